@@ -1,53 +1,89 @@
-from bottle import Bottle, run, static_file, HTTPError, error, template, BaseTemplate
+from bottle import Bottle, run, static_file, HTTPError, HTTPResponse, error, template, BaseTemplate, response
 import importlib
 import os
 import traceback
 import sys
-import json
+from services.dataset_manager import dataset_manager
+from services.metrics import metrics, MetricsMiddleware
 
 app = Bottle()
 
-# Load Athlete JSON data once at app startup
-try:
-    with open('data/strava_athlete.json', 'r') as f:
-        athlete = json.load(f)
-except FileNotFoundError:
-    athlete = {"error": "JSON file not found"}
-except json.JSONDecodeError:
-    athlete = {"error": "Invalid JSON format"}
+# Set the default template variables, the athlete is refreshed before every request
+BaseTemplate.defaults = {'athlete': {}}
 
-# Set the default template variables
-BaseTemplate.defaults = {'athlete': athlete}
+@app.hook('before_request')
+def load_athlete():
+    BaseTemplate.defaults['athlete'] = dataset_manager.athlete()
 
 # Routes for static files (CSS, JS, images)
 @app.route('/static/<filepath:path>')
 def serve_static(filepath):
     return static_file(filepath, root='static/')
 
+# Request counts, timings and map work counters in the Prometheus text format
+@app.route('/metrics')
+def serve_metrics():
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    response.set_header('Cache-Control', 'no-store')
+    return metrics.render()
+
 # Custom error handler for 404
 @app.error(404)
 def error404(error):
     return template('views/404.tpl', message=error.body)
 
-# Dynamic controller/action routing
+def build_route_table(controllers_dir='controllers'):
+    """
+    Imports every controllers/<name>_controller.py once and maps (name, action)
+    to the public methods of a single shared <Name>Controller instance.
+    """
+    routes = {}
+    for filename in sorted(os.listdir(controllers_dir)):
+        if not filename.endswith('_controller.py'):
+            continue
+        name = filename[:-len('_controller.py')]
+        controller_module = importlib.import_module(f"controllers.{name}_controller")
+        controller_instance = getattr(controller_module, f"{name.capitalize()}Controller")()
+        for action in dir(controller_instance):
+            method = getattr(controller_instance, action)
+            if not action.startswith('_') and callable(method):
+                routes[(name, action)] = method
+    return routes
+
+# Controllers are created once, request handlers only look them up
+ROUTES = build_route_table(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controllers'))
+
+# Server-rendered heatmap tiles
+@app.route('/heatmap/tiles/<z:int>/<x:int>/<y:int>.png')
+def heatmap_tile(z, x, y):
+    return ROUTES[('heatmap', 'tile')](z, x, y)
+
+# Map documents of the heatmap views, streamed into the page's iframe
+@app.route('/heatmap/frame/<view>')
+def heatmap_frame(view):
+    return ROUTES[('heatmap', 'frame')](view)
+
+# Geometry of the heatmap views, loaded by the map documents
+@app.route('/heatmap/data/<view>')
+def heatmap_data(view):
+    return ROUTES[('heatmap', 'data')](view)
+
+# Controller/action routing through the route table
 @app.route('/', method=['GET', 'POST'])
 @app.route('/<controller>', method=['GET', 'POST'])
 @app.route('/<controller>/', method=['GET', 'POST'])
 @app.route('/<controller>/<action>', method=['GET', 'POST'])
 def dynamic_route(controller='home', action='index'):
+    action_method = ROUTES.get((controller, action))
+    if action_method is None:
+        raise HTTPError(404, f"Page not found: {controller}/{action}")
     try:
-        # Import the controller module
-        module_name = f"controllers.{controller}_controller"
-        controller_module = importlib.import_module(module_name)
-        
-        # Get the controller class
-        controller_class = getattr(controller_module, f"{controller.capitalize()}Controller")
-        controller_instance = controller_class()
-        
-        # Get and call the action method
-        action_method = getattr(controller_instance, action)
-        return action_method()
-        
+        with metrics.stage('action'):
+            return action_method()
+
+    except HTTPResponse:
+        # Redirects and deliberate errors (e.g. a 400 for bad parameters) pass through
+        raise
     except Exception as e:
         # Log the full error traceback to stderr
         exc_type, exc_value, exc_traceback = sys.exc_info()
@@ -57,6 +93,9 @@ def dynamic_route(controller='home', action='index'):
         # Always return a 404 error to the user
         raise HTTPError(404, f"Page not found: {controller}/{action}")
 
-# Start the app
+# The WSGI application: the app with every request timed and counted, see services/metrics.py
+application = MetricsMiddleware(app, metrics)
+
+# Start the app with the development server, see wsgi.py for serving concurrent users
 if __name__ == "__main__":
-    run(app, host='localhost', port=8080, debug=True, reloader=True)
+    run(application, host='localhost', port=8080, debug=True, reloader=True)
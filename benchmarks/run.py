@@ -0,0 +1,233 @@
+"""
+Benchmarks the map generators and the sync merge path on synthetic histories.
+
+Each case runs in a fresh process inside a scratch copy of the data
+directory, so its peak RSS is its own. Datasets are generated once per size
+and kept in benchmarks/.data.
+
+    python -m benchmarks.run --sizes 100,1000,10000
+    python -m benchmarks.run --save benchmarks/baseline.json
+    python -m benchmarks.run --compare benchmarks/baseline.json
+    python -m benchmarks.run --cases time_data --workers 4  # Aggregation across 4 processes
+
+With ``--compare`` the exit status is 1 when a case got slower or bigger than
+the baseline by more than ``--tolerance``.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from benchmarks import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASET_DIR = os.path.join(ROOT, 'benchmarks', '.data')
+HELD_BACK = 0.05  # Share of the newest activities left for the sync merge case
+
+# Case -> map_service generator, the activities are passed in and the document is built inline
+VIEW_CASES = {
+    'heatmap': 'generate_heatmap',
+    'heatmap_with_time': 'generate_heatmap_with_time',
+    'heatmap_one_at_a_time': 'generate_heatmap_one_ata_time',
+    'routes_map': 'generate_routes_map',
+}
+CASES = ['import'] + list(VIEW_CASES) + ['time_data', 'sync_merge']
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_case(case: str, repeat: int) -> Dict:
+    """Runs one case in the current directory and returns its measurements."""
+    from services.activity_store import activity_store
+
+    with open('held_back.json') as f:
+        held_back = json.load(f)
+
+    if case == 'import':
+        # Everything a full sync does after fetching: store, tabulate, decode, simplify and bin
+        from services.activity_table import load_table
+        from services.density_pyramid import density_pyramid
+        from services.geometry_store import add_geometry
+
+        started = time.perf_counter()
+        activity_store.migrate_from_json('data/strava_activities.json')
+        activities = load_table(activity_store)
+        add_geometry(activities)
+        density_pyramid.rebuild(activities)
+        return {'seconds': time.perf_counter() - started, 'output_bytes': 0, 'activities': len(activities)}
+
+    if case == 'sync_merge':
+        # The incremental sync behind /sync/inc, with Strava replaced by the held back activities
+        from services.sync_jobs import incremental_sync
+
+        listed = {activity['id'] for activity in activity_store.all() + held_back}
+
+        class HeldBackStrava:
+            # Lists every stored activity unchanged and the held back ones as new
+            def fetch_changes(self, client, start_date, end_date, is_changed, on_activities=None, on_progress=None):
+                changed = [activity for activity in held_back if is_changed(activity)]
+                if on_activities:
+                    on_activities(changed)
+                return changed, listed
+
+        started = time.perf_counter()
+        added = incremental_sync(lambda **progress: None, HeldBackStrava(), None)
+        return {'seconds': time.perf_counter() - started, 'output_bytes': 0, 'activities': added}
+
+    import services.map_service as map_service
+    from services.dataset_manager import dataset_manager
+
+    if case == 'time_data':
+        # Just the timelapse geometry, the part ``--workers`` spreads across processes
+        from services.map_data import accumulated_heatmap_data
+
+        activities = dataset_manager.activities()
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            data = accumulated_heatmap_data(map_service.load_batch(activities))
+            timings.append(time.perf_counter() - started)
+        return {'seconds': min(timings), 'output_bytes': len(json.dumps(data, separators=(',', ':'))),
+                'activities': len(activities)}
+
+    # The activity table the server renders from
+    generate = getattr(map_service, VIEW_CASES[case])
+    activities = dataset_manager.activities()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        html = generate(activities)
+        timings.append(time.perf_counter() - started)
+    return {'seconds': min(timings), 'output_bytes': len(html.encode('utf-8')), 'activities': len(activities)}
+
+
+def dataset(size: int) -> str:
+    """Returns the path of the synthetic dataset of a size, generating it the first time."""
+    path = os.path.join(DATASET_DIR, f'activities_{size}.json')
+    if not os.path.exists(path):
+        os.makedirs(DATASET_DIR, exist_ok=True)
+        print(f"Generating {size} synthetic activities...", file=sys.stderr)
+        synthetic.write(size, path + '.tmp')
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def prepare(size: int, workdir: str) -> None:
+    """Lays out a data directory with all but the newest activities and holds those back."""
+    with open(dataset(size)) as f:
+        activities = json.load(f)
+    split = len(activities) - max(1, int(len(activities) * HELD_BACK))
+    os.makedirs(os.path.join(workdir, 'data'))
+    with open(os.path.join(workdir, 'data', 'strava_activities.json'), 'w') as f:
+        json.dump(activities[:split], f)
+    with open(os.path.join(workdir, 'held_back.json'), 'w') as f:
+        json.dump(activities[split:], f)
+
+
+def measure(size: int, cases: List[str], repeat: int, workers: Optional[int] = None) -> Dict[str, Dict]:
+    """Runs the cases on one dataset size, each in its own process."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='heatmap-bench-') as workdir:
+        prepare(size, workdir)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.getenv('PYTHONPATH')])))
+        if workers:
+            # Every size uses the pool, to show from which size on it pays off
+            env.update(HEATMAP_WORKERS=str(workers), HEATMAP_PARALLEL_MIN_POINTS='0')
+        # The import always runs first, every other case reads the store it builds
+        for case in [case for case in CASES if case == 'import' or case in cases]:
+            result = measure_case(case, repeat, workdir, env)
+            if case in cases:
+                results[f"{size}/{case}"] = result
+                print(format_row(f"{size}/{case}", result), file=sys.stderr)
+    return results
+
+
+def measure_case(case: str, repeat: int, workdir: str, env: Dict) -> Dict:
+    if case == 'sync_merge':
+        # Merging must not leave the store changed for later cases
+        scratch = tempfile.mkdtemp(prefix='heatmap-bench-merge-')
+        shutil.copytree(workdir, scratch, dirs_exist_ok=True)
+        workdir = scratch
+    try:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--worker', case, '--repeat', str(repeat)],
+                                cwd=workdir, env=env, check=True, stdout=subprocess.PIPE).stdout
+    finally:
+        if case == 'sync_merge':
+            shutil.rmtree(workdir, ignore_errors=True)
+    return json.loads(output)
+
+
+def format_row(name: str, result: Dict) -> str:
+    return (f"{name:<32} {result['seconds']:>9.3f} s {result['peak_rss_mb']:>9.1f} MB "
+            f"{result['output_bytes'] / 1024:>11.1f} KB")
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """Returns a line per measurement that exceeds its baseline by more than ``tolerance``."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ('seconds', 'peak_rss_mb', 'output_bytes'):
+            if base[metric] and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {result[metric]:.3f} vs baseline {base[metric]:.3f} "
+                                   f"(+{(result[metric] / base[metric] - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help="Comma separated dataset sizes, up to 100000 (default: %(default)s)")
+    parser.add_argument('--cases', default=','.join(CASES), help="Comma separated cases (default: all)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per view case, the fastest counts")
+    parser.add_argument('--save', help="Write the results to this baseline file")
+    parser.add_argument('--compare', help="Compare the results against this baseline file")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed growth over the baseline, 0.25 is 25%% (default: %(default)s)")
+    parser.add_argument('--workers', type=int,
+                        help="Aggregate in this many processes whatever the size, compare against --workers 1")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = run_case(args.worker, args.repeat)
+        result['peak_rss_mb'] = peak_rss_mb()
+        print(json.dumps(result))
+        return 0
+
+    cases = args.cases.split(',')
+    unknown = set(cases) - set(CASES)
+    if unknown:
+        parser.error(f"Unknown cases: {', '.join(sorted(unknown))}, choose from {', '.join(CASES)}")
+
+    print(f"{'case':<32} {'time':>11} {'peak RSS':>12} {'output':>14}", file=sys.stderr)
+    results = {}
+    for size in (int(size) for size in args.sizes.split(',')):
+        results.update(measure(size, cases, args.repeat, args.workers))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Synthetic Strava activity histories for benchmarking.
+
+Activities are clustered the way real histories are: most start from a home
+area, some from a few places visited now and then, and each area has a set
+of favourite routes that get repeated with GPS noise, cut short or run in
+reverse. Routes are encoded polylines with a point every ~20 m, like the
+detailed polylines a sync stores.
+
+    python -m benchmarks.synthetic 10000 data/strava_activities.json
+"""
+import argparse
+import json
+import math
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import numpy as np
+import polyline
+
+METRES_PER_DEGREE = 111_320.0
+POINT_SPACING = 20.0  # Metres between recorded points
+GPS_NOISE = 3.0  # Metres
+
+# Activity type -> (share of activities, typical distance range in km, average speed in m/s)
+TYPES = {
+    'Run': (0.6, (3, 21), 2.9),
+    'Ride': (0.25, (10, 80), 6.5),
+    'Walk': (0.15, (2, 8), 1.4),
+}
+
+# Home area first, then places visited less often
+AREAS = [((18.5204, 73.8567), 0.8), ((19.0760, 72.8777), 0.1), ((15.4909, 73.8278), 0.05),
+         ((12.9716, 77.5946), 0.05)]
+ROUTES_PER_AREA = 40
+
+
+def random_walk(rng: np.random.Generator, start, distance: float) -> np.ndarray:
+    """A smoothly turning path of ``distance`` metres as (N, 2) lat/lng points."""
+    count = max(2, int(distance / POINT_SPACING))
+    heading = rng.uniform(0, 2 * math.pi) + np.cumsum(rng.normal(0, 0.15, count))
+    steps = np.column_stack((np.cos(heading), np.sin(heading))) * POINT_SPACING / METRES_PER_DEGREE
+    steps[:, 1] /= math.cos(math.radians(start[0]))
+    return np.asarray(start) + np.cumsum(steps, axis=0)
+
+
+def path_length(points: np.ndarray) -> float:
+    """Length of a lat/lng path in metres, equirectangular."""
+    deltas = np.diff(points, axis=0)
+    deltas[:, 1] *= math.cos(math.radians(float(points[0, 0])))
+    return float(np.hypot(deltas[:, 0], deltas[:, 1]).sum() * METRES_PER_DEGREE)
+
+
+def generate(count: int, seed: int = 1) -> List[Dict]:
+    """Returns ``count`` activities in the format of strava_activities.json, oldest first."""
+    rng = np.random.default_rng(seed)
+    names = list(TYPES)
+    type_shares = np.array([TYPES[name][0] for name in names])
+
+    # Favourite routes of each area, long enough for the longest activity of any type
+    routes = []
+    for center, _ in AREAS:
+        area_routes = []
+        for _ in range(ROUTES_PER_AREA):
+            start = np.asarray(center) + rng.normal(0, 0.02, 2)
+            area_routes.append(random_walk(rng, start, 80_000))
+        routes.append(area_routes)
+    area_shares = np.array([share for _, share in AREAS])
+
+    activities = []
+    start_time = datetime(2015, 1, 1, 6, 0)
+    for i in range(count):
+        kind = names[rng.choice(len(names), p=type_shares)]
+        low, high = TYPES[kind][1]
+        distance = rng.uniform(low, high) * 1000
+        area = rng.choice(len(AREAS), p=area_shares)
+        if rng.random() < 0.9:
+            route = routes[area][rng.integers(ROUTES_PER_AREA)]
+        else:
+            route = random_walk(rng, np.asarray(AREAS[area][0]) + rng.normal(0, 0.02, 2), high * 1000)
+        points = route[:max(2, int(distance / POINT_SPACING))]
+        if rng.random() < 0.3:
+            points = points[::-1]
+        points = points + rng.normal(0, GPS_NOISE / METRES_PER_DEGREE, points.shape)
+
+        start_time += timedelta(minutes=int(rng.integers(6 * 60, 48 * 60)))
+        distance = path_length(points)
+        speed = TYPES[kind][2] * rng.uniform(0.85, 1.15)
+        activities.append({
+            'id': 1_000_000_000 + i,
+            'name': f"{kind} {i + 1}",
+            'start_date': start_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'start_lat': round(float(points[0, 0]), 6),
+            'start_lng': round(float(points[0, 1]), 6),
+            'distance': round(distance, 1),
+            'moving_time': round(distance / speed),
+            'elapsed_time': round(distance / speed * rng.uniform(1.0, 1.2)),
+            'type': kind,
+            'average_speed': round(speed, 3),
+            'map': polyline.encode(np.round(points, 5).tolist()),
+        })
+    return activities
+
+
+def write(count: int, json_file: str, seed: int = 1) -> None:
+    with open(json_file, 'w') as f:
+        json.dump(generate(count, seed), f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Writes a synthetic strava_activities.json")
+    parser.add_argument('count', type=int, help="Number of activities, e.g. 100 to 100000")
+    parser.add_argument('json_file')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    write(args.count, args.json_file, args.seed)
@@ -0,0 +1,184 @@
+"""
+Syncs activities and exports the map views as static files, without the web server.
+
+Run from the project directory, or give athlete directories with --athlete to
+process several athletes, each directory holding an athlete's data/ and
+services/strava_tokens.json as the project directory does:
+
+    python cli.py sync                      # Incremental sync, or a full one with --full
+    python cli.py export --out data/export  # Render every map view to static files
+    python cli.py build --athlete athletes/alice --athlete athletes/bob --out /srv/heatmaps/{athlete}
+
+``build`` syncs and then exports. Exports are incremental, views whose
+activities and options did not change since the last export are skipped.
+"""
+import argparse
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Start of a full sync when there are no activities yet to start from
+FIRST_SYNC_DATE = '2009-01-01'
+
+
+def parse_date(value: str) -> str:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not a date as YYYY-MM-DD")
+
+
+def report(**progress) -> None:
+    """Prints a sync's stages as the job runner would show them on the progress page."""
+    if 'stage' in progress:
+        print(f"{progress['stage']}...", flush=True)
+
+
+def sync(args) -> int:
+    from services.activity_store import activity_store
+    from services.strava_service import strava_service, strava_client
+    from services.sync_jobs import full_sync, incremental_sync
+
+    if not strava_service.get_valid_access_token(strava_client):
+        print("No Strava tokens, authorize at /sync/authorize in the web app first", file=sys.stderr)
+        return 1
+
+    earliest, latest = activity_store.date_range()
+    if args.full or not latest:
+        start_date = datetime.strptime(args.since or (earliest or FIRST_SYNC_DATE)[:10], "%Y-%m-%d")
+        synced = full_sync(report, strava_service, strava_client, start_date, datetime.today())
+        print(f"Synced {synced} activities since {start_date:%Y-%m-%d}")
+    else:
+        options = {'reconcile_days': args.days} if args.days is not None else {}
+        changes = incremental_sync(report, strava_service, strava_client, **options)
+        print(f"Synced {changes} new, edited or deleted activities")
+    return 0
+
+
+def export(args) -> int:
+    from services.static_export import ExportOptions, export as export_views
+
+    filters = {'start_date': args.start, 'end_date': args.end, 'activity_type': args.type}
+    options = ExportOptions(filters={name: value for name, value in filters.items() if value},
+                            tolerance=args.tolerance, bucket=args.bucket, cumulative=args.cumulative,
+                            inline=args.inline)
+    out_dir = args.out.format(athlete=os.path.basename(os.getcwd()))
+    try:
+        outcomes = export_views(out_dir, args.views.split(',') if args.views else None, options, jobs=args.jobs,
+                                force=args.force, log=lambda line: print(line, flush=True))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    unchanged = [view for view, outcome in outcomes.items() if outcome == 'unchanged']
+    if unchanged:
+        print(f"Unchanged: {', '.join(unchanged)}")
+    print(f"Exported to {os.path.abspath(out_dir)}")
+    return 1 if 'failed' in outcomes.values() else 0
+
+
+def build(args) -> int:
+    status = sync(args)
+    if status and not args.keep_going:
+        return status
+    return export(args) or status
+
+
+COMMANDS = {'sync': sync, 'export': export, 'build': build}
+
+
+def without_athletes(argv: List[str]) -> List[str]:
+    """Returns the command line without its --athlete options, to run in each athlete directory."""
+    args, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--athlete':
+            skip = True
+        elif not arg.startswith('--athlete='):
+            args.append(arg)
+    return args
+
+
+def run_athletes(athletes: List[str], argv: List[str], jobs: int) -> int:
+    """
+    Runs the command in each athlete directory in a process of its own.
+
+    Every process opens the data of its own directory. ``jobs`` is shared
+    out: up to that many athletes run at once, each rendering its share of
+    views in parallel.
+    """
+    running = min(jobs, len(athletes))
+    command = [sys.executable, os.path.abspath(__file__)] + without_athletes(argv) + [
+        '--jobs', str(max(1, jobs // running))]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.getenv('PYTHONPATH')])))
+
+    def run(athlete: str) -> int:
+        if not os.path.isdir(athlete):
+            print(f"[{athlete}] No such directory", file=sys.stderr)
+            return 1
+        result = subprocess.run(command, cwd=athlete, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True)
+        # Printed whole once done, so the output of athletes running at once is not interleaved
+        name = os.path.basename(os.path.abspath(athlete))
+        print(''.join(f"[{name}] {line}\n" for line in result.stdout.splitlines()), end='', flush=True)
+        return result.returncode
+
+    with ThreadPoolExecutor(running) as pool:
+        statuses = list(pool.map(run, athletes))
+    return max(statuses)
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--athlete', action='append', default=[],
+                        help="Athlete directory to run in, repeat for several (default: the current directory)")
+    common.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help="Processes rendering views and athletes at once (default: %(default)s)")
+
+    sync_options = argparse.ArgumentParser(add_help=False)
+    sync_options.add_argument('--full', action='store_true', help="Replace every stored activity with a full sync")
+    sync_options.add_argument('--since', type=parse_date,
+                              help="Start date of a full sync (default: the earliest stored activity)")
+    sync_options.add_argument('--days', type=int,
+                              help="Days an incremental sync re-checks for edits and deletions")
+
+    export_options = argparse.ArgumentParser(add_help=False)
+    export_options.add_argument('--out', default='data/export',
+                                help="Output directory, {athlete} is replaced with the athlete directory's name "
+                                     "(default: %(default)s)")
+    export_options.add_argument('--views', help="Comma separated views to export (default: index,time,single,routes)")
+    export_options.add_argument('--inline', action='store_true',
+                                help="Put the geometry in the documents rather than in data files")
+    export_options.add_argument('--force', action='store_true', help="Render every view, changed or not")
+    export_options.add_argument('--tolerance', type=float, help="Simplification tolerance in metres")
+    export_options.add_argument('--bucket', choices=('day', 'week', 'month'),
+                                help="Group the time views' frames by day, week or month")
+    export_options.add_argument('--cumulative', action='store_true', help="Accumulate routes in the routes view")
+    export_options.add_argument('--start', type=parse_date, help="Only activities from this date")
+    export_options.add_argument('--end', type=parse_date, help="Only activities up to this date")
+    export_options.add_argument('--type', help="Only activities of this type, e.g. Run")
+
+    subparsers.add_parser('sync', parents=[common, sync_options], help="Sync activities from Strava")
+    subparsers.add_parser('export', parents=[common, export_options], help="Export the map views as static files")
+    build_parser = subparsers.add_parser('build', parents=[common, sync_options, export_options],
+                                         help="Sync, then export")
+    build_parser.add_argument('--keep-going', action='store_true',
+                              help="Export the stored activities even when the sync fails")
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.athlete:
+        return run_athletes(args.athlete, argv, args.jobs)
+    return COMMANDS[args.command](args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
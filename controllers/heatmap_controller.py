@@ -1,41 +1,242 @@
-from bottle import template
 import json
-from services.map_service import generate_heatmap, generate_heatmap_with_time, generate_heatmap_one_ata_time, generate_routes_map
+import math
+from datetime import datetime
+from urllib.parse import urlencode
+from bottle import template, request, response, HTTPResponse, HTTPError
+from services.map_service import generate_heatmap, generate_heatmap_with_time, generate_heatmap_one_ata_time, generate_routes_map, generate_tile_heatmap, load_batch
+from services.tile_service import tile_renderer
+from services.render_cache import render_cache
+from services.activity_store import activity_store
+from services.dataset_manager import dataset_manager
+from services.metrics import metrics
+from services.map_data import VIEW_DATA, DATA_OPTIONS, BUCKETS
 from bottle import redirect
 
+# Query parameters selecting which activities a view shows
+FILTER_PARAMS = ('start', 'end', 'type', 'min_distance', 'max_distance', 'bbox')
+# Query parameters that change a rendered view, anything else must not split the cache
+VIEW_PARAMS = ('tolerance', 'cumulative', 'bucket') + FILTER_PARAMS
+
+# Map document generator of each view
+VIEWS = {
+    'index': generate_heatmap,
+    'time': generate_heatmap_with_time,
+    'single': generate_heatmap_one_ata_time,
+    'routes': generate_routes_map,
+    'tiled': lambda activities, tolerance=None, data_url=None:
+        generate_tile_heatmap(activities, tile_version=activity_store.version()),
+}
+
+
 class HeatmapController:
     def load_activities(self):
+        """Loads the activities matching the query filters, only those get decoded"""
+        filters = self.parse_filters()
+        activities = dataset_manager.activities()
+        if filters:
+            activities = activities.filter(**filters)
+        if not activities and not filters:
+            redirect('/sync')
+        return activities
+
+    def parse_number(self, name):
+        value = request.query.get(name)
+        if not value:
+            return None
+        try:
+            number = float(value)
+        except ValueError:
+            raise HTTPError(400, f"{name} must be a number")
+        if not math.isfinite(number) or number < 0:
+            raise HTTPError(400, f"{name} must be a non-negative number")
+        return number
+
+    def parse_date(self, name):
+        value = request.query.get(name)
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            raise HTTPError(400, f"{name} must be a date as YYYY-MM-DD")
+
+    def parse_bbox(self):
+        """Returns the optional ?bbox=south,west,north,east"""
+        value = request.query.get('bbox')
+        if not value:
+            return None
         try:
-            with open('data/strava_activities.json', 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            redirect('/sync') # Will this work reliably?
-            return []
+            south, west, north, east = (float(part) for part in value.split(','))
+        except ValueError:
+            raise HTTPError(400, "bbox must be south,west,north,east in degrees")
+        if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+            raise HTTPError(400, "bbox must be south,west,north,east in degrees")
+        return south, west, north, east
+
+    def parse_filters(self):
+        """Returns the activity_store.query arguments of the query filters that are set"""
+        filters = {
+            'start_date': self.parse_date('start'),
+            'end_date': self.parse_date('end'),
+            'activity_type': request.query.get('type') or None,
+            'min_distance': self.parse_number('min_distance'),
+            'max_distance': self.parse_number('max_distance'),
+            'bbox': self.parse_bbox(),
+        }
+        return {name: value for name, value in filters.items() if value is not None}
+
+    def parse_tolerance(self):
+        """Returns the optional ?tolerance in metres, e.g. ?tolerance=0 for full precision"""
+        return self.parse_number('tolerance')
+
+    def parse_bucket(self):
+        """Returns the optional ?bucket grouping time views' frames by day, week or month"""
+        bucket = request.query.get('bucket')
+        if bucket and bucket not in BUCKETS:
+            raise HTTPError(400, f"bucket must be one of {', '.join(BUCKETS)}")
+        return bucket or None
+
+    def view_params(self, names=VIEW_PARAMS):
+        return {name: request.query.get(name) for name in names if request.query.get(name)}
+
+    def data_params(self, view):
+        """Returns the query parameters that change a view's data"""
+        return self.view_params(('tolerance',) + FILTER_PARAMS + DATA_OPTIONS.get(view, ()))
+
+    def data_options(self, view):
+        options = {'bucket': self.parse_bucket()}
+        return {name: options[name] for name in DATA_OPTIONS.get(view, ()) if options[name]}
+
+    def render_map(self, view):
+        """Render the page shell of a map view, the map itself loads from /heatmap/frame/<view>"""
+        self.parse_tolerance()
+        self.parse_bucket()
+        self.parse_filters()
+        if not dataset_manager.activities():
+            redirect('/sync')
+        params = self.view_params()
+        frame_url = f"/heatmap/frame/{view}" + (f"?{urlencode(params)}" if params else '')
+        return template('views/heatmap.tpl', frame_url=frame_url)
+
+    def stream_cached(self, key, build, content_type):
+        """Stream a cached body in the best encoding the client accepts, building it on a miss"""
+        encoding = None
+        for _ in range(2):
+            if not render_cache.has(key):
+                with metrics.stage('build'):
+                    body = build()
+                with metrics.stage('compress'):
+                    render_cache.put(key, body)
+            encoding = render_cache.negotiate(key, request.headers.get('Accept-Encoding', ''))
+            try:
+                size, chunks = render_cache.stream(key, encoding)
+                break
+            except OSError:
+                continue  # Evicted between the check and the read, build again
+        else:
+            raise HTTPError(500, "Could not read the cached response")
+
+        response.content_type = content_type
+        if encoding != 'identity':
+            response.set_header('Content-Encoding', encoding)
+        response.set_header('Vary', 'Accept-Encoding')
+        response.set_header('Content-Length', str(size))
+        return chunks
+
+    def data_key(self, view):
+        return render_cache.key(f"data/{view}", self.data_params(view))
+
+    def frame(self, view):
+        """Stream a view's map document from the render cache, rendering it on a miss"""
+        if view not in VIEWS:
+            raise HTTPError(404, f"Unknown map view: {view}")
+        tolerance = self.parse_tolerance()
+        self.parse_bucket()
+        self.parse_filters()
+        key = render_cache.key(view, self.view_params())
+        etag = f'"{key}"'
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            return HTTPResponse(status=304, ETag=etag)
+
+        # The geometry loads separately from a URL that changes with the data
+        data_url = None
+        if view in VIEW_DATA:
+            data_url = f"/heatmap/data/{view}?" + urlencode(dict(self.data_params(view), v=self.data_key(view)))
+        options = {'cumulative': request.query.get('cumulative') == '1'} if view == 'routes' else {}
+
+        # Server tiles are rendered from every activity, filters apply to the client-side views
+        load = self.load_activities if view in VIEW_DATA else dataset_manager.activities
+
+        def build():
+            with metrics.stage('load'):
+                activities = load()
+            return VIEWS[view](activities, tolerance=tolerance, data_url=data_url, **options)
+
+        chunks = self.stream_cached(key, build, 'text/html; charset=utf-8')
+        response.set_header('ETag', etag)
+        response.set_header('Cache-Control', 'no-cache')
+        return chunks
+
+    def data(self, view):
+        """Stream the geometry of a map view as JSON"""
+        if view not in VIEW_DATA:
+            raise HTTPError(404, f"Unknown data view: {view}")
+        tolerance = self.parse_tolerance()
+        self.parse_bucket()
+        self.parse_filters()
+        key = self.data_key(view)
+        etag = f'"{key}"'
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            return HTTPResponse(status=304, ETag=etag)
+
+        def build():
+            with metrics.stage('load'):
+                activities = self.load_activities()
+            batch = load_batch(activities)
+            with metrics.stage('data'):
+                data = VIEW_DATA[view](batch, tolerance, **self.data_options(view))
+            with metrics.stage('encode'):
+                return json.dumps(data, separators=(',', ':'))
+
+        chunks = self.stream_cached(key, build, 'application/json')
+        response.set_header('ETag', etag)
+        if request.query.get('v') == key:
+            # The URL changes with the data, so the browser can keep this response
+            response.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+        else:
+            response.set_header('Cache-Control', 'no-cache')
+        return chunks
 
     def index(self):
-        activities = self.load_activities()
-        # Generate heatmap
-        heatmap_html = generate_heatmap(activities)
-        # Return the HTML to display in a template
-        return template('views/heatmap.tpl', map=heatmap_html)
+        return self.render_map('index')
 
     def time(self):
-        activities = self.load_activities()
-        # Generate heatmap
-        heatmap_html = generate_heatmap_with_time(activities)
-        # Return the HTML to display in a template
-        return template('views/heatmap.tpl', map=heatmap_html)
+        return self.render_map('time')
 
     def single(self):
-        activities = self.load_activities()
-        # Generate heatmap
-        heatmap_html = generate_heatmap_one_ata_time(activities)
-        # Return the HTML to display in a template
-        return template('views/heatmap.tpl', map=heatmap_html)
-    
+        return self.render_map('single')
+
     def routes(self):
-        activities = self.load_activities()
-        # Generate heatmap
-        heatmap_html = generate_routes_map(activities)
-        # Return the HTML to display in a template
-        return template('views/heatmap.tpl', map=heatmap_html)        
+        return self.render_map('routes')
+
+    def tiled(self):
+        return self.render_map('tiled')
+
+    def tile(self, z, x, y):
+        """Serve one server-rendered heatmap tile as PNG"""
+        if not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise HTTPError(404, "Tile out of range")
+        version = activity_store.version()
+        etag = f'"{version}-{z}-{x}-{y}"'
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            return HTTPResponse(status=304, ETag=etag)
+
+        response.content_type = 'image/png'
+        response.set_header('ETag', etag)
+        if request.query.get('v') == str(version):
+            # The URL changes with every sync, so this exact tile never goes stale
+            response.set_header('Cache-Control', 'public, max-age=31536000, immutable')
+        else:
+            response.set_header('Cache-Control', 'no-cache')
+        with metrics.stage('tile'):
+            return tile_renderer.render(z, x, y)
@@ -1,30 +1,21 @@
 from bottle import template
 import os
-import json
-from stravalib.client import Client
-from services.strava_service import StravaService
+from services.strava_service import strava_service
+from services.dataset_manager import dataset_manager
 
 class HomeController:
     def index(self):
+        dataset = dataset_manager.current()
         checklist = {
             'env_file': os.path.exists('services/.env'),
             'strava_credentials': False,
             'data_files': {
-                'strava_activities': os.path.exists('data/strava_activities.json'),
-                'strava_athlete': os.path.exists('data/strava_athlete.json')
+                'strava_activities': bool(dataset.activities),
+                'strava_athlete': bool(dataset.athlete)
             }
         }
 
-        # Initialize StravaService
-        strava_service = StravaService()
+        # Checks the tokens held in memory, refreshing them is left to the token manager
+        checklist['strava_credentials'] = strava_service.tokens.has_credentials()
 
-        # Validate Strava credentials
-        client = Client()
-        checklist['strava_credentials'] = strava_service.get_valid_access_token(client)
-
-        athlete = {}
-        if checklist['data_files']['strava_athlete']:
-            with open('data/strava_athlete.json', 'r') as f:
-                athlete = json.load(f)
-
-        return template('views/index.tpl', checklist=checklist, athlete=athlete)
\ No newline at end of file
+        return template('views/index.tpl', checklist=checklist, athlete=dataset.athlete)
\ No newline at end of file
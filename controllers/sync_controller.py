@@ -1,14 +1,15 @@
-from bottle import template, request, redirect, route
-from datetime import datetime, timedelta
-import json
-import os
-from stravalib.client import Client
-from services.strava_service import StravaService
+from bottle import template, request, response, redirect, route
+from datetime import datetime
+from services.strava_service import strava_service, strava_client
+from services.activity_store import activity_store
+from services.dataset_manager import dataset_manager
+from services.job_runner import job_runner
+from services.sync_jobs import full_sync, incremental_sync
 
 class SyncController:
     def __init__(self):
-        self.strava_service = StravaService()
-        self.client = Client()
+        self.strava_service = strava_service
+        self.client = strava_client
         
     def index(self):
         """Show the sync form page"""
@@ -24,26 +25,35 @@ class SyncController:
         return template('views/sync/index.tpl', start_date=start_date, end_date=end_date)
         
     def sync(self):
-        """Handle the sync request"""
+        """Queue a full sync in the background and show its progress"""
         try:
             # Get date parameters from form
             start_date = datetime.strptime(request.forms.get('start_date'), "%Y-%m-%d")
             end_date_input = request.forms.get('end_date')
             end_date = datetime.today() if not end_date_input else datetime.strptime(end_date_input, "%Y-%m-%d")
-                        
-            # Fetch and save activities
-            activities = self.strava_service.fetch_activities(self.client, start_date, end_date)
-            
-            # Save to data file
-            os.makedirs('data', exist_ok=True)
-            with open('data/strava_activities.json', 'w') as f:
-                json.dump(activities, f, indent=4)
-                
-            return template('views/sync/success.tpl', activity_count=len(activities))
-            
-        except Exception as e:
+        except (TypeError, ValueError) as e:
             return template('views/sync/error.tpl', error=str(e))
-            
+
+        if not self.strava_service.get_valid_access_token(self.client):
+            return redirect('/sync/authorize')
+
+        job_id = job_runner.submit('sync', full_sync, self.strava_service, self.client, start_date, end_date)
+        return redirect(f'/sync/progress?job={job_id}')
+
+    def progress(self):
+        """Show a page following a sync job's progress"""
+        return template('views/sync/progress.tpl', job_id=request.query.get('job', ''))
+
+    def status(self):
+        """Report a sync job's progress as JSON, the latest sync job if none is given"""
+        job_id = request.query.get('job')
+        job = job_runner.status(int(job_id) if job_id and job_id.isdigit() else None, kind='sync')
+        response.set_header('Cache-Control', 'no-store')
+        if job is None:
+            response.status = 404
+            return {'error': 'No such sync job'}
+        return job
+
     def authorize(self):
         """Start the Strava OAuth flow"""
         auth_url = self.strava_service.get_authorization_url()
@@ -58,52 +68,35 @@ class SyncController:
         return redirect('/sync')
 
     def inc(self):
-        """Handle incremental sync request"""
-        try:
-            # Ensure we have valid authentication
-            if not self.strava_service.get_valid_access_token(self.client):
-                return redirect('/sync/authorize')
+        """Queue an incremental sync in the background and show its progress
 
-            # Get existing activities
-            existing_activities = []
-            if os.path.exists('data/strava_activities.json'):
-                with open('data/strava_activities.json', 'r') as f:
-                    existing_activities = json.load(f)
+        ?days=N re-checks the last N days for edited and deleted activities,
+        SYNC_RECONCILE_DAYS by default.
+        """
+        days = request.query.get('days')
+        if days and not days.isdigit():
+            return template('views/sync/error.tpl', error="days must be a whole number of days")
+        options = {'reconcile_days': int(days)} if days else {}
+
+        # Ensure we have valid authentication
+        if not self.strava_service.get_valid_access_token(self.client):
+            return redirect('/sync/authorize')
+
+        # Get the last synced date from the start_date index
+        _, latest_start_date = activity_store.date_range()
+        if not latest_start_date:
+            return redirect('/sync')  # Redirect to full sync if no activities exist
+
+        job_id = job_runner.submit('sync', incremental_sync, self.strava_service, self.client, **options)
+        return redirect(f'/sync/progress?job={job_id}')
 
-            # Get the last synced date
-            if not existing_activities:
-                return redirect('/sync')  # Redirect to full sync if no activities exist
-                
-            # Sort activities by start_date and get the latest date
-            sorted_activities = sorted(existing_activities, key=lambda x: x['start_date'])
-            last_sync_date = datetime.fromisoformat(sorted_activities[-1]['start_date'].replace('Z', '+00:00'))
-            
-            # Add one second to avoid duplicate activity
-            start_date = last_sync_date + timedelta(seconds=1)
-            end_date = datetime.today()
-            
-            # Fetch new activities
-            new_activities = self.strava_service.fetch_activities(self.client, start_date, end_date)
-            
-            # Combine existing and new activities
-            all_activities = existing_activities + new_activities
-            
-            # Save to data file
-            os.makedirs('data', exist_ok=True)
-            with open('data/strava_activities.json', 'w') as f:
-                json.dump(all_activities, f, indent=4)
-                
-            return template('views/sync/success.tpl', activity_count=len(new_activities))
-            
-        except Exception as e:
-            return template('views/sync/error.tpl', error=str(e)) 
-        
     def athlete(self):
         # Ensure we have valid authentication
         if not self.strava_service.get_valid_access_token(self.client):
             return redirect('/sync/authorize')
         
         athlete = self.strava_service.fetch_athlete(self.client)
+        dataset_manager.reload()  # Swap the new athlete into every page
         return template('views/athlete.tpl', athlete=athlete)
                 
 
@@ -0,0 +1,93 @@
+from datetime import datetime
+from functools import cached_property
+from typing import List, Mapping, Sequence, Tuple
+
+import numpy as np
+
+from services.activity_store import SUMMARY_COLUMNS, summarize
+from services.activity_table import ActivityTable
+from services.geometry_store import geometry_store, simplified
+from services.metrics import metrics
+
+
+class ActivityBatch:
+    """
+    Decoded geometry and start times of a set of activities in flat NumPy arrays.
+
+    ``coords`` is one contiguous (N, 2) lat/lng array holding every activity's
+    points, and ``offsets[i]:offsets[i + 1]`` is the slice belonging to activity
+    ``i``. Both are only built when first used, start times, bounds and centre
+    come from the summary columns stored with each activity, read as whole
+    columns when the activities are an ``ActivityTable``. Only activities
+    with a route are kept, ordered by start date.
+    """
+
+    def __init__(self, activities: Sequence[Mapping]):
+        if isinstance(activities, ActivityTable):
+            # Columns come straight from the table's arrays rather than row by row
+            routed = activities.take(np.flatnonzero(activities.has_text('map')))
+            order = np.argsort(routed.column('epoch'), kind='stable')
+            self.activities = routed.take(order)
+            self.epochs = self.activities.column('epoch').astype('datetime64[s]')
+            self.summary = np.column_stack([self.activities.column(column).astype(np.float64)
+                                            for column in SUMMARY_COLUMNS if column != 'epoch']).reshape(-1, 7)
+            return
+
+        # Activities that did not come from the store get their summary computed here
+        routed = [activity if activity.get('epoch') is not None else {**activity, **summarize(activity)}
+                  for activity in activities if activity.get('map')]
+        epochs = np.array([activity['epoch'] for activity in routed], dtype='datetime64[s]')
+        order = np.argsort(epochs, kind='stable')
+
+        self.activities = [routed[i] for i in order]
+        self.epochs = epochs[order]
+        self.summary = np.array([[activity[column] for column in SUMMARY_COLUMNS if column != 'epoch']
+                                 for activity in self.activities], dtype=np.float64).reshape(-1, 7)
+
+    @cached_property
+    def offsets(self) -> np.ndarray:
+        counts = self.summary[:, 6].astype(np.int64)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets
+
+    @cached_property
+    def coords(self) -> np.ndarray:
+        with metrics.stage('decode'):
+            geometry_store.add(self.activities)  # Only decodes activities not cached yet
+        arrays = [geometry_store.get(activity) for activity in self.activities]
+        return np.concatenate(arrays) if arrays else np.empty((0, 2), dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.activities)
+
+    def points(self, index: int) -> np.ndarray:
+        """Returns the (N, 2) points of one activity."""
+        return self.coords[self.offsets[index]:self.offsets[index + 1]]
+
+    def simplified(self, index: int, tolerance: float) -> np.ndarray:
+        """Returns one activity's points simplified with Douglas-Peucker, precomputed where possible."""
+        return simplified(self.activities[index], tolerance)
+
+    def bounds(self) -> List[List[float]]:
+        """Returns [[min_lat, min_lng], [max_lat, max_lng]] of all points."""
+        return [[float(np.nanmin(self.summary[:, 0])), float(np.nanmin(self.summary[:, 2]))],
+                [float(np.nanmax(self.summary[:, 1])), float(np.nanmax(self.summary[:, 3]))]]
+
+    def center(self) -> List[float]:
+        """Returns the mean point."""
+        counts = self.summary[:, 6]
+        routed = counts > 0
+        return ((self.summary[routed, 4:6] * counts[routed, None]).sum(axis=0) / counts.sum()).tolist()
+
+    def start(self) -> List[float]:
+        """Returns the start point of the first activity."""
+        first = self.activities[0]
+        if first.get('start_lat') is not None and first.get('start_lng') is not None:
+            return [first['start_lat'], first['start_lng']]
+        return self.points(0)[0].tolist()
+
+    def date_range(self) -> Tuple[datetime, datetime]:
+        """Returns the first and last activity day."""
+        days = self.epochs[[0, -1]].astype('datetime64[D]').astype('datetime64[s]')
+        return days[0].astype(datetime), days[1].astype(datetime)
@@ -0,0 +1,357 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import polyline
+
+from services.geometry_store import add_geometry
+
+COLUMNS = ['id', 'name', 'start_date', 'start_lat', 'start_lng', 'distance',
+           'moving_time', 'elapsed_time', 'type', 'average_speed', 'map']
+
+# Derived from start_date and the route when an activity is written, so renders only read them
+SUMMARY_COLUMNS = {
+    'epoch': 'INTEGER',  # Start time in seconds since 1970 UTC
+    'min_lat': 'REAL',
+    'max_lat': 'REAL',
+    'min_lng': 'REAL',
+    'max_lng': 'REAL',
+    'centroid_lat': 'REAL',  # Mean of the route's points
+    'centroid_lng': 'REAL',
+    'vertex_count': 'INTEGER',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    start_date TEXT NOT NULL,
+    start_lat REAL,
+    start_lng REAL,
+    distance REAL,
+    moving_time REAL,
+    elapsed_time REAL,
+    type TEXT,
+    average_speed REAL,
+    map TEXT,
+    epoch INTEGER,
+    min_lat REAL,
+    max_lat REAL,
+    min_lng REAL,
+    max_lng REAL,
+    centroid_lat REAL,
+    centroid_lng REAL,
+    vertex_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_activities_start_date ON activities (start_date);
+CREATE INDEX IF NOT EXISTS idx_activities_type ON activities (type, start_date);
+CREATE INDEX IF NOT EXISTS idx_activities_distance ON activities (distance);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Spatial index over each activity's route bounding box
+BOUNDS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS activity_bounds USING rtree(id, min_lat, max_lat, min_lng, max_lng);
+"""
+
+# Used when SQLite was built without the R*Tree module
+BOUNDS_FALLBACK_SCHEMA = """
+CREATE TABLE IF NOT EXISTS activity_bounds (
+    id INTEGER PRIMARY KEY,
+    min_lat REAL,
+    max_lat REAL,
+    min_lng REAL,
+    max_lng REAL
+);
+CREATE INDEX IF NOT EXISTS idx_activity_bounds_lat ON activity_bounds (min_lat, max_lat);
+"""
+
+
+def summarize(activity: Dict) -> Dict:
+    """
+    Computes an activity's SUMMARY_COLUMNS: start epoch, route bounds, centroid and vertex count.
+
+    Bounds and centroid are None for activities without a route.
+    """
+    summary = dict.fromkeys(SUMMARY_COLUMNS)
+    summary['epoch'] = int(np.datetime64(activity['start_date'][:19], 's').astype(np.int64))
+    encoded = activity.get('map')
+    points = np.asarray(polyline.decode(encoded) if encoded else [], dtype=np.float64).reshape(-1, 2)
+    summary['vertex_count'] = len(points)
+    if len(points):
+        summary['min_lat'], summary['min_lng'] = points.min(axis=0).tolist()
+        summary['max_lat'], summary['max_lng'] = points.max(axis=0).tolist()
+        summary['centroid_lat'], summary['centroid_lng'] = points.mean(axis=0).tolist()
+    return summary
+
+
+class ActivityStore:
+    """
+    SQLite-backed store of synced activities.
+
+    Activities are keyed by their Strava id and indexed on ``start_date``,
+    ``type`` and ``distance``, so appends only touch new rows and date bounds
+    come straight from the index. Each route's bounding box is kept in the
+    ``activity_bounds`` R-tree, which answers bounding box filters without
+    decoding any geometry. Facts derived from the route and start date
+    (``SUMMARY_COLUMNS``) are computed once when an activity is written and
+    returned with it, so renders never decode polylines for them. A
+    ``version`` counter in the meta table is bumped on every write and used
+    in cache keys, next to the incremental sync's cursor. The legacy
+    ``strava_activities.json`` is imported once the first time the store is
+    opened.
+    """
+
+    def __init__(self, db_file: str = 'data/strava_activities.db',
+                 legacy_file: str = 'data/strava_activities.json'):
+        self.db_file = db_file
+        self.legacy_file = legacy_file
+        self._ready = False
+        self._deferred = threading.local()  # Writes of the thread's deferred_version block
+
+    @contextmanager
+    def _connect(self):
+        self._initialise()
+        conn = sqlite3.connect(self.db_file)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _initialise(self) -> None:
+        """Creates the schema and migrates the legacy JSON file on first use."""
+        if self._ready:
+            return
+        migrate = not os.path.exists(self.db_file) and os.path.exists(self.legacy_file)
+        os.makedirs(os.path.dirname(self.db_file) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.db_file)
+        try:
+            conn.executescript(SCHEMA)
+            try:
+                conn.executescript(BOUNDS_SCHEMA)
+            except sqlite3.OperationalError:
+                conn.executescript(BOUNDS_FALLBACK_SCHEMA)
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(activities)")}
+            with conn:
+                # Tells a recreated database apart from the one it replaced, whose version it may repeat
+                conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('created', ?)", (str(time.time_ns()),))
+                for column, kind in SUMMARY_COLUMNS.items():
+                    if column not in existing:
+                        conn.execute(f"ALTER TABLE activities ADD COLUMN {column} {kind}")
+                self._backfill_summaries(conn)
+        finally:
+            conn.close()
+        self._ready = True
+        if migrate:
+            self.migrate_from_json(self.legacy_file)
+
+    def migrate_from_json(self, json_file: str) -> int:
+        """
+        Imports activities from a strava_activities.json file.
+
+        Their full and simplified routes are cached too, as a sync would, so
+        the first route maps after the import do not decode every polyline.
+        """
+        try:
+            with open(json_file, 'r') as f:
+                activities = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return 0
+        written = self.upsert(activities)
+        add_geometry(activities)
+        return written
+
+    def _backfill_summaries(self, conn, everything: bool = False) -> int:
+        """Computes the summary columns and route bounds of rows stored without them."""
+        where = "" if everything else "WHERE vertex_count IS NULL"
+        rows = conn.execute(f"SELECT id, start_date, map FROM activities {where}").fetchall()
+        summaries = {activity_id: summarize({'start_date': start_date, 'map': encoded})
+                     for activity_id, start_date, encoded in rows}
+        assignments = ', '.join(f"{column} = ?" for column in SUMMARY_COLUMNS)
+        conn.executemany(f"UPDATE activities SET {assignments} WHERE id = ?",
+                         [(*summary.values(), activity_id) for activity_id, summary in summaries.items()])
+        self._write_bounds(conn, summaries)
+        return len(summaries)
+
+    def backfill_summaries(self) -> int:
+        """Recomputes the summary columns of every stored activity. Returns the number updated."""
+        with self._connect() as conn:
+            return self._backfill_summaries(conn, everything=True)
+
+    def _write_bounds(self, conn, summaries: Dict[int, Dict]) -> None:
+        bounds, unrouted = [], []
+        for activity_id, summary in summaries.items():
+            if summary['vertex_count']:
+                bounds.append((activity_id, summary['min_lat'], summary['max_lat'],
+                               summary['min_lng'], summary['max_lng']))
+            else:
+                unrouted.append((activity_id,))
+        conn.executemany("INSERT OR REPLACE INTO activity_bounds (id, min_lat, max_lat, min_lng, max_lng) "
+                         "VALUES (?, ?, ?, ?, ?)", bounds)
+        conn.executemany("DELETE FROM activity_bounds WHERE id = ?", unrouted)
+
+    def all(self) -> List[Dict]:
+        """Returns every activity ordered by start date."""
+        return self.query()
+
+    def query(self, start_date: Optional[str] = None, end_date: Optional[str] = None,
+              activity_type: Optional[str] = None, min_distance: Optional[float] = None,
+              max_distance: Optional[float] = None,
+              bbox: Optional[Tuple[float, float, float, float]] = None) -> List[Dict]:
+        """
+        Returns activities matching every given filter, ordered by start date,
+        including their summary columns.
+
+        Start dates are an inclusive range, distances are in metres and ``bbox``
+        is (south, west, north, east), matching routes that overlap it.
+        """
+        clauses, params = [], []
+        if start_date:
+            clauses.append("start_date >= ?")
+            params.append(start_date)
+        if end_date:
+            # A bare date includes the whole end day
+            clauses.append("start_date <= ?" if 'T' in end_date else "start_date < date(?, '+1 day')")
+            params.append(end_date)
+        if activity_type:
+            clauses.append("type = ?")
+            params.append(activity_type)
+        if min_distance is not None:
+            clauses.append("distance >= ?")
+            params.append(min_distance)
+        if max_distance is not None:
+            clauses.append("distance <= ?")
+            params.append(max_distance)
+        if bbox:
+            south, west, north, east = bbox
+            clauses.append("id IN (SELECT id FROM activity_bounds "
+                           "WHERE max_lat >= ? AND min_lat <= ? AND max_lng >= ? AND min_lng <= ?)")
+            params.extend([south, north, west, east])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT {', '.join(COLUMNS + list(SUMMARY_COLUMNS))} FROM activities {where} "
+                "ORDER BY start_date", params)
+            return [dict(row) for row in rows]
+
+    def date_range(self) -> Tuple[Optional[str], Optional[str]]:
+        """Returns the earliest and latest start_date, or (None, None) if empty."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT MIN(start_date), MAX(start_date) FROM activities").fetchone()
+        return row[0], row[1]
+
+    def count(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM activities").fetchone()[0]
+
+    def version(self) -> int:
+        """Returns a counter that changes whenever the stored activities change."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def created(self) -> str:
+        """Returns when the database was created, which with ``version`` identifies its contents."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'created'").fetchone()
+        return row[0] if row else ''
+
+    def sync_cursor(self) -> Optional[int]:
+        """Returns the epoch up to which every activity has been synced, None before the first sync."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'sync_cursor'").fetchone()
+        return int(row[0]) if row else None
+
+    def set_sync_cursor(self, epoch: int) -> None:
+        with self._connect() as conn:
+            conn.execute("INSERT INTO meta (key, value) VALUES ('sync_cursor', ?) "
+                         "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (int(epoch),))
+
+    @contextmanager
+    def deferred_version(self):
+        """
+        Bumps the version once for all the writes this thread makes in the block.
+
+        A sync writes page by page, bumping the version on each would rebuild
+        the shared activity table once per page. It is bumped even if the block
+        raises, the pages written so far are already committed.
+        """
+        self._deferred.writes = 0
+        try:
+            yield
+        finally:
+            writes, self._deferred.writes = self._deferred.writes, None
+            if writes:
+                with self._connect() as conn:
+                    self._bump_version(conn)
+
+    def _bump_version(self, conn) -> None:
+        if getattr(self._deferred, 'writes', None) is not None:
+            self._deferred.writes += 1
+            return
+        conn.execute("INSERT INTO meta (key, value) VALUES ('version', 1) "
+                     "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+    def _write(self, conn, activities: Iterable[Dict]) -> int:
+        summaries = {activity['id']: (activity, summarize(activity)) for activity in activities}
+        if not summaries:
+            return 0  # Pages of unchanged activities write nothing and keep the caches valid
+        columns = COLUMNS + list(SUMMARY_COLUMNS)
+        rows = [tuple(activity.get(column) for column in COLUMNS) + tuple(summary.values())
+                for activity, summary in summaries.values()]
+        placeholders = ', '.join('?' for _ in columns)
+        updates = ', '.join(f"{column} = excluded.{column}" for column in columns[1:])
+        conn.executemany(
+            f"INSERT INTO activities ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT(id) DO UPDATE SET {updates}", rows)
+        self._write_bounds(conn, {activity_id: summary for activity_id, (_, summary) in summaries.items()})
+        self._bump_version(conn)
+        return len(rows)
+
+    def upsert(self, activities: Iterable[Dict]) -> int:
+        """Inserts or updates activities by id. Returns the number written."""
+        with self._connect() as conn:
+            return self._write(conn, activities)
+
+    def replace_all(self, activities: List[Dict]) -> int:
+        """Replaces the stored activities with a freshly synced set in one transaction."""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM activities")
+            conn.execute("DELETE FROM activity_bounds")
+            self._bump_version(conn)
+            return self._write(conn, activities)
+
+    def retain(self, ids: Iterable[int]) -> int:
+        """Deletes every activity whose id is not in ``ids``. Returns the number deleted."""
+        with self._connect() as conn:
+            conn.execute("CREATE TEMP TABLE keep (id INTEGER PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO keep (id) VALUES (?)", ((int(i),) for i in ids))
+            deleted = conn.execute("DELETE FROM activities WHERE id NOT IN (SELECT id FROM keep)").rowcount
+            conn.execute("DELETE FROM activity_bounds WHERE id NOT IN (SELECT id FROM keep)")
+            conn.execute("DROP TABLE keep")
+            if deleted:
+                self._bump_version(conn)
+            return deleted
+
+    def delete(self, ids: Iterable[int]) -> int:
+        """Deletes activities by id, e.g. those deleted on Strava. Returns the number deleted."""
+        ids = [(int(i),) for i in ids]
+        with self._connect() as conn:
+            deleted = sum(conn.execute("DELETE FROM activities WHERE id = ?", row).rowcount for row in ids)
+            conn.executemany("DELETE FROM activity_bounds WHERE id = ?", ids)
+            if deleted:
+                self._bump_version(conn)
+            return deleted
+
+
+activity_store = ActivityStore()
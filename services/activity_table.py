@@ -0,0 +1,262 @@
+import json
+import os
+import shutil
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from services.activity_store import COLUMNS, SUMMARY_COLUMNS
+
+# Fixed-width columns, floats are NaN where the store has NULL and type is a code into the table's type names
+NUMERIC_DTYPE = np.dtype([
+    ('id', '<i8'),
+    ('epoch', '<i8'),
+    ('type', '<i2'),
+    ('distance', '<f8'),
+    ('moving_time', '<f8'),
+    ('elapsed_time', '<f8'),
+    ('average_speed', '<f8'),
+    ('start_lat', '<f8'),
+    ('start_lng', '<f8'),
+    ('min_lat', '<f8'),
+    ('max_lat', '<f8'),
+    ('min_lng', '<f8'),
+    ('max_lng', '<f8'),
+    ('centroid_lat', '<f8'),
+    ('centroid_lng', '<f8'),
+    ('vertex_count', '<i8'),
+])
+INTEGER_COLUMNS = ('id', 'epoch', 'vertex_count')
+# Variable-length columns, each a UTF-8 blob with a (start, length) index, -1 length for NULL
+TEXT_COLUMNS = ('name', 'start_date', 'map')
+ROW_KEYS = tuple(COLUMNS) + tuple(SUMMARY_COLUMNS)
+
+TABLE_DIR = 'data/activity_table'
+
+
+class ActivityRow(Mapping):
+    """One activity of an ActivityTable, read from the columns on access like the store's row dicts."""
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table: 'ActivityTable', index: int):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key: str):
+        return self.table.value(key, self.index)
+
+    def __iter__(self):
+        return iter(ROW_KEYS)
+
+    def __len__(self) -> int:
+        return len(ROW_KEYS)
+
+    def __repr__(self) -> str:
+        return f"ActivityRow({dict(self)!r})"
+
+
+class ActivityTable(Sequence):
+    """
+    Columnar snapshot of the stored activities.
+
+    Numeric fields are one fixed-width NumPy record per activity and text
+    fields (name, start date, encoded polyline) UTF-8 blobs with an index, so
+    a table saved with ``save`` loads with ``load`` as memory maps: opening
+    it reads no rows and a request only touches the pages of the columns and
+    activities it uses. Rows are ``ActivityRow`` mappings with the keys of
+    ``ActivityStore.query`` rows. ``filter`` and ``take`` return views on
+    the same arrays, in table order, which is by start date.
+    """
+
+    def __init__(self, numeric: np.ndarray, texts: Dict[str, Tuple[np.ndarray, np.ndarray]], types: List[str],
+                 rows: Optional[np.ndarray] = None):
+        self.numeric = numeric
+        self.texts = texts
+        self.types = types
+        self.rows = rows  # Indices into the arrays of the rows this view holds, all of them if None
+
+    @classmethod
+    def from_activities(cls, activities: List[Dict]) -> 'ActivityTable':
+        """Builds a table from store rows, e.g. ``ActivityStore.all()``."""
+        types = sorted({activity['type'] for activity in activities if activity.get('type') is not None})
+        codes = {name: code for code, name in enumerate(types)}
+        numeric = np.zeros(len(activities), dtype=NUMERIC_DTYPE)
+        for name in NUMERIC_DTYPE.names:
+            if name == 'type':
+                numeric[name] = [codes.get(activity.get('type'), -1) for activity in activities]
+            elif name in INTEGER_COLUMNS:
+                numeric[name] = [activity.get(name) or 0 for activity in activities]
+            else:
+                numeric[name] = [np.nan if activity.get(name) is None else activity[name] for activity in activities]
+        texts = {name: encode_texts(activity.get(name) for activity in activities) for name in TEXT_COLUMNS}
+        return cls(numeric, texts, types)
+
+    @classmethod
+    def load(cls, directory: str) -> 'ActivityTable':
+        """Memory-maps a table written by ``save``."""
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        numeric = np.load(os.path.join(directory, 'numeric.npy'), mmap_mode='r')
+        texts = {}
+        for name in TEXT_COLUMNS:
+            index = np.load(os.path.join(directory, f'{name}_index.npy'), mmap_mode='r')
+            blob_file = os.path.join(directory, f'{name}.bin')
+            blob = (np.memmap(blob_file, dtype=np.uint8, mode='r') if os.path.getsize(blob_file)
+                    else np.empty(0, dtype=np.uint8))
+            texts[name] = (index, blob)
+        return cls(numeric, texts, meta['types'])
+
+    def save(self, directory: str) -> None:
+        """Writes the table to a new directory, renamed into place once complete."""
+        table = self.compact()
+        tmp_dir = directory + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'numeric.npy'), table.numeric)
+        for name, (index, blob) in table.texts.items():
+            np.save(os.path.join(tmp_dir, f'{name}_index.npy'), index)
+            with open(os.path.join(tmp_dir, f'{name}.bin'), 'wb') as f:
+                f.write(blob.tobytes())
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'count': len(table), 'types': table.types}, f)
+        os.rename(tmp_dir, directory)
+
+    def compact(self) -> 'ActivityTable':
+        """Returns a table holding just the rows of this view in arrays of its own."""
+        if self.rows is None:
+            return self
+        texts = {name: encode_texts(self.text(name, i) for i in range(len(self))) for name in TEXT_COLUMNS}
+        return ActivityTable(np.ascontiguousarray(self.numeric[self.rows]), texts, self.types)
+
+    def __len__(self) -> int:
+        return len(self.numeric) if self.rows is None else len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(np.arange(len(self))[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return ActivityRow(self, index)
+
+    def _row(self, index: int) -> int:
+        return index if self.rows is None else int(self.rows[index])
+
+    def value(self, key: str, index: int):
+        """Returns one field of the row at ``index`` as the store would, None for NULL."""
+        if key in TEXT_COLUMNS:
+            return self.text(key, index)
+        if key not in NUMERIC_DTYPE.names:
+            raise KeyError(key)
+        value = self.numeric[key][self._row(index)]
+        if key == 'type':
+            return self.types[value] if value >= 0 else None
+        if key in INTEGER_COLUMNS:
+            return int(value)
+        return None if np.isnan(value) else float(value)
+
+    def text(self, name: str, index: int) -> Optional[str]:
+        index_array, blob = self.texts[name]
+        start, length = index_array[self._row(index)]
+        if length < 0:
+            return None
+        return blob[start:start + length].tobytes().decode('utf-8')
+
+    def column(self, name: str) -> np.ndarray:
+        """Returns a numeric column of the rows in this view, a view of the memory map for a whole table."""
+        values = self.numeric[name]
+        return values if self.rows is None else values[self.rows]
+
+    def has_text(self, name: str) -> np.ndarray:
+        """Returns a boolean mask of the rows with a non-empty ``name`` text field."""
+        lengths = self.texts[name][0][:, 1]
+        return (lengths if self.rows is None else lengths[self.rows]) > 0
+
+    def take(self, indices: Iterable[int]) -> 'ActivityTable':
+        """Returns a view of the rows at ``indices`` of this view."""
+        indices = np.asarray(indices, dtype=np.int64)
+        rows = indices if self.rows is None else self.rows[indices]
+        return ActivityTable(self.numeric, self.texts, self.types, rows)
+
+    def filter(self, start_date: Optional[str] = None, end_date: Optional[str] = None,
+               activity_type: Optional[str] = None, min_distance: Optional[float] = None,
+               max_distance: Optional[float] = None,
+               bbox: Optional[Tuple[float, float, float, float]] = None) -> 'ActivityTable':
+        """
+        Returns the rows matching every given filter, the arguments of ``ActivityStore.query``.
+
+        Dates compare against the UTC start epoch, so they select the same
+        rows as the store does for its ISO 8601 start dates.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        epochs = self.column('epoch')
+        if start_date:
+            mask &= epochs >= to_epoch(start_date)
+        if end_date:
+            # A bare date includes the whole end day
+            mask &= epochs <= to_epoch(end_date) if 'T' in end_date else epochs < to_epoch(end_date) + 24 * 60 * 60
+        if activity_type:
+            if activity_type not in self.types:
+                return self.take([])
+            mask &= self.column('type') == self.types.index(activity_type)
+        distances = self.column('distance')
+        if min_distance is not None:
+            mask &= distances >= min_distance
+        if max_distance is not None:
+            mask &= distances <= max_distance
+        if bbox:
+            south, west, north, east = bbox
+            mask &= ((self.column('max_lat') >= south) & (self.column('min_lat') <= north)
+                     & (self.column('max_lng') >= west) & (self.column('min_lng') <= east))
+        return self.take(np.flatnonzero(mask))
+
+
+def encode_texts(values: Iterable[Optional[str]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Packs strings into a (N, 2) (start, length) index and a UTF-8 blob, length -1 for None."""
+    encoded = [None if value is None else str(value).encode('utf-8') for value in values]
+    lengths = np.array([-1 if value is None else len(value) for value in encoded], dtype=np.int64)
+    starts = np.zeros(len(encoded), dtype=np.int64)
+    np.cumsum(np.maximum(lengths, 0)[:-1], out=starts[1:])
+    blob = np.frombuffer(b''.join(value for value in encoded if value), dtype=np.uint8)
+    return np.column_stack((starts, lengths)).reshape(-1, 2), blob
+
+
+def to_epoch(date: str) -> int:
+    return int(np.datetime64(date[:19], 's').astype(np.int64))
+
+
+def store_fingerprint(store) -> str:
+    """
+    Identifies the store's contents: its version counter and, should the
+    database be recreated, its creation time. Not the file's mtime, which
+    also changes when a sync only moves its cursor.
+    """
+    return f"{store.version()}-{store.created()}"
+
+
+def load_table(store, table_dir: str = TABLE_DIR) -> ActivityTable:
+    """
+    Returns the store's activities as an ActivityTable, memory-mapped from
+    ``table_dir`` when a table of the store's current contents was saved
+    there before, otherwise read from the store and saved for next time.
+    """
+    fingerprint = store_fingerprint(store)
+    directory = os.path.join(table_dir, fingerprint)
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        return ActivityTable.load(directory)
+
+    table = ActivityTable.from_activities(store.all())
+    if store_fingerprint(store) != fingerprint:
+        return table  # Written to while being read, the next load saves the newer contents
+    os.makedirs(table_dir, exist_ok=True)
+    try:
+        table.save(directory)
+    except OSError:
+        return table  # Saved by another process in the meantime, or the disk is read-only
+    for name in os.listdir(table_dir):
+        if name != fingerprint:
+            shutil.rmtree(os.path.join(table_dir, name), ignore_errors=True)
+    return ActivityTable.load(directory)
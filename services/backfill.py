@@ -0,0 +1,36 @@
+"""
+Precomputes the derived data of activities synced before it was stored at ingest.
+
+Imports ``data/strava_activities.json`` (or another file) into the activity
+store, recomputes every activity's summary columns and caches the columnar
+activity table, the decoded and simplified routes and the density pyramid. Run from the project directory:
+
+    python -m services.backfill [--json data/strava_activities.json]
+"""
+import argparse
+import os
+
+from services.activity_store import activity_store
+from services.activity_table import load_table
+from services.density_pyramid import density_pyramid
+from services.geometry_store import add_geometry
+from services.render_cache import render_cache
+
+
+def backfill(json_file: str) -> None:
+    if os.path.exists(json_file):
+        print(f"Imported {activity_store.migrate_from_json(json_file)} activities from {json_file}")
+    print(f"Summarized {activity_store.backfill_summaries()} activities")
+
+    activities = load_table(activity_store)
+    print(f"Saved the activity table of {len(activities)} activities")
+    print(f"Decoded {add_geometry(activities)} routes")
+    print(f"Binned {density_pyramid.update(activities)} routes into the density pyramid")
+    render_cache.invalidate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--json', default=activity_store.legacy_file,
+                        help="Activities JSON file to import first (default: %(default)s)")
+    backfill(parser.parse_args().json)
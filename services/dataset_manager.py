@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+from services.activity_store import activity_store
+from services.activity_table import ActivityTable, load_table
+
+ATHLETE_FILE = 'data/strava_athlete.json'
+
+
+class Dataset(NamedTuple):
+    version: str  # Fingerprint of the athlete file and the activity store, used in cache keys
+    athlete: Dict
+    activities: ActivityTable
+
+
+class DatasetManager:
+    """
+    Shared in-memory snapshot of the athlete and every stored activity.
+
+    Requests read ``current()`` and never parse the athlete file or query the
+    full activity table themselves. Activities are an ``ActivityTable``
+    memory-mapped from its saved copy, which is only rebuilt from the store
+    after a write, so starting up reads no rows. A new snapshot is built when the athlete
+    file's mtime or the store's version counter changes and swapped in as one
+    object, so a request sees either the old or the new data, never a mix.
+    Changes are looked for at most every ``check_interval`` seconds, and
+    ``reload`` picks them up at once after a sync in this process.
+    """
+
+    def __init__(self, athlete_file: str = ATHLETE_FILE, store=activity_store, check_interval: float = 1.0,
+                 clock=time.monotonic):
+        self.athlete_file = athlete_file
+        self.store = store
+        self.check_interval = check_interval
+        self.clock = clock
+        self._dataset: Optional[Dataset] = None
+        self._athlete_mtime = None
+        self._store_version = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def _athlete_file_mtime(self):
+        try:
+            return os.stat(self.athlete_file).st_mtime_ns
+        except OSError:
+            return 'missing'
+
+    def _load_athlete(self) -> Dict:
+        try:
+            with open(self.athlete_file, 'r') as f:
+                athlete = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+        return athlete if isinstance(athlete, dict) else {}
+
+    def _refresh(self, force: bool = False) -> Dataset:
+        with self._lock:
+            now = self.clock()
+            if not force and self._dataset is not None and now - self._checked < self.check_interval:
+                return self._dataset
+            self._checked = now
+
+            athlete_mtime, store_version = self._athlete_file_mtime(), self.store.version()
+            dataset = self._dataset
+            if dataset is None or athlete_mtime != self._athlete_mtime or store_version != self._store_version:
+                # Only what changed is reloaded, the rest is carried over from the previous snapshot
+                athlete = (self._load_athlete() if dataset is None or athlete_mtime != self._athlete_mtime
+                           else dataset.athlete)
+                activities = (load_table(self.store) if dataset is None or store_version != self._store_version
+                              else dataset.activities)
+                self._dataset = Dataset(f"{store_version}|{athlete_mtime}", athlete, activities)
+                self._athlete_mtime, self._store_version = athlete_mtime, store_version
+            return self._dataset
+
+    def current(self) -> Dataset:
+        """Returns the latest snapshot, reloading it if the files changed."""
+        dataset = self._dataset
+        if dataset is not None and self.clock() - self._checked < self.check_interval:
+            return dataset
+        return self._refresh()
+
+    def reload(self) -> Dataset:
+        """Picks up changes immediately, called after a sync writes new data."""
+        return self._refresh(force=True)
+
+    def athlete(self) -> Dict:
+        return self.current().athlete
+
+    def activities(self) -> ActivityTable:
+        """Returns every stored activity ordered by start date, shared between requests so not to be modified."""
+        return self.current().activities
+
+    def version(self) -> str:
+        return self.current().version
+
+
+dataset_manager = DatasetManager()
@@ -0,0 +1,190 @@
+import os
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from services.geometry_store import geometry_store
+
+TILE_SIZE = 256
+MAX_LEVEL = 16  # Cells at this level are the pixels of zoom 16 tiles
+
+
+def project(coords: np.ndarray) -> np.ndarray:
+    """Projects (lat, lng) pairs to Web Mercator world coordinates in [0, 1)."""
+    lat = np.radians(np.clip(coords[:, 0], -85.0511, 85.0511))
+    wx = (coords[:, 1] + 180.0) / 360.0
+    wy = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0
+    return np.column_stack((wx, wy))
+
+
+def cell_keys(world: np.ndarray, level: int) -> np.ndarray:
+    """Returns the sorted-friendly key (x << 32 | y) of the level cell containing each point."""
+    size = TILE_SIZE * 2 ** level
+    px = np.clip((world[:, 0] * size).astype(np.int64), 0, size - 1)
+    py = np.clip((world[:, 1] * size).astype(np.int64), 0, size - 1)
+    return (px << 32) | py
+
+
+def aggregate(keys: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sums counts of equal keys, returning sorted unique keys."""
+    if not len(keys):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    unique, inverse = np.unique(keys, return_inverse=True)
+    return unique, np.bincount(inverse.ravel(), weights=counts, minlength=len(unique)).astype(np.int64)
+
+
+def coarsen(keys: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Aggregates cells of one level into the cells of the level above."""
+    px, py = keys >> 32, keys & 0xFFFFFFFF
+    return aggregate(((px >> 1) << 32) | (py >> 1), counts)
+
+
+def bin_points(world: np.ndarray, level: int = MAX_LEVEL) -> Tuple[np.ndarray, np.ndarray]:
+    """Bins projected points into sparse (keys, counts) cells of one level."""
+    return aggregate(cell_keys(world, level), np.ones(len(world), dtype=np.int64))
+
+
+def cell_centers(keys: np.ndarray, level: int) -> np.ndarray:
+    """Returns the (lat, lng) center of each cell."""
+    size = TILE_SIZE * 2 ** level
+    wx = ((keys >> 32) + 0.5) / size
+    wy = ((keys & 0xFFFFFFFF) + 0.5) / size
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * wy))))
+    return np.column_stack((lat, wx * 360.0 - 180.0))
+
+
+class DensityPyramid:
+    """
+    Multi-resolution sparse grid of point counts built from activity geometry.
+
+    Level ``L`` holds one cell per pixel of the zoom ``L`` map tiles, stored as
+    sorted ``x << 32 | y`` keys with their counts, so a tile is a binary search
+    plus a slice. Levels are saved together in one ``.npz`` file along with the
+    ids and polyline checksums of the activities they include. ``update`` merges
+    only new activities into every level and rebuilds when a route was edited or
+    an activity removed, since their old cells cannot be told apart.
+    """
+
+    def __init__(self, pyramid_file: str = 'data/density_pyramid.npz'):
+        self.pyramid_file = pyramid_file
+        self._lock = threading.Lock()
+        self._levels: List[Tuple[np.ndarray, np.ndarray]] = []
+        self._ids = np.empty(0, dtype=np.int64)
+        self._checksums = np.empty(0, dtype=np.int64)
+        self._mtime = None
+
+    def _reload_if_changed(self) -> None:
+        try:
+            mtime = os.path.getmtime(self.pyramid_file)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        with np.load(self.pyramid_file) as data:
+            self._ids = data['ids']
+            # Pyramids saved before checksums were kept get rebuilt on the next update
+            self._checksums = data['checksums'] if 'checksums' in data else np.full(len(self._ids), -1)
+            self._levels = [(data[f'keys_{level}'], data[f'counts_{level}'])
+                            for level in range(MAX_LEVEL + 1)]
+        self._mtime = mtime
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.pyramid_file) or '.', exist_ok=True)
+        arrays = {'ids': self._ids, 'checksums': self._checksums}
+        for level, (keys, counts) in enumerate(self._levels):
+            arrays[f'keys_{level}'] = keys
+            arrays[f'counts_{level}'] = counts
+        tmp_file = self.pyramid_file + '.tmp.npz'
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, self.pyramid_file)
+        self._mtime = os.path.getmtime(self.pyramid_file)
+
+    @staticmethod
+    def _build_levels(activities: Iterable[Dict]) -> List[Tuple[np.ndarray, np.ndarray]]:
+        arrays = [geometry_store.get(activity) for activity in activities if activity.get('map')]
+        world = project(np.concatenate(arrays)) if arrays else np.empty((0, 2))
+        levels = [bin_points(world, MAX_LEVEL)]
+        for _ in range(MAX_LEVEL):
+            levels.append(coarsen(*levels[-1]))
+        return levels[::-1]
+
+    def covers_exactly(self, ids: np.ndarray) -> bool:
+        """Whether the pyramid holds the routes of exactly these (distinct) activity ids."""
+        with self._lock:
+            self._reload_if_changed()
+            return len(ids) > 0 and len(ids) == len(self._ids) and bool(
+                np.isin(ids, self._ids, assume_unique=True).all())
+
+    @staticmethod
+    def _fingerprints(activities: Iterable[Dict]) -> Dict[int, int]:
+        return {int(a['id']): geometry_store.checksum(a['map']) for a in activities if a.get('map')}
+
+    def _replace(self, levels: List[Tuple[np.ndarray, np.ndarray]], fingerprints: Dict[int, int]) -> None:
+        self._levels = levels
+        self._ids = np.array(sorted(fingerprints), dtype=np.int64)
+        self._checksums = np.array([fingerprints[i] for i in self._ids.tolist()], dtype=np.int64)
+        self._save()
+
+    def rebuild(self, activities: List[Dict]) -> None:
+        """Rebuilds every level from scratch, e.g. after a full sync."""
+        levels = self._build_levels(activities)
+        with self._lock:
+            self._replace(levels, self._fingerprints(activities))
+
+    def update(self, activities: List[Dict]) -> int:
+        """
+        Brings the pyramid in line with the complete set of stored activities.
+
+        New activities are merged into the existing levels. If an included
+        activity's polyline changed or it is no longer stored, every level is
+        rebuilt. Returns the number of activities binned.
+        """
+        fingerprints = self._fingerprints(activities)
+        with self._lock:
+            self._reload_if_changed()
+            known = dict(zip(self._ids.tolist(), self._checksums.tolist()))
+            if self._levels and known == fingerprints:
+                return 0
+
+            if all(fingerprints.get(i) == crc for i, crc in known.items()):
+                new = [a for a in activities if a.get('map') and int(a['id']) not in known]
+                added = self._build_levels(new)
+                if self._levels:
+                    added = [aggregate(np.concatenate((keys, new_keys)), np.concatenate((counts, new_counts)))
+                             for (keys, counts), (new_keys, new_counts) in zip(self._levels, added)]
+                self._replace(added, fingerprints)
+                return len(new)
+
+            self._replace(self._build_levels(activities), fingerprints)
+            return len(fingerprints)
+
+    def cells(self, level: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the (keys, counts) of one level."""
+        with self._lock:
+            self._reload_if_changed()
+            if not self._levels:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+            return self._levels[min(level, MAX_LEVEL)]
+
+    def tile_counts(self, z: int, x: int, y: int) -> np.ndarray:
+        """Returns a TILE_SIZE x TILE_SIZE grid of point counts for a map tile."""
+        level = min(z, MAX_LEVEL)
+        factor = 2 ** (z - level)  # Tile pixels per cell when zoomed past the finest level
+        span = max(1, TILE_SIZE // factor)
+        x0, y0 = x * TILE_SIZE // factor, y * TILE_SIZE // factor
+
+        keys, counts = self.cells(level)
+        lo, hi = np.searchsorted(keys, [x0 << 32, (x0 + span) << 32])
+        px = (keys[lo:hi] >> 32) - x0
+        py = (keys[lo:hi] & 0xFFFFFFFF) - y0
+        inside = (py >= 0) & (py < span)
+
+        grid = np.bincount(py[inside] * span + px[inside], weights=counts[lo:hi][inside],
+                           minlength=span * span).reshape(span, span)
+        if span < TILE_SIZE:
+            grid = np.repeat(np.repeat(grid, TILE_SIZE // span, axis=0), TILE_SIZE // span, axis=1)
+        return grid
+
+
+density_pyramid = DensityPyramid()
@@ -0,0 +1,187 @@
+import os
+import threading
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import polyline
+
+from services.simplify import douglas_peucker, douglas_peucker_ranks
+
+PRECISION = 1e5
+
+# Douglas-Peucker tolerances in metres precomputed at sync time, those of the routes and time views
+SIMPLIFY_TOLERANCES = (3.0, 5.0)
+
+
+class GeometryStore:
+    """
+    Persistent cache of decoded activity polylines keyed by activity id.
+
+    Coordinates are stored as int32 (lat, lng) pairs scaled by 1e5, the native
+    precision of Strava's encoded polylines, in one append-only binary file.
+    A small index file maps each activity id to its (offset, count) in that
+    file and a CRC of the encoded polyline it was decoded from. The coordinate
+    file is memory-mapped on load, so reading a route is a slice rather than a
+    decode. New activities append, and so do routes whose polyline changed
+    (e.g. an edited activity or a detailed polyline replacing the summary).
+
+    With a ``tolerance`` the store holds routes simplified with Douglas-Peucker
+    instead, keyed by the same polyline CRC.
+    """
+
+    def __init__(self, data_dir: str = 'data', name: str = 'geometry', tolerance: float = 0.0):
+        self.data_dir = data_dir
+        self.tolerance = tolerance
+        self.coords_file = os.path.join(data_dir, f'{name}.bin')
+        self.index_file = os.path.join(data_dir, f'{name}_index.npy')
+        self._lock = threading.Lock()
+        self._index: Dict[int, Tuple[int, int, int]] = {}
+        self._coords = np.empty((0, 2), dtype=np.int32)
+        self._loaded_size = -1
+        self._index_mtime = None
+
+    def _reload_if_changed(self) -> None:
+        """Re-maps the files when another writer has appended to them."""
+        try:
+            size = os.path.getsize(self.coords_file)
+            index_mtime = os.path.getmtime(self.index_file)
+        except OSError:
+            return
+        if size == self._loaded_size and index_mtime == self._index_mtime:
+            return
+
+        entries = np.load(self.index_file)
+        if entries.shape[1] < 4:
+            # Index written before polyline checksums, force a re-decode
+            entries = np.column_stack((entries, np.full(len(entries), -1)))
+        self._index = {int(i): (int(o), int(c), int(h)) for i, o, c, h in entries}
+        self._coords = (np.memmap(self.coords_file, dtype=np.int32, mode='r').reshape(-1, 2)
+                        if size else np.empty((0, 2), dtype=np.int32))
+        self._loaded_size = size
+        self._index_mtime = index_mtime
+
+    @staticmethod
+    def checksum(encoded: str) -> int:
+        return zlib.crc32(encoded.encode('ascii', 'replace'))
+
+    def _decode(self, encoded: str) -> np.ndarray:
+        points = np.asarray(polyline.decode(encoded), dtype=np.float64).reshape(-1, 2)
+        return douglas_peucker(points, self.tolerance) if self.tolerance else points
+
+    def _cached(self, activity_id: int, encoded: str):
+        entry = self._index.get(activity_id)
+        if entry is not None and entry[2] == self.checksum(encoded):
+            return entry
+        return None
+
+    def add(self, activities: Iterable[Dict], points: Optional[Callable[[Dict], np.ndarray]] = None) -> int:
+        """
+        Decodes and appends activities not cached or whose polyline changed. Returns the number added.
+
+        :param points: Returns the points to store for an activity, instead of decoding its polyline.
+        """
+        with self._lock:
+            self._reload_if_changed()
+            pending: List[Tuple[int, int, np.ndarray]] = []
+            queued = set()
+            for activity in activities:
+                activity_id = activity.get('id')
+                if activity_id is None or not activity.get('map'):
+                    continue
+                activity_id = int(activity_id)
+                if activity_id in queued or self._cached(activity_id, activity['map']):
+                    continue
+                coords = points(activity) if points else self._decode(activity['map'])
+                pending.append((activity_id, self.checksum(activity['map']),
+                                np.rint(coords * PRECISION).astype(np.int32)))
+                queued.add(activity_id)
+
+            if not pending:
+                return 0
+
+            os.makedirs(self.data_dir, exist_ok=True)
+            with open(self.coords_file, 'ab') as f:
+                offset = f.tell() // 8
+                for activity_id, crc, coords in pending:
+                    f.write(coords.tobytes())
+                    self._index[activity_id] = (offset, len(coords), crc)
+                    offset += len(coords)
+
+            entries = np.array([(i, o, c, h) for i, (o, c, h) in self._index.items()], dtype=np.int64)
+            tmp_file = self.index_file + '.tmp.npy'
+            np.save(tmp_file, entries)
+            os.replace(tmp_file, self.index_file)
+            self._loaded_size = -1
+            return len(pending)
+
+    def spans(self, activities: Iterable[Dict]) -> np.ndarray:
+        """
+        Returns the (offset, count) of each activity's cached points, (-1, 0) where not cached.
+
+        Together with ``read`` this lets worker processes read routes from the
+        memory-mapped file themselves, rather than be sent the points.
+        """
+        with self._lock:
+            self._reload_if_changed()
+            spans = [self._cached(int(activity['id']), activity['map'])
+                     if activity.get('id') is not None and activity.get('map') else None
+                     for activity in activities]
+        return np.array([span[:2] if span else (-1, 0) for span in spans], dtype=np.int64).reshape(-1, 2)
+
+    def read(self, offset: int, count: int) -> np.ndarray:
+        """Returns the points at a span from ``spans`` as an (N, 2) float array of lat/lng."""
+        with self._lock:
+            self._reload_if_changed()
+            return self._coords[offset:offset + count] / PRECISION
+
+    def get(self, activity: Dict) -> np.ndarray:
+        """Returns an activity's points as an (N, 2) float array of lat/lng."""
+        activity_id = activity.get('id')
+        if not activity.get('map'):
+            return np.empty((0, 2), dtype=np.float64)
+        with self._lock:
+            self._reload_if_changed()
+            entry = self._cached(int(activity_id), activity['map']) if activity_id is not None else None
+            if entry is not None:
+                offset, count, _ = entry
+                return self._coords[offset:offset + count] / PRECISION
+        return self._decode(activity['map'])
+
+
+geometry_store = GeometryStore()
+simplified_stores = {tolerance: GeometryStore(name=f'geometry_dp{tolerance:g}', tolerance=tolerance)
+                     for tolerance in SIMPLIFY_TOLERANCES}
+
+
+def simplified(activity: Dict, tolerance: float) -> np.ndarray:
+    """Returns an activity's points simplified with Douglas-Peucker, precomputed where possible."""
+    store = simplified_stores.get(float(tolerance))
+    if store is not None:
+        return store.get(activity)
+    return douglas_peucker(geometry_store.get(activity), tolerance)
+
+
+def add_geometry(activities: List[Dict], chunk_size: int = 1000) -> int:
+    """
+    Caches the full and simplified routes of activities. Returns the most any store added.
+
+    Routes are decoded once and ranked by one Douglas-Peucker pass that serves
+    every tolerance, a chunk of activities at a time to bound memory.
+    """
+    added = {'full': geometry_store.add(activities)}
+    for start in range(0, len(activities), chunk_size):
+        chunk = activities[start:start + chunk_size]
+        ranked = {}
+
+        def simplified_points(activity: Dict, tolerance: float) -> np.ndarray:
+            if activity['id'] not in ranked:
+                points = geometry_store.get(activity)
+                ranked[activity['id']] = points, douglas_peucker_ranks(points, min(SIMPLIFY_TOLERANCES))
+            points, ranks = ranked[activity['id']]
+            return points[ranks > tolerance]
+
+        for tolerance, store in simplified_stores.items():
+            added[tolerance] = added.get(tolerance, 0) + store.add(
+                chunk, points=lambda activity: simplified_points(activity, tolerance))
+    return max(added.values())
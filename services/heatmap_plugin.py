@@ -0,0 +1,53 @@
+from folium.elements import JSCSSMixin
+from folium.map import Layer
+from folium.template import Template
+
+MAP_DATA_JS = ("map_data.js", "/static/map_data.js")
+
+
+class DensityHeatMap(JSCSSMixin, Layer):
+    """
+    A Folium plugin for a static heatmap of weighted density cells.
+
+    The cells are given inline or as the URL of a JSON endpoint the browser
+    fetches once the map has rendered, as delta-encoded ``points`` with one
+    entry in ``weights`` per point.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{this.get_name()}} = L.heatLayer([], {{ this.options | tojson }});
+
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var layer = {{this.get_name()}};
+                layer.addTo(map);
+
+                MapData.load({{ this.data | tojson }}).then(function(data) {
+                    const points = MapData.decodePoints(data.points);
+                    layer.setLatLngs(points.map((point, i) => [point[0], point[1], data.weights[i]]));
+                }).catch(function(error) {
+                    console.error("Error in DensityHeatMap plugin:", error);
+                });
+            })();
+        {% endmacro %}
+    """)
+
+    default_js = [
+        (
+            "leaflet-heat.js",
+            "https://cdn.jsdelivr.net/gh/python-visualization/folium@main/folium/templates/leaflet_heat.min.js",
+        ),
+        MAP_DATA_JS,
+    ]
+
+    def __init__(self, data, radius=25, blur=15, min_opacity=0.5, max_zoom=18, scale_radius=False,
+                 name=None, overlay=True, control=True, show=True):
+        """
+        :param data: A dict with delta-encoded 'points' and their 'weights', or the URL returning it.
+        """
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = "DensityHeatMap"
+        self.data = data
+        self.options = {'radius': radius, 'blur': blur, 'minOpacity': min_opacity,
+                        'maxZoom': max_zoom, 'scaleRadius': scale_radius}
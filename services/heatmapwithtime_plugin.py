@@ -0,0 +1,149 @@
+from folium.elements import JSCSSMixin
+from folium.map import Layer
+from folium.template import Template
+
+from services.heatmap_plugin import MAP_DATA_JS
+
+
+class HeatMapWithTimeDiff(JSCSSMixin, Layer):
+    """
+    A Folium plugin for a time heatmap that transmits only per-frame changes.
+
+    Distinct points are sent once and each frame is a flat ``[index, count, ...]``
+    list of the point counts it adds. The browser keeps a running counts array
+    and applies (or reverts) frame diffs as the time slider moves, so the page
+    grows with the number of points rather than points x frames. The data is
+    given inline or as the URL of a JSON endpoint fetched after the map renders.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{this.get_name()}} = L.heatLayer([], {{ this.options | tojson }});
+
+            MapData.load({{ this.data | tojson }}).then(function(data) {
+                try {
+                    const points = MapData.decodePoints(data.points);
+                    const frames = data.frames;
+                    const times = data.times;
+                    const cumulative = {{ this.cumulative | tojson }};
+
+                    var map = {{ this._parent.get_name() }};
+                    var layer = {{this.get_name()}};
+
+                    // Frame lookup by timestamp instead of scanning on every change
+                    const frameIndex = new Map(times.map((time, index) => [time, index]));
+                    const counts = new Float64Array(points.length);
+                    var current = -1;
+
+                    function apply(frame, sign) {
+                        for (var i = 0; i < frame.length; i += 2) {
+                            counts[frame[i]] += sign * frame[i + 1];
+                        }
+                    }
+
+                    function frameLatLngs(frame) {
+                        var latlngs = [];
+                        for (var i = 0; i < frame.length; i += 2) {
+                            const point = points[frame[i]];
+                            latlngs.push([point[0], point[1], counts[frame[i]]]);
+                        }
+                        return latlngs;
+                    }
+
+                    function show(target) {
+                        var latlngs;
+                        if (cumulative) {
+                            while (current < target) apply(frames[++current], 1);
+                            while (current > target) apply(frames[current--], -1);
+                            latlngs = [];
+                            for (var i = 0; i < points.length; i++) {
+                                if (counts[i] > 0) latlngs.push([points[i][0], points[i][1], counts[i]]);
+                            }
+                        } else {
+                            if (current >= 0) apply(frames[current], -1);
+                            apply(frames[target], 1);
+                            current = target;
+                            latlngs = frameLatLngs(frames[target]);
+                        }
+                        var max = 1;
+                        for (var j = 0; j < latlngs.length; j++) max = Math.max(max, latlngs[j][2]);
+                        layer.setOptions({max: max});
+                        layer.setLatLngs(latlngs);
+                    }
+
+                    if (!map.timeDimension) {
+                        map.timeDimension = new L.TimeDimension({
+                            times: times,
+                            currentTime: times[0]
+                        });
+                        map.addControl(new L.Control.TimeDimension({
+                            autoPlay: {{ this.auto_play | tojson }},
+                            loopButton: true,
+                            timeSliderDragUpdate: true,
+                            displayDateFormat: 'YYYY-MM-DD HH:mm',
+                            // Times are the activities' local clock times encoded as UTC
+                            timeZones: ['UTC'],
+                            position: {{ this.position | tojson }},
+                            playerOptions: {transitionTime: {{ this.transition_time | tojson }}, loop: false}
+                        }));
+                    }
+
+                    map.timeDimension.on('timeload', function() {
+                        const index = frameIndex.get(map.timeDimension.getCurrentTime());
+                        if (index !== undefined) show(index);
+                    });
+
+                    layer.addTo(map);
+                    show(0);
+                } catch (error) {
+                    console.error("Error in HeatMapWithTimeDiff plugin:", error);
+                }
+            }).catch(function(error) {
+                console.error("Error loading HeatMapWithTimeDiff data:", error);
+            });
+        {% endmacro %}
+    """)
+
+    default_js = [
+        (
+            "leaflet-heat.js",
+            "https://cdn.jsdelivr.net/gh/python-visualization/folium@main/folium/templates/leaflet_heat.min.js",
+        ),
+        (
+            "iso8601",
+            "https://cdn.jsdelivr.net/npm/iso8601-js-period@0.2.1/iso8601.min.js",
+        ),
+        (
+            "leaflet.timedimension.min.js",
+            "https://cdn.jsdelivr.net/npm/leaflet-timedimension@1.1.1/dist/leaflet.timedimension.min.js",
+        ),
+        MAP_DATA_JS,
+    ]
+
+    default_css = [
+        (
+            "leaflet.timedimension.control.min.css",
+            "https://cdn.jsdelivr.net/npm/leaflet-timedimension@1.1.1/dist/leaflet.timedimension.control.css",
+        )
+    ]
+
+    def __init__(self, data, cumulative=True, radius=5, blur=4, min_opacity=0.3,
+                 auto_play=True, position='topleft', transition_time=200,
+                 name=None, overlay=True, control=True, show=True):
+        """
+        :param data: A dict, or the URL returning it, with
+            'points': the distinct points as a delta-encoded [dlat, dlng, ...] list scaled by 1e5,
+            'frames': one flat [point index, count, ...] list per time step,
+            'times': epoch milliseconds of each time step (local clock time as UTC), ascending and unique.
+        :param cumulative: Keep earlier frames' counts (True) or show each frame alone (False).
+        """
+        super().__init__(name=name, overlay=overlay, control=control, show=show)
+        self._name = "HeatMapWithTimeDiff"
+        if isinstance(data, dict) and len(data['frames']) != len(data['times']):
+            raise ValueError("Each frame needs exactly one time.")
+        self.data = data
+        self.cumulative = cumulative
+        self.auto_play = auto_play
+        self.position = position
+        self.transition_time = transition_time
+        self.options = {'radius': radius, 'blur': blur, 'minOpacity': min_opacity}
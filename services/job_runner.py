@@ -0,0 +1,99 @@
+import itertools
+import queue
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, Dict, Optional
+
+
+class JobRunner:
+    """
+    Runs long tasks such as a Strava sync on a background worker thread.
+
+    Submitted jobs are queued and run one at a time, so a sync never blocks a
+    request handler. Every job has an entry in the job table with its state
+    (queued, running, done or failed) and the progress fields it reports
+    through the ``progress`` callback it is called with. An ETA is estimated
+    from the elapsed time and the ``done``/``remaining`` work counts.
+    """
+
+    def __init__(self, clock=time.time, keep: int = 20):
+        self.clock = clock
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._jobs: Dict[int, Dict] = {}
+        self._queue: queue.Queue = queue.Queue()
+        self._ids = itertools.count(1)
+        self._worker: Optional[threading.Thread] = None
+
+    def submit(self, kind: str, task: Callable, *args, **kwargs) -> int:
+        """
+        Queues ``task(progress, *args, **kwargs)`` and returns its job id.
+
+        A job of the same kind that is still queued or running is reused
+        instead of starting a second one.
+        """
+        with self._lock:
+            for job in self._jobs.values():
+                if job['kind'] == kind and job['state'] in ('queued', 'running'):
+                    return job['id']
+            job_id = next(self._ids)
+            self._jobs[job_id] = {'id': job_id, 'kind': kind, 'state': 'queued', 'progress': {},
+                                  'created_at': self.clock(), 'started_at': None, 'finished_at': None,
+                                  'result': None, 'error': None}
+            self._prune()
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='job-runner', daemon=True)
+                self._worker.start()
+        self._queue.put((job_id, task, args, kwargs))
+        return job_id
+
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job['state'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(self._jobs) - self.keep)]:
+            del self._jobs[job_id]
+
+    def _update(self, job_id: int, **fields) -> None:
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def _run(self) -> None:
+        while True:
+            job_id, task, args, kwargs = self._queue.get()
+
+            def progress(**fields):
+                with self._lock:
+                    self._jobs[job_id]['progress'].update(fields)
+
+            self._update(job_id, state='running', started_at=self.clock())
+            try:
+                result = task(progress, *args, **kwargs)
+                self._update(job_id, state='done', result=result, finished_at=self.clock())
+            except Exception as e:
+                print("Job failed:", traceback.format_exc(), file=sys.stderr)
+                self._update(job_id, state='failed', error=str(e), finished_at=self.clock())
+            finally:
+                self._queue.task_done()
+
+    def status(self, job_id: Optional[int] = None, kind: Optional[str] = None) -> Optional[Dict]:
+        """Returns a copy of a job, or the latest job of a kind, with its elapsed time and ETA."""
+        with self._lock:
+            if job_id is None:
+                jobs = [job for job in self._jobs.values() if kind is None or job['kind'] == kind]
+                job_id = jobs[-1]['id'] if jobs else None
+            if job_id not in self._jobs:
+                return None
+            job = dict(self._jobs[job_id], progress=dict(self._jobs[job_id]['progress']))
+
+        started, finished = job['started_at'], job['finished_at']
+        job['elapsed'] = ((finished or self.clock()) - started) if started else 0.0
+        done, remaining = job['progress'].get('done'), job['progress'].get('remaining')
+        job['eta'] = None
+        if job['state'] == 'running' and done and remaining is not None:
+            job['eta'] = job['elapsed'] / done * remaining
+        return job
+
+
+job_runner = JobRunner()
@@ -0,0 +1,161 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import polyline
+
+from services.activity_batch import ActivityBatch
+from services.activity_table import ActivityTable
+from services.density_pyramid import density_pyramid, bin_points, cell_centers, project, MAX_LEVEL
+from services.metrics import metrics
+from services.parallel_aggregation import SIMPLIFIERS, activity_point_counts, bin_activities, use_processes
+from services.point_accumulator import PointAccumulator, point_counts
+from services.simplify import level_for_tolerance
+
+# Simplification tolerance in metres per view, applied before points reach the browser.
+# Roughly one screen pixel at zoom 15, 0 ships full precision.
+VIEW_TOLERANCES = {
+    'index': 5.0,   # Density grid cell size
+    'time': 5.0,    # Douglas-Peucker per activity
+    'single': 5.0,  # Grid snapping per activity
+    'routes': 3.0,  # Douglas-Peucker per activity
+}
+
+SCALE = 1e5  # Points travel as integers at encoded polyline precision
+
+# Time steps of the time views, activities starting within one step share a frame
+BUCKETS = ('minute', 'day', 'week', 'month')
+
+
+def delta_encode(points: np.ndarray) -> List[int]:
+    """Encodes (N, 2) lat/lng points as a flat [dlat, dlng, ...] list of 1e5-scaled integer deltas."""
+    scaled = np.rint(np.asarray(points, dtype=np.float64).reshape(-1, 2) * SCALE).astype(np.int64)
+    deltas = np.diff(scaled, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+    return deltas.ravel().tolist()
+
+
+def bucket_times(epochs: np.ndarray, bucket: Optional[str] = None) -> List[int]:
+    """Returns the epoch milliseconds of the time step each start time falls in, minutes by default."""
+    bucket = bucket or 'minute'
+    if bucket not in BUCKETS:
+        raise ValueError(f"Unknown time bucket: {bucket}")
+    if bucket == 'minute':
+        steps = epochs.astype('datetime64[m]')
+    elif bucket == 'day':
+        steps = epochs.astype('datetime64[D]')
+    elif bucket == 'week':
+        # Weeks start on Monday, 1970-01-01 was a Thursday
+        days = epochs.astype('datetime64[D]')
+        steps = days - (days.astype(np.int64) + 3) % 7
+    else:
+        steps = epochs.astype('datetime64[M]')
+    return steps.astype('datetime64[ms]').astype(np.int64).tolist()
+
+
+def density_cells(batch: ActivityBatch, level: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns cell centers and point counts of the activities' density grid."""
+    activities = batch.activities
+    ids = (activities.column('id') if isinstance(activities, ActivityTable)
+           else np.array([activity['id'] for activity in activities], dtype=np.int64))
+    if density_pyramid.covers_exactly(ids):
+        keys, counts = density_pyramid.cells(level)
+    elif use_processes(batch.activities):
+        keys, counts = bin_activities(batch.activities, level)
+    else:
+        # A subset of the synced activities, bin just these
+        keys, counts = bin_points(project(batch.coords), level)
+    return cell_centers(keys, level), counts
+
+
+def heatmap_data(batch: ActivityBatch, tolerance: Optional[float] = None) -> Dict:
+    """Weighted density cells of the static heatmap."""
+    tolerance = VIEW_TOLERANCES['index'] if tolerance is None else tolerance
+    with metrics.stage('bin'):
+        centers, counts = density_cells(batch, level_for_tolerance(tolerance, MAX_LEVEL))
+    metrics.count('points', len(centers))
+    return {'points': delta_encode(centers), 'weights': counts.tolist()}
+
+
+def time_heatmap_data(batch: ActivityBatch, method: str, tolerance: float, bucket: Optional[str] = None) -> Dict:
+    """
+    Distinct points and per-frame count diffs of a time heatmap.
+
+    Routes are simplified with the ``method`` named in SIMPLIFIERS, in worker
+    processes for large batches.
+
+    Each distinct point is sent once and every frame only the counts it adds.
+    Activities starting in the same ``bucket`` (minute by default, or day, week,
+    month to cap the number of frames) share a frame.
+    """
+    # Store each activity's point counts once as a sparse delta
+    accumulator = PointAccumulator(precision=5)
+    with metrics.stage('accumulate'):
+        if use_processes(batch.activities):
+            activity_counts = activity_point_counts(batch.activities, method, tolerance, accumulator.scale)
+        else:
+            simplify = SIMPLIFIERS[method]
+            activity_counts = (point_counts(simplify(activity, tolerance), accumulator.scale)
+                               for activity in batch.activities)
+        for counts in activity_counts:
+            accumulator.add_counts(*counts)
+
+    frames, times = [], []
+    with metrics.stage('frames'):
+        for (indices, counts), time in zip(accumulator.deltas(), bucket_times(batch.epochs, bucket)):
+            diff = np.column_stack((indices, counts)).ravel().tolist()
+            if times and times[-1] == time:
+                frames[-1].extend(diff)
+            else:
+                frames.append(diff)
+                times.append(time)
+    points = accumulator.coordinates()
+    metrics.count('frames', len(frames))
+    metrics.count('points', len(points))
+    return {'points': delta_encode(points), 'frames': frames, 'times': times}
+
+
+def accumulated_heatmap_data(batch: ActivityBatch, tolerance: Optional[float] = None,
+                             bucket: Optional[str] = None) -> Dict:
+    """Time heatmap data of the timelapse view, which accumulates activities."""
+    return time_heatmap_data(batch, 'douglas_peucker', VIEW_TOLERANCES['time'] if tolerance is None else tolerance,
+                             bucket)
+
+
+def single_heatmap_data(batch: ActivityBatch, tolerance: Optional[float] = None,
+                        bucket: Optional[str] = None) -> Dict:
+    """Time heatmap data of the one-at-a-time view."""
+    return time_heatmap_data(batch, 'snap_to_grid', VIEW_TOLERANCES['single'] if tolerance is None else tolerance, bucket)
+
+
+def routes_data(batch: ActivityBatch, tolerance: Optional[float] = None) -> Dict:
+    """Simplified routes as encoded polylines, grouped by start minute."""
+    tolerance = VIEW_TOLERANCES['routes'] if tolerance is None else tolerance
+    frames, times, points = [], [], 0
+    with metrics.stage('frames'):
+        for i, time in enumerate(bucket_times(batch.epochs)):
+            route = batch.simplified(i, tolerance)
+            points += len(route)
+            line = polyline.encode(route.tolist())
+            if times and times[-1] == time:
+                frames[-1].append(line)
+            else:
+                frames.append([line])
+                times.append(time)
+    metrics.count('frames', len(frames))
+    metrics.count('points', points)
+    return {'times': times, 'frames': frames}
+
+
+# Data builder of each view with client-loaded geometry, called with an ActivityBatch,
+# the tolerance and the view's DATA_OPTIONS
+VIEW_DATA = {
+    'index': heatmap_data,
+    'time': accumulated_heatmap_data,
+    'single': single_heatmap_data,
+    'routes': routes_data,
+}
+
+# Optional keyword arguments each data builder accepts
+DATA_OPTIONS = {
+    'time': ('bucket',),
+    'single': ('bucket',),
+}
@@ -1,12 +1,17 @@
-from datetime import datetime, timezone
-from collections import defaultdict
-from typing import List, Dict, Tuple, Any
+from datetime import datetime
+from typing import List, Dict, Tuple, Any, Optional
 
 import folium
-import polyline
 from folium import plugins
 from bottle import template
 from services.polylinewithtime_plugin import PolylineWithTime
+from services.heatmapwithtime_plugin import HeatMapWithTimeDiff
+from services.heatmap_plugin import DensityHeatMap
+from services.activity_batch import ActivityBatch
+from services.metrics import metrics
+from services.map_data import heatmap_data, accumulated_heatmap_data, single_heatmap_data, routes_data
+
+TILE_URL = '/heatmap/tiles/{z}/{x}/{y}.png'
 
 LEGEND_HTML = '''
 <div style="position: fixed; top: 10px; left: 50px; width: 250px; z-index: 9999;
@@ -47,154 +52,125 @@ def add_map_controls(map_obj: folium.Map, activities: List[Dict], start_date: da
     folium.LayerControl(position='topright').add_to(map_obj)
 
 
-def generate_heatmap(activities: List[Dict]) -> str:
-    """Generates a static heatmap visualization of activities."""
-    if not activities:
-        return "No activities found."
+def load_batch(activities: List[Dict]) -> ActivityBatch:
+    """Builds the ActivityBatch of a map, counting the activities it covers."""
+    with metrics.stage('batch'):
+        batch = ActivityBatch(activities)
+    metrics.count('activities', len(batch))
+    return batch
+
 
-    map_obj = create_base_map(
-        [activities[0]['start_lat'], activities[0]['start_lng']])
+def render_document(map_obj: folium.Map) -> str:
+    """Renders a map to its HTML document."""
+    with metrics.stage('render'):
+        return map_obj.get_root().render()
 
-    # Extract points and date range
-    points = []
-    start_date = end_date = datetime.strptime(
-        activities[0]['start_date'][:10], '%Y-%m-%d')
 
-    for activity in activities:
-        if activity.get("map"):
-            points.extend(polyline.decode(activity["map"]))
-            activity_date = datetime.strptime(
-                activity['start_date'][:10], '%Y-%m-%d')
-            start_date = min(start_date, activity_date)
-            end_date = max(end_date, activity_date)
+def generate_heatmap(activities: List[Dict], tolerance: Optional[float] = None,
+                     data_url: Optional[str] = None) -> str:
+    """Generates a static heatmap visualization of activities.
+
+    With a ``data_url`` the browser loads the points from it, otherwise they are inlined.
+    """
+    batch = load_batch(activities)
+    if not len(batch):
+        return "No activities found."
+
+    with metrics.stage('data'):
+        data = data_url or heatmap_data(batch, tolerance)
 
-    if points:
-        plugins.HeatMap(points, name='Heatmap', control=True,
-                        radius=6, blur=2, scaleRadius=True).add_to(map_obj)
+    with metrics.stage('folium'):
+        map_obj = create_base_map(batch.center())
+
+        DensityHeatMap(data, name='Heatmap', control=True,
+                       radius=6, blur=2, scale_radius=True).add_to(map_obj)
 
         # Fit map bounds to points
-        bounds = [[min(p[0] for p in points), min(p[1] for p in points)],
-                  [max(p[0] for p in points), max(p[1] for p in points)]]
-        map_obj.fit_bounds(bounds)
+        map_obj.fit_bounds(batch.bounds())
+
+        add_map_controls(map_obj, batch.activities, *batch.date_range())
+    return render_document(map_obj)
+
+
+def generate_tile_heatmap(activities: List[Dict], tile_version: Optional[int] = None) -> str:
+    """Generates a heatmap whose density tiles are rendered server-side."""
+    # The tiles carry the geometry, the stored route summaries place the map
+    batch = load_batch(activities)
+    if not len(batch):
+        return "No activities found."
 
-    add_map_controls(map_obj, activities, start_date, end_date)
-    return map_obj._repr_html_()
+    with metrics.stage('folium'):
+        map_obj = create_base_map(batch.center())
 
+        # Versioned tile URLs can be cached by the browser until the next sync
+        tiles = TILE_URL if tile_version is None else f"{TILE_URL}?v={tile_version}"
+        folium.TileLayer(tiles=tiles, attr='Strava activities', name='Heatmap',
+                         overlay=True, control=True, show=True).add_to(map_obj)
+        map_obj.fit_bounds(batch.bounds())
 
-def generate_heatmap_one_ata_time(activities: List[Dict]) -> str:
+        add_map_controls(map_obj, batch.activities, *batch.date_range())
+    return render_document(map_obj)
+
+
+def generate_heatmap_one_ata_time(activities: List[Dict], tolerance: Optional[float] = None,
+                                  data_url: Optional[str] = None, bucket: Optional[str] = None) -> str:
     """Generates a map visualization showing one activity at a time as a heatmap."""
-    if not activities:
+    batch = load_batch(activities)
+    if not len(batch):
         return "No activities found."
 
-    activities.sort(key=lambda x: x["start_date"])
-    start_date = end_date = datetime.strptime(
-        activities[0]['start_date'][:10], '%Y-%m-%d')
-    map_obj = create_base_map(
-        [activities[0]['start_lat'], activities[0]['start_lng']])
-
-    heatmap_data = []
-    time_labels = []
-
-    for activity in activities:
-        if activity.get("map"):
-            points = polyline.decode(activity["map"])
-            start_time = datetime.fromisoformat(
-                activity["start_date"].replace("Z", "+00:00"))
-            time_labels.append(start_time.strftime("%Y-%m-%d %H:%M"))
-            activity_date = datetime.strptime(
-                activity['start_date'][:10], '%Y-%m-%d')
-            start_date = min(start_date, activity_date)
-            end_date = max(end_date, activity_date)
-            heatmap_data.append([[lat, lon] for lat, lon in points])
-
-    plugins.HeatMapWithTime(
-        heatmap_data, index=time_labels, position='topleft', auto_play=True,
-        max_opacity=0.8, min_opacity=0.3, radius=5, name='Heatmap'
-    ).add_to(map_obj)
-
-    add_map_controls(map_obj, activities, start_date, end_date)
-    return map_obj._repr_html_()
-
-
-def generate_heatmap_with_time(activities: List[Dict]) -> str:
+    with metrics.stage('data'):
+        data = data_url or single_heatmap_data(batch, tolerance, bucket)
+
+    with metrics.stage('folium'):
+        map_obj = create_base_map(batch.start())
+
+        HeatMapWithTimeDiff(
+            data, cumulative=False,
+            auto_play=True, position='topleft', min_opacity=0.3, radius=5, name='Heatmap'
+        ).add_to(map_obj)
+
+        add_map_controls(map_obj, batch.activities, *batch.date_range())
+    return render_document(map_obj)
+
+
+def generate_heatmap_with_time(activities: List[Dict], tolerance: Optional[float] = None,
+                               data_url: Optional[str] = None, bucket: Optional[str] = None) -> str:
     """Generates a time-based heatmap visualization with accumulated points."""
-    if not activities:
+    batch = load_batch(activities)
+    if not len(batch):
         return "No activities found."
 
-    activities.sort(key=lambda x: x["start_date"])
-    point_freq = defaultdict(lambda: [0] * len(activities))
-    time_labels = []
-    start_date = end_date = datetime.strptime(
-        activities[0]['start_date'][:10], '%Y-%m-%d')
-
-    # Process activities and build frequency map
-    for timestep, activity in enumerate(activities):
-        if activity.get("map"):
-            points = polyline.decode(activity["map"])
-            activity_date = datetime.strptime(
-                activity['start_date'][:10], '%Y-%m-%d')
-            start_date = min(start_date, activity_date)
-            end_date = max(end_date, activity_date)
-
-            for lat, lng in points:
-                point_key = (round(lat, 5), round(lng, 5))
-                for t in range(timestep, len(activities)):
-                    point_freq[point_key][t] += 1
-
-            time_labels.append(datetime.fromisoformat(activity["start_date"].replace("Z", "+00:00"))
-                               .strftime("%Y-%m-%d %H:%M"))
-
-    # Generate heatmap data
-    all_points = list(point_freq.keys())
-    heatmap_data = [
-        [[lat, lng, point_freq[(lat, lng)][t]]
-         for lat, lng in all_points if point_freq[(lat, lng)][t] > 0]
-        for t in range(len(activities))
-    ]
+    with metrics.stage('data'):
+        data = data_url or accumulated_heatmap_data(batch, tolerance, bucket)
 
     # Create and configure map
-    map_center = [sum(lat for lat, _ in all_points) / len(all_points),
-                  sum(lng for _, lng in all_points) / len(all_points)]
-    map_obj = create_base_map(map_center)
+    with metrics.stage('folium'):
+        map_obj = create_base_map(batch.center())
 
-    plugins.HeatMapWithTime(
-        heatmap_data, index=time_labels, auto_play=True, position='topleft',
-        max_opacity=0.8, min_opacity=0.3, radius=5, name='Heatmap'
-    ).add_to(map_obj)
+        HeatMapWithTimeDiff(
+            data, cumulative=True,
+            auto_play=True, position='topleft', min_opacity=0.3, radius=5, name='Heatmap'
+        ).add_to(map_obj)
 
-    add_map_controls(map_obj, activities, start_date, end_date)
-    return map_obj._repr_html_()
+        add_map_controls(map_obj, batch.activities, *batch.date_range())
+    return render_document(map_obj)
 
 
-def generate_routes_map(activities: List[Dict]) -> str:
-    """Generates a map with polylines showing activity routes over time."""
-    if not activities:
+def generate_routes_map(activities: List[Dict], tolerance: Optional[float] = None,
+                        data_url: Optional[str] = None, cumulative: bool = False) -> str:
+    """Generates a map with polylines showing activity routes over time, optionally accumulating them."""
+    batch = load_batch(activities)
+    if not len(batch):
         return "No activities found."
 
-    map_obj = create_base_map(
-        [activities[0]['start_lat'], activities[0]['start_lng']])
-    start_date = end_date = datetime.strptime(
-        activities[0]['start_date'][:10], '%Y-%m-%d')
-
-    polylines = []
-    for activity in activities:
-        if activity.get("map"):
-            date = datetime.fromisoformat(activity["start_date"])
-            date = date if date.tzinfo else date.replace(tzinfo=timezone.utc)
-            activity_date = datetime.strptime(
-                activity['start_date'][:10], '%Y-%m-%d')
-            start_date = min(start_date, activity_date)
-            end_date = max(end_date, activity_date)
-
-            polylines.append({
-                "coords": polyline.decode(activity["map"]),
-                "time": date.strftime("%Y-%m-%d %H:%M")
-            })
-
-    polylines.sort(key=lambda x: x["time"])
-    available_times = sorted(set(p["time"] for p in polylines))
-
-    PolylineWithTime(polylines, available_times, control=False).add_to(map_obj)
-    add_map_controls(map_obj, activities, start_date, end_date)
-
-    return map_obj._repr_html_()
+    with metrics.stage('data'):
+        data = data_url or routes_data(batch, tolerance)
+
+    with metrics.stage('folium'):
+        map_obj = create_base_map(batch.start())
+
+        PolylineWithTime(data, cumulative=cumulative, control=False).add_to(map_obj)
+        add_map_controls(map_obj, batch.activities, *batch.date_range())
+
+    return render_document(map_obj)
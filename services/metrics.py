@@ -0,0 +1,262 @@
+import cProfile
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List
+
+# Upper bounds in seconds of the request duration histogram
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Route parameters kept in the route label, any other (e.g. tile coordinates) would make a label per URL
+LABEL_PARAMS = ('controller', 'action', 'view')
+# Descriptions of the work counters, others are described by name
+COUNTER_HELP = {
+    'activities': 'Activities in the maps and data built.',
+    'points': 'Points sent to browsers, after simplification and binning.',
+    'frames': 'Frames of the time views sent.',
+}
+ROUTE_PARAM = re.compile(r'<([a-zA-Z_][a-zA-Z_0-9]*)(?::[^>]*)?>')
+
+# Requests to profile: 'off', 'all' or those whose path starts with a prefix, e.g. '/heatmap/data'
+PROFILE_MODE = os.getenv('HEATMAP_PROFILE', 'off')
+PROFILE_DIR = os.getenv('HEATMAP_PROFILE_DIR', 'data/profiles')
+# Profiles kept, the oldest are removed beyond this
+PROFILE_KEEP = int(os.getenv('HEATMAP_PROFILE_KEEP', 20))
+
+
+class Metrics:
+    """
+    Process-wide request timings and work counters.
+
+    ``stage`` times a step of handling a request, e.g. decoding or rendering,
+    and adds it to the totals of that stage as well as to the timings of the
+    request running on the current thread, which ``MetricsMiddleware`` sends
+    back in a Server-Timing header. ``render`` writes everything in the
+    Prometheus text format for /metrics.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.requests: Dict[tuple, int] = defaultdict(int)  # (route, method, status) -> count
+        self.durations: Dict[str, List[float]] = {}  # route -> bucket counts, then the sum
+        self.response_bytes: Dict[str, int] = defaultdict(int)
+        self.stage_seconds: Dict[str, float] = defaultdict(float)
+        self.stage_calls: Dict[str, int] = defaultdict(int)
+        self.counters: Dict[str, int] = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name: str):
+        started = self.clock()
+        try:
+            yield
+        finally:
+            self.record_stage(name, self.clock() - started)
+
+    def record_stage(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.stage_seconds[name] += seconds
+            self.stage_calls[name] += 1
+        timings = getattr(self._local, 'timings', None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + seconds
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += int(amount)
+
+    def begin_request(self) -> Dict[str, float]:
+        """Starts collecting the stage timings of the request on this thread."""
+        self._local.timings = {}
+        return self._local.timings
+
+    def end_request(self, route: str, method: str, status: str, seconds: float, size: int) -> None:
+        self._local.timings = None
+        with self._lock:
+            self.requests[(route, method, status)] += 1
+            histogram = self.durations.setdefault(route, [0] * (len(DURATION_BUCKETS) + 1) + [0.0])
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[len(DURATION_BUCKETS)] += 1
+            histogram[-1] += seconds
+            self.response_bytes[route] += size
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            lines = ['# HELP heatmap_http_requests_total Requests handled by route, method and status.',
+                     '# TYPE heatmap_http_requests_total counter']
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'heatmap_http_requests_total{labels(route=route, method=method, status=status)} '
+                             f'{count}')
+
+            lines += ['# HELP heatmap_http_request_duration_seconds Time to handle and send a response.',
+                      '# TYPE heatmap_http_request_duration_seconds histogram']
+            for route, histogram in sorted(self.durations.items()):
+                for bound, count in zip(DURATION_BUCKETS, histogram):
+                    lines.append(f'heatmap_http_request_duration_seconds_bucket{labels(route=route, le=bound)} '
+                                 f'{count}')
+                total = histogram[len(DURATION_BUCKETS)]
+                lines += [f'heatmap_http_request_duration_seconds_bucket{labels(route=route, le="+Inf")} {total}',
+                          f'heatmap_http_request_duration_seconds_sum{labels(route=route)} {histogram[-1]:.6f}',
+                          f'heatmap_http_request_duration_seconds_count{labels(route=route)} {total}']
+
+            lines += ['# HELP heatmap_http_response_bytes_total Response body bytes sent, as encoded.',
+                      '# TYPE heatmap_http_response_bytes_total counter']
+            for route, size in sorted(self.response_bytes.items()):
+                lines.append(f'heatmap_http_response_bytes_total{labels(route=route)} {size}')
+
+            lines += ['# HELP heatmap_stage_duration_seconds Time spent in each stage of building a response.',
+                      '# TYPE heatmap_stage_duration_seconds summary']
+            for name in sorted(self.stage_seconds):
+                lines += [f'heatmap_stage_duration_seconds_sum{labels(stage=name)} {self.stage_seconds[name]:.6f}',
+                          f'heatmap_stage_duration_seconds_count{labels(stage=name)} {self.stage_calls[name]}']
+
+            for name in sorted(self.counters):
+                help_text = COUNTER_HELP.get(name, f'{name.capitalize()} processed by the map views.')
+                lines += [f'# HELP heatmap_{name}_total {help_text}',
+                          f'# TYPE heatmap_{name}_total counter',
+                          f'heatmap_{name}_total {self.counters[name]}']
+        return '\n'.join(lines) + '\n'
+
+
+def labels(**values) -> str:
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for value in values.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(values, escaped)) + '}'
+
+
+def server_timing(timings: Dict[str, float], total: float) -> str:
+    """Formats stage timings as a Server-Timing header value, durations in milliseconds."""
+    entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in timings.items()]
+    return ', '.join(entries + [f'total;dur={total * 1000:.1f}'])
+
+
+def route_label(environ: Dict, status: str) -> str:
+    """Names the route that handled a request, e.g. /heatmap/frame/time or /heatmap/tiles/<z>/<x>/<y>.png."""
+    route = environ.get('bottle.route')
+    if route is None or status == '404':
+        # Unknown paths would otherwise each get a label of their own
+        return 'not_found'
+    args = environ.get('route.url_args', {})
+    if route.rule in ('/', '/<controller>', '/<controller>/'):
+        # Defaulted parameters name the same page as the full path
+        return f"/{args.get('controller', 'home')}/{args.get('action', 'index')}"
+    return ROUTE_PARAM.sub(lambda match: str(args[match.group(1)]) if match.group(1) in LABEL_PARAMS
+                           and match.group(1) in args else f'<{match.group(1)}>', route.rule)
+
+
+class _Body:
+    """Response body that counts the bytes sent and reports when the server closes it."""
+
+    def __init__(self, body: Iterable[bytes], done: Callable[[int], None]):
+        self.body = body
+        self.done = done
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            close = getattr(self.body, 'close', None)
+            if close:
+                close()
+        finally:
+            self.done(self.size)
+
+
+class MetricsMiddleware:
+    """
+    WSGI middleware recording each request in ``metrics``.
+
+    Adds a Server-Timing header with the stages the request went through and
+    its total time up to the headers. Requests are profiled with cProfile
+    when the server is started with ``profile_mode`` 'all', or a path prefix
+    the request's path starts with. The stats are written to ``profile_dir``,
+    which keeps the newest ``profile_keep``, and named by the id in an
+    X-Profile header.
+    """
+
+    def __init__(self, app: Callable, metrics: 'Metrics', profile_mode: str = PROFILE_MODE,
+                 profile_dir: str = PROFILE_DIR, profile_keep: int = PROFILE_KEEP):
+        self.app = app
+        self.metrics = metrics
+        self.profile_mode = profile_mode
+        self.profile_dir = profile_dir
+        self.profile_keep = profile_keep
+
+    def profiling(self, environ: Dict) -> bool:
+        if self.profile_mode == 'all':
+            return True
+        return self.profile_mode.startswith('/') and environ.get('PATH_INFO', '').startswith(self.profile_mode)
+
+    def profile_id(self, environ: Dict) -> str:
+        path = re.sub(r'[^A-Za-z0-9]+', '_', environ.get('PATH_INFO', '')).strip('_') or 'root'
+        return f"{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 10**9:09d}-{path[:80]}"
+
+    def __call__(self, environ: Dict, start_response: Callable):
+        metrics = self.metrics
+        started = metrics.clock()
+        timings = metrics.begin_request()
+        status = ['500']
+        profiler = start_profiler() if self.profiling(environ) else None
+        profile_id = self.profile_id(environ) if profiler else None
+
+        def timed_start_response(status_line: str, headers: List, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            headers.append(('Server-Timing', server_timing(timings, metrics.clock() - started)))
+            if profile_id:
+                headers.append(('X-Profile', profile_id))
+            return start_response(status_line, headers, exc_info)
+
+        def done(size: int) -> None:
+            metrics.end_request(route_label(environ, status[0]), environ.get('REQUEST_METHOD', 'GET'), status[0],
+                                metrics.clock() - started, size)
+
+        try:
+            body = self.app(environ, timed_start_response)
+        except BaseException:
+            done(0)
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+                dump_profile(profiler, os.path.join(self.profile_dir, f"{profile_id}.prof"), self.profile_keep)
+        return _Body(body, done)
+
+
+def start_profiler():
+    """Returns an enabled profiler, or None while another request is being profiled on Python 3.12+."""
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
+
+
+def dump_profile(profiler: cProfile.Profile, profile_file: str, keep: int = PROFILE_KEEP) -> None:
+    """
+    Writes pstats data, e.g. for ``python -m pstats``, snakeviz or flameprof to
+    draw a flame graph, and removes all but the newest ``keep`` profiles.
+    """
+    profile_dir = os.path.dirname(profile_file) or '.'
+    os.makedirs(profile_dir, exist_ok=True)
+    profiler.dump_stats(profile_file)
+    # Ids start with the time, so they sort oldest first
+    profiles = sorted(name for name in os.listdir(profile_dir) if name.endswith('.prof'))
+    for name in profiles[:max(0, len(profiles) - keep)]:
+        try:
+            os.remove(os.path.join(profile_dir, name))
+        except OSError:
+            pass
+
+
+metrics = Metrics()
@@ -0,0 +1,141 @@
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from services.density_pyramid import aggregate, bin_points, project
+from services.activity_table import ActivityTable
+from services.geometry_store import GeometryStore, geometry_store, simplified, simplified_stores
+from services.point_accumulator import point_counts
+from services.simplify import douglas_peucker, snap_to_grid
+
+# Worker processes for aggregating large histories, 1 keeps everything in the request thread. Off by default:
+# measure with ``python -m benchmarks.run --cases time_data --workers N`` that the pool wins on your machine first.
+HEATMAP_WORKERS = int(os.getenv('HEATMAP_WORKERS', 1))
+# Below this many route points the process round trip costs more than it saves
+PARALLEL_MIN_POINTS = int(os.getenv('HEATMAP_PARALLEL_MIN_POINTS', 1_000_000))
+
+# Per-activity simplification of the time views, precomputed where possible
+SIMPLIFIERS: Dict[str, Callable[[Dict, float], np.ndarray]] = {
+    'douglas_peucker': simplified,
+    'snap_to_grid': lambda activity, tolerance: snap_to_grid(geometry_store.get(activity), tolerance),
+}
+# The same applied to points read from the full precision store, by name so workers can look them up
+POINT_SIMPLIFIERS: Dict[str, Callable[[np.ndarray, float], np.ndarray]] = {
+    'douglas_peucker': douglas_peucker,
+    'snap_to_grid': snap_to_grid,
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Forking a threaded server could copy held locks into the children
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(HEATMAP_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def use_processes(activities: Sequence[Dict]) -> bool:
+    """Whether a set of activities is large enough to aggregate in worker processes."""
+    if HEATMAP_WORKERS < 2:
+        return False
+    if isinstance(activities, ActivityTable):
+        points = int(activities.column('vertex_count').sum())
+    else:
+        points = sum(activity.get('vertex_count') or 0 for activity in activities)
+    return points >= PARALLEL_MIN_POINTS
+
+
+def _store(tolerance: Optional[float]) -> GeometryStore:
+    return geometry_store if tolerance is None else simplified_stores[tolerance]
+
+
+def _source(activities: Sequence[Dict], method: Optional[str],
+            tolerance: float) -> Tuple[Optional[float], Optional[str], np.ndarray]:
+    """
+    Returns where workers read the activities' routes from: the tolerance of
+    the simplified store or None for the full one, the simplification still
+    to apply, and each activity's span in that store.
+    """
+    if method == 'douglas_peucker' and float(tolerance) in simplified_stores:
+        spans = simplified_stores[float(tolerance)].spans(activities)
+        if (spans[:, 0] >= 0).all():
+            return float(tolerance), None, spans
+    geometry_store.add(activities)
+    return None, method, geometry_store.spans(activities)
+
+
+def _map_chunks(task: Callable, activities: Sequence[Dict], method: Optional[str], tolerance: float, *args) -> List:
+    """
+    Runs ``task(store, spans, simplify, tolerance, *args)`` over chunks of
+    activities in the pool, results in chunk order. Workers are only sent
+    where each route is in the memory-mapped geometry store and read the
+    points themselves.
+    """
+    store, simplify, spans = _source(activities, method, tolerance)
+    size = max(1, -(-len(spans) // (HEATMAP_WORKERS * 4)))
+    chunks = [spans[i:i + size] for i in range(0, len(spans), size)]
+    calls = [(store, chunk, simplify, tolerance, *args) for chunk in chunks]
+    try:
+        pool = _get_pool()
+        return list(pool.map(task, *zip(*calls)))
+    except (BrokenProcessPool, OSError) as e:
+        print(f"Heatmap workers unavailable, aggregating in-process: {e}", file=sys.stderr)
+        _reset_pool()
+        return [task(*call) for call in calls]
+
+
+def _read(store: Optional[float], spans: np.ndarray, simplify: Optional[str], tolerance: float) -> Iterator[np.ndarray]:
+    source = _store(store)
+    for offset, count in spans.tolist():
+        points = source.read(offset, count) if offset >= 0 else np.empty((0, 2), dtype=np.float64)
+        yield POINT_SIMPLIFIERS[simplify](points, tolerance) if simplify else points
+
+
+def _bin_chunk(store: Optional[float], spans: np.ndarray, simplify: Optional[str], tolerance: float,
+               level: int) -> Tuple[np.ndarray, np.ndarray]:
+    points = list(_read(store, spans, simplify, tolerance))
+    return bin_points(project(np.concatenate(points) if points else np.empty((0, 2))), level)
+
+
+def bin_activities(activities: Sequence[Dict], level: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Bins the routes of activities into sparse (keys, counts) cells, one chunk per worker task."""
+    parts = _map_chunks(_bin_chunk, activities, None, 0.0, level)
+    return aggregate(np.concatenate([keys for keys, _ in parts]), np.concatenate([counts for _, counts in parts]))
+
+
+def _count_chunk(store: Optional[float], spans: np.ndarray, simplify: Optional[str], tolerance: float,
+                 scale: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Returned as a few flat arrays, which pickle far faster than a tuple of small arrays per activity
+    parts = [point_counts(points, scale) for points in _read(store, spans, simplify, tolerance)]
+    lengths = np.array([len(keys) for keys, _, _ in parts], dtype=np.int64)
+    if not parts:
+        return lengths, np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty((0, 2), dtype=np.int64)
+    return (lengths, np.concatenate([keys for keys, _, _ in parts]), np.concatenate([counts for _, counts, _ in parts]),
+            np.concatenate([quantised for _, _, quantised in parts]))
+
+
+def activity_point_counts(activities: Sequence[Dict], method: str, tolerance: float,
+                          scale: int) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """Simplifies each activity's route and counts its distinct points, see ``point_counts``."""
+    for lengths, keys, counts, quantised in _map_chunks(_count_chunk, activities, method, tolerance, scale):
+        bounds = np.cumsum(lengths)[:-1]
+        yield from zip(np.split(keys, bounds), np.split(counts, bounds), np.split(quantised, bounds))
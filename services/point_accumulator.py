@@ -0,0 +1,63 @@
+from typing import Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+
+def point_counts(points: Sequence[Sequence[float]], scale: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Counts an activity's distinct rounded points.
+
+    Returns the keys of the distinct points in first-seen order, how often each
+    occurs and their ``scale``-quantised (lat, lng).
+    """
+    coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    quantised = np.rint(coords * scale).astype(np.int64)
+    keys = (quantised[:, 0] << 32) | (quantised[:, 1] & 0xFFFFFFFF)
+
+    unique_keys, first_seen, counts = np.unique(keys, return_index=True, return_counts=True)
+    order = np.argsort(first_seen, kind='stable')
+    return unique_keys[order], counts[order].astype(np.int64), quantised[first_seen[order]]
+
+
+class PointAccumulator:
+    """
+    Accumulates rounded point frequencies activity by activity.
+
+    Every activity is stored once as a sparse delta: the indices of the distinct
+    points it touches and how often it touches each of them. Points are numbered
+    in first-seen order, so the points present after timestep ``t`` are a
+    prefix of ``coordinates()``. Cumulative state is rebuilt by adding deltas
+    into one running counts array, which keeps work and memory proportional to
+    the number of points rather than points x activities.
+    """
+
+    def __init__(self, precision: int = 5):
+        self.scale = 10 ** precision
+        self._index = {}
+        self._points: List[np.ndarray] = []
+        self._deltas: List[Tuple[np.ndarray, np.ndarray]] = []
+
+    def __len__(self) -> int:
+        return len(self._deltas)
+
+    def add_counts(self, keys: np.ndarray, counts: np.ndarray, quantised: np.ndarray) -> None:
+        """Adds one activity's ``point_counts`` as the next timestep."""
+        known = len(self._index)
+        indices = np.fromiter(
+            (self._index.setdefault(key, len(self._index)) for key in keys.tolist()),
+            dtype=np.int64, count=len(keys))
+        new_points = indices >= known
+        if new_points.any():
+            self._points.append(quantised[new_points])
+
+        self._deltas.append((indices, counts))
+
+    def coordinates(self) -> np.ndarray:
+        """Returns all distinct points as an (N, 2) float array in first-seen order."""
+        if not self._points:
+            return np.empty((0, 2), dtype=np.float64)
+        return np.concatenate(self._points) / self.scale
+
+    def deltas(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yields the (point indices, counts) each activity adds, in the order added."""
+        return iter(self._deltas)
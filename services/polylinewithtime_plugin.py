@@ -1,27 +1,55 @@
+import re
+
 from branca.element import Element, Figure
 from folium.elements import JSCSSMixin
 from folium.map import Layer
 from folium.template import Template
-import json
+from jinja2.utils import htmlsafe_json_dumps
+
+from services.heatmap_plugin import MAP_DATA_JS
+
+# Branca compiles the rendered script as a template again, so a "{{" inside an
+# encoded polyline must not reach it as a Jinja delimiter
+JINJA_DELIMITER = re.compile(r'\{(?=[{%#])')
+
+
+def script_json(data) -> str:
+    """Serialises data for a script block, HTML-safe and with Jinja delimiters escaped."""
+    return JINJA_DELIMITER.sub(r'\\u007b', str(htmlsafe_json_dumps(data)))
 
 
 class PolylineWithTime(JSCSSMixin, Layer):
     """
     A Folium plugin to display polylines on a map, updating them dynamically based on time.
+
+    Routes are given inline or as the URL of a JSON endpoint fetched after the
+    map renders, as encoded polyline strings decoded in the browser. They come
+    grouped into one frame per time step, so a time change is a lookup of the
+    frame for that time. Each frame's layers are built once and reused. In
+    cumulative mode earlier frames stay on the map and moving the slider only
+    adds or removes the frames in between.
     """
 
     _template = Template("""
         {% macro script(this, kwargs) %}
             var {{this.get_name()}} = L.layerGroup();
             
-            (function() {
+            MapData.load({{ this.data_json | safe }}).then(function(data) {
                 try {
-                    // Extract polylines and timestamps from Python
-                    const polylines = {{ this.polylines | tojson | safe }};
-                    const availableTimes = {{ this.available_times | tojson | safe }}.map(date => new Date(date).getTime());
-                    
+                    const times = data.times;
+                    const frames = data.frames;
+                    const cumulative = {{ this.cumulative | tojson }};
+
+                    // Frame lookup by timestamp and each frame's first route number for colouring
+                    const frameIndex = new Map(times.map((time, index) => [time, index]));
+                    const firstRoute = [];
+                    frames.reduce((count, frame, index) => (firstRoute[index] = count) + frame.length, 0);
+                    const frameLayers = new Array(frames.length);
+                    var current = -1;
+
                     // Get Folium-generated map object
                     var map = {{ this._parent.get_name() }};
+                    var group = {{this.get_name()}};
                     
                     // Store existing layers
                     var existingLayers = [];
@@ -33,15 +61,17 @@ class PolylineWithTime(JSCSSMixin, Layer):
                     if (!map.timeDimension) {
                         // Create time dimension instance
                         map.timeDimension = new L.TimeDimension({
-                            times: availableTimes,
-                            currentTime: availableTimes[0]
+                            times: times,
+                            currentTime: times[0]
                         });
                         
                         // Set up time control
                         var timeDimensionControl = new L.Control.TimeDimension({
                             loopButton: true,
                             timeSliderDragUpdate: true,
-                            displayDateFormat: 'YYYY-MM-DD HH:mm:ss',
+                            displayDateFormat: 'YYYY-MM-DD HH:mm',
+                            // Times are the activities' local clock times encoded as UTC
+                            timeZones: ['UTC'],
                             position: 'topleft'
                         });
                         map.addControl(timeDimensionControl);
@@ -54,38 +84,51 @@ class PolylineWithTime(JSCSSMixin, Layer):
                         });
                     }
 
+                    // Decodes a frame's routes the first time it is shown
+                    function layersOf(index) {
+                        if (!frameLayers[index]) {
+                            frameLayers[index] = frames[index].map((encoded, i) => L.polyline(MapData.decodePolyline(encoded), {
+                                color: `hsl(${(firstRoute[index] + i) * 60}, 70%, 50%)`,
+                                weight: 3
+                            }));
+                        }
+                        return frameLayers[index];
+                    }
+
+                    function showFrame(index, visible) {
+                        layersOf(index).forEach(line => visible ? group.addLayer(line) : group.removeLayer(line));
+                    }
+
                     // Function to update polylines based on selected time
-                    function updatePolylines(timestamp) {
-                        {{this.get_name()}}.clearLayers();
-                        const currentDate = new Date(timestamp);
-
-                        polylines.forEach((poly, index) => {
-                            const polyDate = new Date(poly.time);
-                            if (polyDate.getTime() === currentDate.getTime()) {
-                                const line = L.polyline(poly.coords, {
-                                    color: `hsl(${index * 60}, 70%, 50%)`,
-                                    weight: 3
-                                });
-                                {{this.get_name()}}.addLayer(line);
-                                map.fitBounds(line.getBounds());
-                            }
-                        });
+                    function updatePolylines(target) {
+                        if (cumulative) {
+                            while (current < target) showFrame(++current, true);
+                            while (current > target) showFrame(current--, false);
+                        } else {
+                            if (current >= 0) showFrame(current, false);
+                            showFrame(target, true);
+                            current = target;
+                            map.fitBounds(L.featureGroup(layersOf(target)).getBounds());
+                        }
                     }
 
                     // Update polylines when time changes
-                    map.timeDimension.on('timeload', function(data) {
-                        updatePolylines(map.timeDimension.getCurrentTime());
+                    map.timeDimension.on('timeload', function() {
+                        const index = frameIndex.get(map.timeDimension.getCurrentTime());
+                        if (index !== undefined) updatePolylines(index);
                     });
 
                     // Initial update
-                    updatePolylines(map.timeDimension.getCurrentTime());
+                    updatePolylines(0);
                     
-                    {{this.get_name()}}.addTo(map);
+                    group.addTo(map);
                     
                 } catch (error) {
                     console.error("Error in PolylineWithTime plugin:", error);
                 }
-            })();
+            }).catch(function(error) {
+                console.error("Error loading PolylineWithTime data:", error);
+            });
         {% endmacro %}
     """)
 
@@ -98,6 +141,7 @@ class PolylineWithTime(JSCSSMixin, Layer):
             "leaflet.timedimension.min.js",
             "https://cdn.jsdelivr.net/npm/leaflet-timedimension@1.1.1/dist/leaflet.timedimension.min.js",
         ),
+        MAP_DATA_JS,
     ]
 
     default_css = [
@@ -107,20 +151,20 @@ class PolylineWithTime(JSCSSMixin, Layer):
         )
     ]
 
-    def __init__(self, polylines, available_times, name=None, overlay=True, control=True, show=True):
+    def __init__(self, data, cumulative=False, name=None, overlay=True, control=True, show=True):
         """
-        :param polylines: A list of dictionaries containing 'coords' (list of lat/lon points) and 'time' (ISO 8601 timestamp).
-        :param available_times: A list of timestamps in ISO 8601 format representing available time steps.
+        :param data: A dict, or the URL returning it, with
+            'times': epoch milliseconds of each time step (local clock time as UTC), ascending and unique,
+            'frames': for each time step, the encoded polylines of the routes starting then.
+        :param cumulative: Keep earlier frames' routes on the map (True) or show each frame alone (False).
         """
         super().__init__(name=name, overlay=overlay, control=control, show=show)
         self._name = "PolylineWithTime"
-
-        # Ensure JSON serialization is valid
-        try:
-            self.polylines = json.loads(json.dumps(polylines))
-            self.available_times = json.loads(json.dumps(available_times))
-        except Exception as e:
-            raise ValueError(f"Error in JSON serialization: {e}")
+        if isinstance(data, dict) and len(data['frames']) != len(data['times']):
+            raise ValueError("Each frame needs exactly one time.")
+        self.data = data
+        self.data_json = script_json(data)
+        self.cumulative = cumulative
 
     def render(self, **kwargs):
         super().render(**kwargs)
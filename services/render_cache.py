@@ -0,0 +1,153 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Iterator, Optional, Tuple
+
+from services.dataset_manager import dataset_manager
+
+try:
+    import brotli
+except ImportError:  # Optional, pages are served gzip-compressed without it
+    brotli = None
+
+CHUNK_SIZE = 64 * 1024
+# Compression levels, past these a multi-megabyte page takes seconds longer for a few percent
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 5
+
+# Content-Encoding -> file suffix of the precompressed variant
+ENCODINGS = {'br': '.br', 'gzip': '.gz', 'identity': ''}
+
+
+class RenderCache:
+    """
+    Disk cache for rendered map documents and view data, streamed back in chunks.
+
+    Keys are derived from the view name, its parameters and a fingerprint of the
+    dataset, so a sync automatically produces new keys. The sync controller
+    also calls ``invalidate`` to drop entries that can no longer be hit, and at
+    most ``max_disk_entries`` pages are kept on disk, least recently used first out.
+
+    Each page is compressed once when it is stored (gzip, plus brotli when the
+    ``brotli`` package is installed), so serving a page is a chunked file read
+    in the encoding the client accepts and never holds the document in memory.
+    Only gzip is compressed before the first response, see ``put``.
+    """
+
+    def __init__(self, cache_dir: str = 'data/cache', max_disk_entries: int = 32):
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self._lock = threading.Lock()
+
+    def dataset_version(self) -> str:
+        """Fingerprints the dataset by the store version and the athlete file mtime."""
+        return dataset_manager.version()
+
+    def key(self, view: str, params: Optional[Dict] = None) -> str:
+        """Builds the cache key (also used as the ETag) for a view."""
+        payload = json.dumps([view, sorted((params or {}).items()), self.dataset_version()])
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str, encoding: str = 'identity') -> str:
+        return os.path.join(self.cache_dir, f"{key}.body{ENCODINGS[encoding]}")
+
+    def has(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def _write(self, key: str, variants: Dict[str, bytes]) -> None:
+        with self._lock:
+            # The identity file goes last, its presence marks the entry complete
+            for encoding in sorted(variants, key=lambda e: e == 'identity'):
+                tmp_path = self._path(key, encoding) + '.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(variants[encoding])
+                os.replace(tmp_path, self._path(key, encoding))
+            self._evict_disk()
+
+    def put(self, key: str, html: str) -> None:
+        """
+        Stores a page and its gzip variant, which the request that built it waits for.
+
+        The brotli variant is compressed on a background thread and served
+        from when it is ready, until then clients get gzip.
+        """
+        data = html.encode('utf-8')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._write(key, {'gzip': gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0), 'identity': data})
+        if brotli is not None:
+            threading.Thread(target=self._put_brotli, args=(key, data), name='brotli', daemon=True).start()
+
+    def _put_brotli(self, key: str, data: bytes) -> None:
+        compressed = brotli.compress(data, quality=BROTLI_QUALITY)
+        with self._lock:
+            if not self.has(key):
+                return  # Evicted or invalidated in the meantime
+            tmp_path = self._path(key, 'br') + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(compressed)
+            os.replace(tmp_path, self._path(key, 'br'))
+
+    def negotiate(self, key: str, accept_encoding: str) -> str:
+        """Picks the best stored encoding of a page the client accepts."""
+        accepted = {part.split(';')[0].strip().lower() for part in accept_encoding.split(',')}
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted and os.path.exists(self._path(key, encoding)):
+                return encoding
+        return 'identity'
+
+    def stream(self, key: str, encoding: str = 'identity') -> Tuple[int, Iterator[bytes]]:
+        """Returns the size of a stored page variant and an iterator over its chunks."""
+        path = self._path(key, encoding)
+        f = open(path, 'rb')
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+        size = os.fstat(f.fileno()).st_size
+
+        def chunks():
+            with f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        return
+                    yield chunk
+
+        return size, chunks()
+
+    def _evict_disk(self) -> None:
+        """Removes the least recently used pages beyond ``max_disk_entries``."""
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                 if name.endswith('.body')]
+        if len(paths) <= self.max_disk_entries:
+            return
+        for path in sorted(paths, key=self._mtime)[:len(paths) - self.max_disk_entries]:
+            for suffix in ENCODINGS.values():
+                try:
+                    os.remove(path + suffix)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _mtime(path: str) -> float:
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0.0
+
+    def invalidate(self) -> None:
+        """Drops every cached page from disk."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        with self._lock:
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(('.body', '.gz', '.br', '.html')):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        pass
+
+
+render_cache = RenderCache()
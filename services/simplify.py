@@ -0,0 +1,96 @@
+import math
+
+import numpy as np
+
+METRES_PER_DEGREE = 111_320.0
+EQUATOR_METRES = 40_075_016.686
+
+
+def to_metres(points: np.ndarray) -> np.ndarray:
+    """Projects (lat, lng) points to local equirectangular metres."""
+    scale = math.cos(math.radians(float(points[:, 0].mean())))
+    return np.column_stack((points[:, 1] * scale, points[:, 0])) * METRES_PER_DEGREE
+
+
+def douglas_peucker(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Simplifies a route with the Douglas-Peucker algorithm.
+
+    :param points: (N, 2) array of lat/lng points.
+    :param tolerance: Maximum distance in metres a dropped point may be from the simplified line.
+    """
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    return points[douglas_peucker_ranks(points, tolerance) > tolerance]
+
+
+def douglas_peucker_ranks(points: np.ndarray, min_tolerance: float) -> np.ndarray:
+    """
+    Ranks each point by the largest Douglas-Peucker tolerance that still keeps it.
+
+    ``points[ranks > tolerance]`` is the simplification at any tolerance of at
+    least ``min_tolerance``, so one pass serves several tolerances. A point is
+    split off a segment only if the split that made the segment happened too,
+    so its rank is its distance capped by its parent's. Endpoints rank infinite.
+
+    All segments of one depth of the recursion are split together in a few
+    array operations, so the Python loop runs once per depth, not per split.
+    """
+    count = len(points)
+    if count < 3:
+        return np.full(count, np.inf)
+    ranks = np.zeros(count)
+    ranks[[0, -1]] = np.inf
+
+    xy = to_metres(points)
+    firsts, lasts, ceilings = np.array([0]), np.array([count - 1]), np.array([np.inf])
+    while len(firsts):
+        interior = lasts - firsts - 1
+        splittable = interior > 0
+        firsts, lasts, ceilings, interior = (firsts[splittable], lasts[splittable],
+                                             ceilings[splittable], interior[splittable])
+        if not len(firsts):
+            break
+
+        # Every interior point of every segment in one flat array, segment by segment
+        segment_of = np.repeat(np.arange(len(firsts)), interior)
+        starts = np.cumsum(interior) - interior
+        indices = np.arange(len(segment_of)) - starts[segment_of] + firsts[segment_of] + 1
+        segments = xy[lasts] - xy[firsts]
+        offsets = xy[indices] - xy[firsts][segment_of]
+        lengths = np.hypot(segments[:, 0], segments[:, 1])[segment_of]
+        cross = np.abs(segments[segment_of, 0] * offsets[:, 1] - segments[segment_of, 1] * offsets[:, 0])
+        distances = np.where(lengths > 0, cross / np.where(lengths > 0, lengths, 1),
+                             np.hypot(offsets[:, 0], offsets[:, 1]))
+
+        # The farthest point of each segment, the first one on ties
+        farthest = np.maximum.reduceat(distances, starts)
+        candidates = np.flatnonzero(distances == farthest[segment_of])
+        _, first_candidate = np.unique(segment_of[candidates], return_index=True)
+        splits = indices[candidates[first_candidate]]
+
+        split = farthest > min_tolerance
+        split_ranks = np.minimum(farthest[split], ceilings[split])
+        ranks[splits[split]] = split_ranks
+        firsts = np.concatenate((firsts[split], splits[split]))
+        lasts = np.concatenate((splits[split], lasts[split]))
+        ceilings = np.concatenate((split_ranks, split_ranks))
+    return ranks
+
+
+def snap_to_grid(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Snaps points to a grid of roughly ``tolerance`` metres and drops duplicates, keeping order."""
+    if not len(points) or tolerance <= 0:
+        return points
+    step = tolerance / METRES_PER_DEGREE
+    snapped = np.round(points / step) * step
+    _, first = np.unique(snapped, axis=0, return_index=True)
+    return np.round(snapped[np.sort(first)], 5)
+
+
+def level_for_tolerance(tolerance: float, max_level: int) -> int:
+    """Returns the finest grid level whose cells are at least ``tolerance`` metres wide."""
+    if tolerance <= 0:
+        return max_level
+    level = int(math.floor(math.log2(EQUATOR_METRES / (256 * tolerance))))
+    return max(0, min(max_level, level))
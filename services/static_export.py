@@ -0,0 +1,209 @@
+"""
+Renders the map views to static files that any file server can serve.
+
+Each view becomes ``<view>.html``, with its geometry in ``data/<view>.json``
+and ``static/map_data.js`` next to it, or inlined into the document. A
+manifest records the inputs every file was built from, so exporting again
+only renders the views whose activities or options changed. See cli.py:
+
+    python cli.py export --out data/export
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+import services.parallel_aggregation as parallel_aggregation
+from services.activity_store import activity_store
+from services.activity_table import store_fingerprint
+from services.dataset_manager import dataset_manager
+from services.geometry_store import add_geometry
+from services.heatmap_plugin import MAP_DATA_JS
+from services.map_data import VIEW_DATA, DATA_OPTIONS
+from services.map_service import (generate_heatmap, generate_heatmap_with_time, generate_heatmap_one_ata_time,
+                                  generate_routes_map, load_batch)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXPORT_DIR = 'data/export'
+MANIFEST_FILE = 'manifest.json'
+# Bumped when the exported files change shape, so existing exports are rebuilt
+EXPORT_FORMAT = 1
+
+# Map document generator of each exported view, the server tiles view needs the tile server
+GENERATORS = {
+    'index': generate_heatmap,
+    'time': generate_heatmap_with_time,
+    'single': generate_heatmap_one_ata_time,
+    'routes': generate_routes_map,
+}
+
+
+class ExportOptions(NamedTuple):
+    """What the exported views show, the query parameters of the live views."""
+    filters: Dict = {}  # ActivityTable.filter arguments
+    tolerance: Optional[float] = None
+    bucket: Optional[str] = None  # Frames of the time views
+    cumulative: bool = False  # Routes accumulate rather than replace each other
+    inline: bool = False  # Geometry inside the documents rather than in data files
+
+
+def view_key(view: str, options: ExportOptions, fingerprint: str) -> str:
+    """Identifies everything a view's files are built from."""
+    payload = json.dumps([EXPORT_FORMAT, view, options._asdict(), fingerprint], sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def write_file(path: str, content) -> None:
+    """Writes a file in place of the old one at once, so a file server never serves half of it."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(content if isinstance(content, bytes) else content.encode('utf-8'))
+    os.replace(tmp_file, path)
+
+
+def render_view(out_dir: str, view: str, options: ExportOptions, key: str, activities=None) -> List[str]:
+    """
+    Writes one view's files to ``out_dir``. Returns their paths relative to it.
+
+    Runs in the export's worker processes, which read the activities from the
+    shared dataset unless they are given.
+    """
+    if activities is None:
+        activities = dataset_manager.activities()
+    if options.filters:
+        activities = activities.filter(**options.filters)
+    data_options = {'bucket': options.bucket} if options.bucket and 'bucket' in DATA_OPTIONS.get(view, ()) else {}
+    view_options = dict(data_options, cumulative=True) if view == 'routes' and options.cumulative else data_options
+
+    files, data_url = [], None
+    if not options.inline and len(activities):
+        data_file = f"data/{view}.json"
+        data = VIEW_DATA[view](load_batch(activities), options.tolerance, **data_options)
+        write_file(os.path.join(out_dir, data_file), json.dumps(data, separators=(',', ':')))
+        files.append(data_file)
+        # The URL changes with the data, so browsers never mix a new document with old data
+        data_url = f"{data_file}?v={key[:16]}"
+
+    html = GENERATORS[view](activities, tolerance=options.tolerance, data_url=data_url, **view_options)
+    # Relative, so the export can be served from any path
+    html = html.replace(f'src="{MAP_DATA_JS[1]}"', f'src="{MAP_DATA_JS[1].lstrip("/")}"')
+    html_file = f"{view}.html"
+    write_file(os.path.join(out_dir, html_file), html)
+    return [html_file] + files
+
+
+def read_manifest(out_dir: str) -> Dict:
+    try:
+        with open(os.path.join(out_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def is_current(out_dir: str, entry: Optional[Dict], key: str) -> bool:
+    """Whether a manifest entry was built from ``key`` and its files are all still there."""
+    return bool(entry) and entry.get('key') == key and all(
+        os.path.exists(os.path.join(out_dir, name)) for name in entry.get('files', []))
+
+
+def copy_assets(out_dir: str) -> None:
+    """Copies the scripts the documents load, unless the export already has the same ones."""
+    name = MAP_DATA_JS[1].lstrip('/')
+    source, target = os.path.join(ROOT, name), os.path.join(out_dir, name)
+    with open(source, 'rb') as f:
+        content = f.read()
+    try:
+        with open(target, 'rb') as f:
+            if f.read() == content:
+                return
+    except OSError:
+        pass
+    write_file(target, content)
+
+
+def _init_worker() -> None:
+    # The views already run in parallel, each renders in its own process only
+    parallel_aggregation.HEATMAP_WORKERS = 1
+
+
+def export(out_dir: str = EXPORT_DIR, views: Optional[Iterable[str]] = None,
+           options: ExportOptions = ExportOptions(), jobs: int = 1, force: bool = False,
+           log: Callable[[str], None] = print) -> Dict[str, str]:
+    """
+    Exports the map views to ``out_dir``, rendering up to ``jobs`` views at a
+    time in worker processes once the history is large enough to be worth it.
+
+    A view is skipped when the manifest shows its files were built from the
+    same activities and options and they still exist, unless ``force`` is set.
+    Returns each view's outcome: 'built', 'unchanged' or 'failed'.
+    """
+    views = list(views or GENERATORS)
+    unknown = [view for view in views if view not in GENERATORS]
+    if unknown:
+        raise ValueError(f"Unknown views: {', '.join(unknown)}, choose from {', '.join(GENERATORS)}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    copy_assets(out_dir)
+    manifest = read_manifest(out_dir)
+    activities = dataset_manager.activities()
+    fingerprint = store_fingerprint(activity_store)
+    keys = {view: view_key(view, options, fingerprint) for view in views}
+    outcomes = {view: 'unchanged' for view in views
+                if not force and is_current(out_dir, manifest.get(view), keys[view])}
+    stale = [view for view in views if view not in outcomes]
+    if not stale:
+        return outcomes
+
+    # Decoded once here, the workers read the cached routes
+    add_geometry(activities)
+
+    def finished(view: str, files: List[str], seconds: float) -> None:
+        old_files = set(manifest.get(view, {}).get('files', [])) - set(files)
+        for name in old_files:
+            # e.g. the data file of a view that is now inlined
+            if os.path.exists(os.path.join(out_dir, name)):
+                os.remove(os.path.join(out_dir, name))
+        manifest[view] = {'key': keys[view], 'files': files}
+        # Saved after every view, so an interrupted export keeps what it built
+        write_file(os.path.join(out_dir, MANIFEST_FILE), json.dumps(manifest, indent=2, sort_keys=True))
+        outcomes[view] = 'built'
+        log(f"Built {view} in {seconds:.1f} s")
+
+    def failed(view: str, error: Exception) -> None:
+        outcomes[view] = 'failed'
+        log(f"Failed to build {view}: {error}")
+
+    # Small histories render faster than worker processes start
+    points = int(activities.column('vertex_count').sum()) if len(activities) else 0
+    if jobs < 2 or len(stale) < 2 or points < parallel_aggregation.PARALLEL_MIN_POINTS:
+        for view in stale:
+            started = time.perf_counter()
+            try:
+                files = render_view(out_dir, view, options, keys[view], activities)
+            except Exception as e:
+                failed(view, e)
+                continue
+            finished(view, files, time.perf_counter() - started)
+        return outcomes
+
+    # Forking a process with threads running (e.g. the token refresher) could copy held locks
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    started = time.perf_counter()
+    with ProcessPoolExecutor(min(jobs, len(stale)), mp_context=multiprocessing.get_context(method),
+                             initializer=_init_worker) as pool:
+        futures = {pool.submit(render_view, out_dir, view, options, keys[view]): view for view in stale}
+        for future in as_completed(futures):
+            view = futures[future]
+            try:
+                files = future.result()
+            except Exception as e:
+                failed(view, e)
+                continue
+            finished(view, files, time.perf_counter() - started)
+    return outcomes
+
@@ -1,7 +1,10 @@
 import os
 import json
-from time import time
 from dotenv import load_dotenv
+from stravalib.client import Client
+from services.activity_store import activity_store
+from services.sync_pipeline import SyncPipeline, API_URL
+from services.token_manager import TokenManager
 
 class StravaService:
     def __init__(self):
@@ -9,38 +12,31 @@ class StravaService:
         self.client_id = os.getenv("CLIENT_ID")
         self.client_secret = os.getenv("CLIENT_SECRET")
         self.tokens_file = "services/strava_tokens.json"
-        
-    def load_tokens(self):
-        """Load tokens from file."""
-        return json.load(open(self.tokens_file)) if os.path.exists(self.tokens_file) else {}
-        
+        self.tokens = TokenManager(self.tokens_file, self.refresh_tokens)
+
+    def refresh_tokens(self, refresh_token):
+        """Exchange a refresh token for new tokens, on a client of its own so no request's client is touched."""
+        return Client().refresh_access_token(
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            refresh_token=refresh_token
+        )
+
     def save_tokens(self, tokens):
-        """Save tokens to file."""
-        with open(self.tokens_file, 'w') as f:
-            json.dump(tokens, f)
+        """Save tokens to file and use them from now on."""
+        self.tokens.save(tokens)
             
     def get_authorization_url(self):
         """Generate the Strava authorization URL"""
         return f"https://www.strava.com/oauth/authorize?client_id={self.client_id}&response_type=code&redirect_uri=http://localhost:8080/sync/exchange_token&scope=activity:read_all&approval_prompt=force"
         
     def get_valid_access_token(self, client):
-        """Get or refresh Strava access token."""
-        tokens = self.load_tokens()
-        
-        if not tokens:
+        """Set a valid Strava access token on the client, refreshed in the background before it expires."""
+        access_token = self.tokens.access_token()
+        if not access_token:
             return False
-            
-        # Refresh token if expired
-        if tokens.get("expires_at", 0) <= time():
-            print("Refreshing access token...")
-            tokens = client.refresh_access_token(
-                client_id=self.client_id,
-                client_secret=self.client_secret,
-                refresh_token=tokens["refresh_token"]
-            )
-            self.save_tokens(tokens)
-            
-        client.access_token = tokens["access_token"]
+
+        client.access_token = access_token
         return True
         
     def handle_authorization_callback(self, client, code):
@@ -52,22 +48,32 @@ class StravaService:
         )
         self.save_tokens(tokens)
         
-    def fetch_activities(self, client, start_date, end_date):
-        """Fetch and format Strava activities."""
-        return [{
-            "id": activity.id,
-            "name": activity.name,
-            "start_date": activity.start_date_local.isoformat(),
-            "start_lat": activity.start_latlng.lat if activity.start_latlng else None,
-            "start_lng": activity.start_latlng.lon if activity.start_latlng else None,
-            "distance": activity.distance,
-            "moving_time": activity.moving_time,
-            "elapsed_time": activity.elapsed_time,
-            "type": activity.type.root,
-            "average_speed": activity.average_speed,
-            "map": activity.map.summary_polyline if hasattr(activity, 'map') else None
-        } for activity in client.get_activities(after=start_date, before=end_date)
-        if hasattr(activity, 'map') and activity.map.summary_polyline] 
+    def _pipeline(self, client, **options):
+        return SyncPipeline(
+            client.access_token,
+            api_url=os.getenv("STRAVA_API_URL", API_URL),
+            workers=int(os.getenv("SYNC_WORKERS", 4)),
+            detailed=os.getenv("SYNC_DETAILED", "1") != "0",
+            **options
+        )
+
+    def fetch_activities(self, client, start_date, end_date, on_activities=None, on_progress=None):
+        """Fetch and format Strava activities with detailed routes.
+
+        on_activities receives each batch of activities as it arrives and
+        on_progress the fetch progress, see SyncPipeline.
+        """
+        pipeline = self._pipeline(client, on_activities=on_activities, on_progress=on_progress)
+        return pipeline.run(start_date, end_date)
+
+    def fetch_changes(self, client, start_date, end_date, is_changed, on_activities=None, on_progress=None):
+        """Fetch the activities in a date range whose listed summary is_changed returns True for.
+
+        Returns:
+            tuple: (the changed activities with detailed routes, the ids of every activity listed)
+        """
+        pipeline = self._pipeline(client, on_activities=on_activities, on_progress=on_progress, keep=is_changed)
+        return pipeline.run(start_date, end_date), pipeline.listed
 
     def get_activity_date_range(self):
         """Get the date range of stored activities.
@@ -75,24 +81,12 @@ class StravaService:
         Returns:
             tuple: (start_date, end_date) as ISO format strings, or (None, None) if no activities
         """
-        try:
-            with open('data/strava_activities.json', 'r') as f:
-                activities = json.load(f)
-                
-            if not activities:
-                return None, None
-                
-            # Sort activities by start_date
-            sorted_activities = sorted(activities, key=lambda x: x['start_date'])
-            
-            # Get earliest and latest dates
-            start_date = sorted_activities[0]['start_date'].split('T')[0]  # Get just the date part
-            end_date = sorted_activities[-1]['start_date'].split('T')[0]
-            
-            return start_date, end_date
-            
-        except (FileNotFoundError, json.JSONDecodeError):
-            return None, None 
+        start_date, end_date = activity_store.date_range()
+        if not start_date:
+            return None, None
+
+        # Get just the date part
+        return start_date.split('T')[0], end_date.split('T')[0]
         
     def fetch_athlete(self, client):
         try:
@@ -128,4 +122,9 @@ class StravaService:
             
         except Exception as e:
             print(f"Error fetching athlete data: {str(e)}")
-            return None
\ No newline at end of file
+            return None
+
+
+# Shared by every request, the service reads .env once and the client keeps its session
+strava_service = StravaService()
+strava_client = Client()
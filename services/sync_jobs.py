@@ -0,0 +1,96 @@
+import os
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict
+
+from services.activity_store import activity_store
+from services.dataset_manager import dataset_manager
+from services.density_pyramid import density_pyramid
+from services.geometry_store import add_geometry
+from services.render_cache import render_cache
+
+DAY = 24 * 60 * 60
+# Days back an incremental sync re-lists to pick up late uploads, edits and deletions
+RECONCILE_DAYS = int(os.getenv('SYNC_RECONCILE_DAYS', 7))
+# Fields of a listed activity that differ from the stored ones once it has been edited on Strava
+SUMMARY_FIELDS = ('name', 'start_date', 'start_lat', 'start_lng', 'distance', 'moving_time', 'elapsed_time',
+                  'type', 'average_speed')
+
+
+def full_sync(progress: Callable, strava_service, client, start_date: datetime, end_date: datetime) -> int:
+    """
+    Background task replacing the stored activities with those in a date range.
+
+    Activities are written to the store page by page as they arrive, and
+    anything not returned by the sync is removed once it completes.
+    """
+    progress(stage='Fetching activities')
+    # One version for the whole sync, so the activity table is rebuilt once rather than per page
+    with activity_store.deferred_version():
+        activities = strava_service.fetch_activities(client, start_date, end_date,
+                                                     on_activities=activity_store.upsert, on_progress=progress)
+        activity_store.retain(activity['id'] for activity in activities)
+    # Incremental syncs carry on from the end of the range
+    activity_store.set_sync_cursor(min(int(end_date.timestamp()), int(time.time())))
+    dataset_manager.reload()
+
+    progress(stage='Building map caches')
+    # Cache decoded and simplified geometry so map renders skip polyline decoding
+    add_geometry(activities)
+    density_pyramid.rebuild(activities)
+    render_cache.invalidate()
+    return len(activities)
+
+
+def incremental_sync(progress: Callable, strava_service, client, reconcile_days: int = RECONCILE_DAYS) -> int:
+    """
+    Background task bringing the store up to date with Strava. Returns the number of activities written or deleted.
+
+    Activities are listed from a day before the sync cursor, the time the
+    previous sync started, or from ``reconcile_days`` ago if that is earlier,
+    which picks up late uploads, edits and deletions in that window. Stored
+    start dates are local time while Strava filters on UTC, the day of overlap
+    covers the difference. Only listed activities that are new or whose
+    summary differs from the stored one are fetched in detail and written, and
+    stored activities in the window that are no longer listed are deleted, so
+    a sync without changes writes nothing.
+    """
+    started = datetime.now(timezone.utc)
+    cursor = activity_store.sync_cursor()
+    if cursor is None:
+        # Synced before the cursor was kept, continue from the latest stored activity
+        _, latest_start_date = activity_store.date_range()
+        cursor = utc_epoch(latest_start_date)
+    window_start = min(cursor - DAY, int(started.timestamp()) - reconcile_days * DAY)
+    window_start -= window_start % DAY  # Whole days, so an interrupted sync resumes the same run
+
+    # Every stored activity that can be in the listing, keyed by id
+    since = datetime.fromtimestamp(window_start - DAY, timezone.utc).strftime('%Y-%m-%d')
+    stored = {activity['id']: activity for activity in activity_store.query(start_date=since)}
+
+    def is_changed(activity: Dict) -> bool:
+        known = stored.get(activity['id'])
+        return known is None or any(known.get(field) != activity.get(field) for field in SUMMARY_FIELDS)
+
+    progress(stage='Fetching activities')
+    with activity_store.deferred_version():
+        changed, listed = strava_service.fetch_changes(client, datetime.fromtimestamp(window_start, timezone.utc),
+                                                       started, is_changed, on_activities=activity_store.upsert,
+                                                       on_progress=progress)
+
+        # Activities starting a day into the window are listed whatever their time zone, unless deleted
+        deleted = activity_store.delete(activity_id for activity_id, activity in stored.items()
+                                        if activity['epoch'] >= window_start + DAY and activity_id not in listed)
+    activity_store.set_sync_cursor(int(started.timestamp()))
+
+    if changed or deleted:
+        progress(stage='Building map caches')
+        # Only changed activities need decoding, edited and deleted routes make the pyramid rebuild
+        add_geometry(changed)
+        density_pyramid.update(dataset_manager.reload().activities)
+        render_cache.invalidate()
+    return len(changed) + deleted
+
+
+def utc_epoch(start_date: str) -> int:
+    return int(datetime.fromisoformat(start_date.rstrip('Z')[:19]).replace(tzinfo=timezone.utc).timestamp())
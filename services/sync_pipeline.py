@@ -0,0 +1,299 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+import requests
+
+API_URL = 'https://www.strava.com/api/v3'
+SHORT_WINDOW = 15 * 60
+LONG_WINDOW = 24 * 60 * 60
+
+
+class RateLimiter:
+    """
+    Token bucket scheduler for Strava's 15-minute and daily request budgets.
+
+    Both buckets start full and refill continuously over their window. Limits
+    and remaining budget are re-read from the ``X-RateLimit-Limit`` and
+    ``X-RateLimit-Usage`` headers ("short,long") of every response, so the
+    scheduler follows whatever budget the API reports for this application.
+    Strava resets the short window at each quarter hour and the daily one at
+    midnight UTC, so a 429 waits for the next of those rather than retrying.
+    """
+
+    def __init__(self, short_limit: int = 100, long_limit: int = 1000, clock=time.monotonic, sleep=time.sleep,
+                 wall_clock=time.time):
+        self.clock = clock
+        self.sleep = sleep
+        self.wall_clock = wall_clock
+        self._lock = threading.Lock()
+        self.limits = [short_limit, long_limit]
+        self.tokens = [float(short_limit), float(long_limit)]
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        elapsed = now - self._updated
+        self._updated = now
+        for i, window in enumerate((SHORT_WINDOW, LONG_WINDOW)):
+            self.tokens[i] = min(self.limits[i], self.tokens[i] + elapsed * self.limits[i] / window)
+
+    def acquire(self) -> None:
+        """Blocks until both budgets allow one more request."""
+        while True:
+            with self._lock:
+                self._refill()
+                missing = [max(0.0, 1 - tokens) * window / limit
+                           for tokens, limit, window in zip(self.tokens, self.limits, (SHORT_WINDOW, LONG_WINDOW))]
+                wait = max(missing)
+                if wait == 0:
+                    self.tokens = [tokens - 1 for tokens in self.tokens]
+                    return
+            self.sleep(wait)
+
+    def update(self, headers) -> None:
+        """Aligns the buckets with the limits and usage reported by the API."""
+        limit = headers.get('X-ReadRateLimit-Limit') or headers.get('X-RateLimit-Limit')
+        usage = headers.get('X-ReadRateLimit-Usage') or headers.get('X-RateLimit-Usage')
+        if not limit or not usage:
+            return
+        try:
+            limits = [int(value) for value in limit.split(',')][:2]
+            used = [int(value) for value in usage.split(',')][:2]
+        except ValueError:
+            return
+        with self._lock:
+            self._refill()
+            self.limits = limits
+            # The API's count is authoritative, it also covers other clients of this app
+            self.tokens = [float(max(0, lim - use)) for lim, use in zip(limits, used)]
+
+    def reset_delay(self) -> float:
+        """Returns the seconds until the exhausted window resets, midnight UTC if the daily budget is spent."""
+        now = self.wall_clock()
+        with self._lock:
+            daily_spent = self.tokens[1] < 1
+        window = LONG_WINDOW if daily_spent else SHORT_WINDOW
+        return window - now % window
+
+    def exhausted(self) -> None:
+        """Sleeps through a 429 until the window resets, then empties the short bucket's debt."""
+        with self._lock:
+            self._refill()
+            self.tokens[0] = min(self.tokens[0], 0.0)
+        self.sleep(self.reset_delay())
+        with self._lock:
+            self._updated = self.clock()
+            self.tokens = [float(limit) if tokens < 1 else tokens
+                           for tokens, limit in zip(self.tokens, self.limits)]
+
+
+def format_activity(data: Dict, detailed: bool = False) -> Dict:
+    """Formats an activity from the Strava API like the stored activities."""
+    latlng = data.get('start_latlng') or [None, None]
+    route = data.get('map') or {}
+    return {
+        "id": data['id'],
+        "name": data.get('name'),
+        "start_date": data['start_date_local'].rstrip('Z'),
+        "start_lat": latlng[0] if latlng else None,
+        "start_lng": latlng[1] if latlng else None,
+        "distance": data.get('distance'),
+        "moving_time": data.get('moving_time'),
+        "elapsed_time": data.get('elapsed_time'),
+        "type": data.get('type'),
+        "average_speed": data.get('average_speed'),
+        "map": (detailed and route.get('polyline')) or route.get('summary_polyline')
+    }
+
+
+class SyncPipeline:
+    """
+    Downloads activities from the Strava API with a bounded thread pool.
+
+    Activity pages are requested ``workers`` at a time until a short page marks
+    the end, then each activity's detailed polyline is fetched concurrently.
+    Every request goes through the ``RateLimiter``. Progress is checkpointed to
+    ``state_file`` and fetched activities are spooled to ``spool_file``, so an
+    interrupted sync with the same start date and end day resumes where it stopped.
+    ``api_url`` can point at a local stub server.
+
+    ``on_activities`` is called with each batch of activities as it arrives, so
+    callers can write them to the store while the sync runs, and ``on_progress``
+    with the counts of pages and activities fetched and of requests remaining.
+
+    With a ``keep`` predicate only the listed activities it returns True for
+    are spooled, delivered and have their details fetched, e.g. those new or
+    changed since the last sync. The ids of every listed activity with a route
+    are in ``listed`` after ``run``, so callers can tell what was deleted.
+    """
+
+    def __init__(self, access_token: str, api_url: str = API_URL, workers: int = 4, per_page: int = 200,
+                 detailed: bool = True, limiter: Optional[RateLimiter] = None,
+                 state_file: str = 'data/sync_state.json', spool_file: str = 'data/sync_spool.jsonl',
+                 max_retries: int = 5, on_activities: Optional[Callable[[List[Dict]], None]] = None,
+                 on_progress: Optional[Callable[..., None]] = None, keep: Optional[Callable[[Dict], bool]] = None):
+        self.api_url = api_url.rstrip('/')
+        self.workers = workers
+        self.per_page = per_page
+        self.detailed = detailed
+        self.limiter = limiter or RateLimiter()
+        self.state_file = state_file
+        self.spool_file = spool_file
+        self.max_retries = max_retries
+        self.on_activities = on_activities
+        self.on_progress = on_progress
+        self.keep = keep
+        self.listed: Set[int] = set()
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f"Bearer {access_token}"
+        self._lock = threading.Lock()
+
+    def _get(self, path: str, params: Optional[Dict] = None):
+        attempt = 0
+        while attempt < self.max_retries:
+            self.limiter.acquire()
+            response = self.session.get(f"{self.api_url}{path}", params=params, timeout=30)
+            self.limiter.update(response.headers)
+            if response.status_code == 429:
+                # Rate limited, not failed, wait for the window without spending a retry
+                self.limiter.exhausted()
+                continue
+            if response.status_code >= 500:
+                attempt += 1
+                if attempt < self.max_retries:
+                    self.limiter.sleep(2 ** attempt)
+                continue
+            response.raise_for_status()
+            return response.json()
+        raise RuntimeError(f"Strava API request failed after {self.max_retries} attempts: {path}")
+
+    def _load_state(self, after: int, end_day: str, before: int) -> Dict:
+        state = {'after': after, 'end_day': end_day, 'before': before, 'pages': [], 'last_page': None, 'detailed': []}
+        try:
+            with open(self.state_file, 'r') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            saved = None
+        if saved and saved.get('after') == after and saved.get('end_day') == end_day:
+            # Keep the first run's 'before' so page boundaries stay the same
+            return saved
+        # A different range, start over
+        for path in (self.state_file, self.spool_file):
+            if os.path.exists(path):
+                os.remove(path)
+        return state
+
+    def _save_state(self, state: Dict) -> None:
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        tmp_file = self.state_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
+
+    def _spool(self, activities: Iterable[Dict]) -> None:
+        os.makedirs(os.path.dirname(self.spool_file) or '.', exist_ok=True)
+        with open(self.spool_file, 'a') as f:
+            for activity in activities:
+                f.write(json.dumps(activity) + '\n')
+
+    def _load_spool(self) -> Dict[int, Dict]:
+        activities = {}
+        if os.path.exists(self.spool_file):
+            with open(self.spool_file, 'r') as f:
+                for line in f:
+                    try:
+                        activity = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Partially written line from an interrupted run
+                    activities[activity['id']] = activity
+        return activities
+
+    def _report(self, state: Dict) -> None:
+        """Passes progress to ``on_progress``, called with ``self._lock`` held."""
+        if not self.on_progress:
+            return
+        pages_remaining = (None if state['last_page'] is None
+                           else len(set(range(1, state['last_page'] + 1)) - set(state['pages'])))
+        details_remaining = state.get('details_total', 0) - len(state['detailed']) if self.detailed else 0
+        remaining = None if pages_remaining is None else pages_remaining + max(0, details_remaining)
+        self.on_progress(fetched=state.get('fetched', 0), pages_done=len(state['pages']),
+                         pages_remaining=pages_remaining, details_done=len(state['detailed']),
+                         done=len(state['pages']) + len(state['detailed']), remaining=remaining)
+
+    def _deliver(self, activities: List[Dict]) -> None:
+        if self.on_activities and activities:
+            self.on_activities(activities)
+
+    def _fetch_page(self, state: Dict, after: int, before: int, page: int) -> int:
+        items = self._get('/athlete/activities',
+                          {'after': after, 'before': before, 'page': page, 'per_page': self.per_page})
+        activities = [activity for activity in map(format_activity, items) if activity['map']]
+        listed = [activity['id'] for activity in activities]
+        if self.keep:
+            activities = [activity for activity in activities if self.keep(activity)]
+        with self._lock:
+            if self.keep:
+                # Only tracked when filtering, a full sync's every id would bloat each state save
+                state['listed'] = state.get('listed', []) + listed
+            self._spool(activities)
+            self._deliver(activities)
+            state['pages'].append(page)
+            state['fetched'] = state.get('fetched', 0) + len(activities)
+            if len(items) < self.per_page:
+                state['last_page'] = page if state['last_page'] is None else min(state['last_page'], page)
+            self._save_state(state)
+            self._report(state)
+        return len(items)
+
+    def _fetch_detail(self, state: Dict, activity: Dict) -> None:
+        detail = format_activity(self._get(f"/activities/{activity['id']}"), detailed=True)
+        with self._lock:
+            if detail['map']:
+                self._spool([detail])
+                self._deliver([detail])
+            state['detailed'].append(activity['id'])
+            self._save_state(state)
+            self._report(state)
+
+    def run(self, start_date: datetime, end_date: datetime) -> List[Dict]:
+        """Fetches all activities between two dates, resuming an interrupted run."""
+        # Runs are identified by day, end_date is usually today() and differs on every call
+        state = self._load_state(int(start_date.timestamp()), end_date.date().isoformat(), int(end_date.timestamp()))
+        after, before = state['after'], state['before']
+        # Activities spooled by an interrupted run have to reach the caller too
+        self._deliver(list(self._load_spool().values()))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            page = 1
+            while True:
+                done = set(state['pages'])
+                if state['last_page'] is not None:
+                    # The end is known, fill in pages an interrupted run missed
+                    pages = [p for p in range(1, state['last_page'] + 1) if p not in done]
+                    if not pages:
+                        break
+                else:
+                    pages = [p for p in range(page, page + self.workers) if p not in done]
+                    page += self.workers
+                list(executor.map(lambda p: self._fetch_page(state, after, before, p), pages))
+
+            if self.detailed:
+                done = set(state['detailed'])
+                spooled = self._load_spool()
+                pending = [a for a in spooled.values() if a['id'] not in done]
+                with self._lock:
+                    state['details_total'] = len(spooled)
+                    self._report(state)
+                list(executor.map(lambda a: self._fetch_detail(state, a), pending))
+
+        activities = sorted(self._load_spool().values(), key=lambda a: a['start_date'])
+        self.listed = set(state.get('listed', [])) if self.keep else {activity['id'] for activity in activities}
+        for path in (self.state_file, self.spool_file):
+            if os.path.exists(path):
+                os.remove(path)
+        return activities
@@ -0,0 +1,97 @@
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+from services.dataset_manager import dataset_manager
+from services.geometry_store import geometry_store
+from services.density_pyramid import TILE_SIZE, density_pyramid
+
+SATURATION = 20  # Visits per pixel that map to the hottest colour
+
+# Colour stops (position, r, g, b, alpha) for the heat ramp
+COLOR_STOPS = [
+    (0.0, 0, 0, 0, 0),
+    (0.15, 60, 0, 150, 120),
+    (0.4, 220, 20, 60, 200),
+    (0.7, 255, 140, 0, 235),
+    (1.0, 255, 255, 200, 255),
+]
+
+
+def build_colormap(stops=COLOR_STOPS) -> np.ndarray:
+    """Interpolates colour stops into a 256 entry RGBA lookup table."""
+    positions = np.array([stop[0] for stop in stops])
+    values = np.array([stop[1:] for stop in stops], dtype=np.float64)
+    ramp = np.linspace(0, 1, 256)
+    return np.stack([np.interp(ramp, positions, values[:, c]) for c in range(4)], axis=1).astype(np.uint8)
+
+
+COLORMAP = build_colormap()
+
+
+def encode_png(rgba: np.ndarray) -> bytes:
+    """Encodes an (H, W, 4) uint8 array as a PNG image."""
+    height, width, _ = rgba.shape
+    raw = np.empty((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 0] = 0  # No filter on every scanline
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + chunk(b'IEND', b''))
+
+
+EMPTY_TILE = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8))
+
+
+def colorize(counts: np.ndarray) -> np.ndarray:
+    """Turns a grid of visit counts into RGBA pixels."""
+    # Spread single-pixel tracks over their neighbours so thin routes stay visible
+    padded = np.pad(counts, 1)
+    spread = counts + 0.5 * (padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:])
+    intensity = np.clip(np.log1p(spread) / np.log1p(SATURATION), 0.0, 1.0)
+    return COLORMAP[(intensity * 255).astype(np.uint8)]
+
+
+class TileRenderer:
+    """
+    Rasterises activity density into slippy-map PNG tiles.
+
+    Counts come from the precomputed density pyramid, so a tile costs a binary
+    search over the cells of its column instead of a pass over every point.
+    The pyramid is topped up from the activity store when the store has
+    changed without going through sync (e.g. the one-time JSON migration).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+
+    def _ensure_pyramid(self) -> None:
+        dataset = dataset_manager.current()
+        with self._lock:
+            if dataset.version != self._version:
+                activities = dataset.activities
+                geometry_store.add(activities)
+                density_pyramid.update(activities)
+                self._version = dataset.version
+
+    def counts(self, z: int, x: int, y: int) -> np.ndarray:
+        """Returns a TILE_SIZE x TILE_SIZE grid of point counts for a tile."""
+        self._ensure_pyramid()
+        return density_pyramid.tile_counts(z, x, y)
+
+    def render(self, z: int, x: int, y: int) -> bytes:
+        """Renders one tile as PNG bytes."""
+        counts = self.counts(z, x, y)
+        if not counts.any():
+            return EMPTY_TILE
+        return encode_png(colorize(counts))
+
+
+tile_renderer = TileRenderer()
@@ -0,0 +1,121 @@
+import json
+import os
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+
+class TokenManager:
+    """
+    Holds the Strava OAuth tokens in memory and keeps the access token fresh.
+
+    Tokens are read from ``tokens_file`` once. A background thread calls
+    ``refresh`` with the refresh token ``refresh_margin`` seconds before
+    ``expires_at``, so requests normally find a valid token without touching
+    the disk or the network. Refreshes are serialised with a lock: a request
+    that finds the token already expired waits for the one refresh in flight
+    rather than starting another. ``status`` never blocks.
+    """
+
+    def __init__(self, tokens_file: str, refresh: Callable[[str], Dict], clock=time.time,
+                 refresh_margin: float = 300, retry_delay: float = 60):
+        self.tokens_file = tokens_file
+        self.refresh_token = refresh
+        self.clock = clock
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+        self._tokens: Optional[Dict] = None
+        self._loaded = False
+        self._load_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._refresher: Optional[threading.Thread] = None
+
+    def _load(self) -> Optional[Dict]:
+        if not self._loaded:
+            with self._load_lock:
+                if not self._loaded:
+                    try:
+                        with open(self.tokens_file) as f:
+                            self._tokens = json.load(f)
+                    except (OSError, json.JSONDecodeError):
+                        self._tokens = None
+                    self._loaded = True
+                    self._start_refresher()
+        return self._tokens
+
+    def _start_refresher(self) -> None:
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+            self._refresher.start()
+
+    def _run(self) -> None:
+        while True:
+            tokens = self._tokens
+            if not tokens:
+                self._wake.wait()
+            else:
+                delay = tokens.get('expires_at', 0) - self.refresh_margin - self.clock()
+                if delay <= 0:
+                    # Whether it worked or not, check again after a pause rather than spin
+                    self.refresh()
+                    self._wake.clear()
+                    delay = self.retry_delay
+                self._wake.wait(delay)
+            self._wake.clear()
+
+    def _expiring(self, tokens: Dict, margin: float = 0) -> bool:
+        return tokens.get('expires_at', 0) - margin <= self.clock()
+
+    def status(self) -> str:
+        """Returns 'missing', 'valid' or 'expired' from the tokens in memory, without refreshing."""
+        tokens = self._tokens if self._loaded else self._load()
+        if not tokens:
+            return 'missing'
+        return 'expired' if self._expiring(tokens) else 'valid'
+
+    def has_credentials(self) -> bool:
+        """Whether tokens are stored, an expired access token is refreshed when next used."""
+        return self.status() != 'missing'
+
+    def save(self, tokens: Dict) -> None:
+        """Stores new tokens, e.g. from the OAuth code exchange."""
+        tmp_file = self.tokens_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(tokens, f)
+        os.replace(tmp_file, self.tokens_file)
+        self._load()
+        self._tokens = dict(tokens)
+        self._wake.set()  # Reschedule the background refresh
+
+    def refresh(self) -> bool:
+        """Refreshes the access token unless it has just been refreshed. Returns False on failure."""
+        with self._refresh_lock:
+            tokens = self._load()
+            if not tokens:
+                return False
+            if not self._expiring(tokens, self.refresh_margin):
+                return True  # Another thread refreshed while this one waited
+            try:
+                print("Refreshing access token...")
+                new_tokens = dict(self.refresh_token(tokens['refresh_token']))
+            except Exception as e:
+                print(f"Access token refresh failed: {e}", file=sys.stderr)
+                return False
+            self.save(new_tokens)
+            return True
+
+    def access_token(self) -> Optional[str]:
+        """
+        Returns a valid access token, or None if there are no tokens.
+
+        Only blocks when the token has already expired, e.g. the refresher could
+        not reach Strava, and then only for the refresh.
+        """
+        tokens = self._load()
+        if not tokens:
+            return None
+        if self._expiring(tokens) and not self.refresh():
+            return None
+        return self._tokens['access_token']
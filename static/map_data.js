@@ -0,0 +1,50 @@
+/*
+ * Loads and decodes the geometry of the map views.
+ *
+ * Map layers get their data either inline or as the URL of a
+ * /heatmap/data/<view> endpoint. Points arrive as flat delta-encoded integer
+ * arrays [dlat, dlng, ...] scaled by 1e5 and routes as encoded polylines.
+ */
+(function() {
+    const SCALE = 1e5;
+
+    function load(data) {
+        if (typeof data !== 'string') return Promise.resolve(data);
+        return fetch(data).then(function(response) {
+            if (!response.ok) throw new Error('Could not load ' + data + ': ' + response.status);
+            return response.json();
+        });
+    }
+
+    function decodePoints(flat) {
+        const points = new Array(flat.length / 2);
+        var lat = 0, lng = 0;
+        for (var i = 0; i < points.length; i++) {
+            lat += flat[2 * i];
+            lng += flat[2 * i + 1];
+            points[i] = [lat / SCALE, lng / SCALE];
+        }
+        return points;
+    }
+
+    function decodePolyline(encoded) {
+        const points = [];
+        var index = 0, lat = 0, lng = 0;
+        while (index < encoded.length) {
+            for (var axis = 0; axis < 2; axis++) {
+                var result = 0, shift = 0, byte;
+                do {
+                    byte = encoded.charCodeAt(index++) - 63;
+                    result |= (byte & 0x1f) << shift;
+                    shift += 5;
+                } while (byte >= 0x20);
+                const delta = (result & 1) ? ~(result >> 1) : (result >> 1);
+                if (axis === 0) lat += delta; else lng += delta;
+            }
+            points.push([lat / SCALE, lng / SCALE]);
+        }
+        return points;
+    }
+
+    window.MapData = {load: load, decodePoints: decodePoints, decodePolyline: decodePolyline};
+})();
@@ -0,0 +1,93 @@
+import json
+import os
+
+import services.activity_store as activity_store_module
+from services.activity_store import ActivityStore
+from services.activity_table import ActivityTable, load_table
+
+
+def make_activity(activity_id, start_date, activity_type='Run', distance=5000.0, route='_p~iF~ps|U_ulLnnqC'):
+    return {
+        'id': activity_id,
+        'name': f"Activity {activity_id} ✓",
+        'start_date': start_date,
+        'start_lat': 38.5,
+        'start_lng': -120.2,
+        'distance': distance,
+        'moving_time': 1500,
+        'elapsed_time': 1600,
+        'type': activity_type,
+        'average_speed': 3.3,
+        'map': route,
+    }
+
+
+def make_store(tmp_path):
+    store = ActivityStore(db_file=str(tmp_path / 'activities.db'), legacy_file=str(tmp_path / 'missing.json'))
+    store.upsert([
+        make_activity(1, '2023-01-01T07:00:00Z'),
+        make_activity(2, '2023-01-02T23:59:59Z', activity_type='Ride', distance=40000.0),
+        make_activity(3, '2023-01-03T00:00:00Z', route=''),
+        {**make_activity(4, '2023-02-01T08:00:00Z', activity_type=None, route=None), 'name': None,
+         'distance': None, 'start_lat': None},
+        make_activity(5, '2023-03-01T08:00:00Z', route='_ibE_seK_seK_seK'),
+    ])
+    return store
+
+
+def test_saved_table_reads_back_the_store_rows(tmp_path):
+    store = make_store(tmp_path)
+    ActivityTable.from_activities(store.all()).save(str(tmp_path / 'table'))
+    table = ActivityTable.load(str(tmp_path / 'table'))
+
+    assert [dict(row) for row in table] == store.all()
+    assert table[3]['name'] is None and table[3]['type'] is None and table[3]['min_lat'] is None
+    assert [dict(row) for row in table[1:3]] == store.all()[1:3]
+
+
+def test_filters_select_the_rows_of_the_store_query(tmp_path):
+    store = make_store(tmp_path)
+    table = ActivityTable.from_activities(store.all())
+
+    for filters in [{}, {'start_date': '2023-01-02'}, {'end_date': '2023-01-02'},
+                    {'start_date': '2023-01-02', 'end_date': '2023-01-03'}, {'activity_type': 'Ride'},
+                    {'activity_type': 'Swim'}, {'min_distance': 10000}, {'max_distance': 10000},
+                    {'bbox': (38.0, -121.0, 39.0, -120.0)}, {'bbox': (39.0, -121.0, 41.0, -119.0)},
+                    {'bbox': (0.0, 0.0, 1.0, 1.0)}]:
+        assert table.filter(**filters).column('id').tolist() == [row['id'] for row in store.query(**filters)], filters
+
+
+def test_table_is_saved_once_per_store_change(tmp_path):
+    store = make_store(tmp_path)
+    table_dir = str(tmp_path / 'tables')
+
+    first = load_table(store, table_dir)
+    assert len(first) == 5 and len(os.listdir(table_dir)) == 1
+    saved = os.listdir(table_dir)
+    store.set_sync_cursor(1700000000)  # A sync without changes keeps the saved table
+    load_table(store, table_dir)
+    assert os.listdir(table_dir) == saved
+    assert load_table(store, table_dir).column('id').tolist() == first.column('id').tolist()
+
+    store.upsert([make_activity(6, '2023-04-01T08:00:00Z')])
+    second = load_table(store, table_dir)
+    assert second.column('id').tolist() == [1, 2, 3, 4, 5, 6]
+    assert len(os.listdir(table_dir)) == 1  # The previous table is removed
+
+    # A recreated database starts its version over but is told apart by its creation time
+    os.remove(store.db_file)
+    recreated = ActivityStore(db_file=store.db_file, legacy_file=store.legacy_file)
+    recreated.upsert([make_activity(7, '2023-05-01T08:00:00Z')])
+    assert load_table(recreated, table_dir).column('id').tolist() == [7]
+
+
+def test_legacy_json_is_imported_with_its_routes_cached(tmp_path, monkeypatch):
+    cached = []
+    monkeypatch.setattr(activity_store_module, 'add_geometry', lambda activities: cached.extend(activities))
+    activities = [make_activity(1, '2023-01-01T07:00:00Z'), make_activity(2, '2023-01-02T07:00:00Z')]
+    with open(tmp_path / 'activities.json', 'w') as f:
+        json.dump(activities, f)
+
+    store = ActivityStore(db_file=str(tmp_path / 'activities.db'), legacy_file=str(tmp_path / 'activities.json'))
+    assert store.count() == 2
+    assert [activity['id'] for activity in cached] == [1, 2]
@@ -0,0 +1,91 @@
+import pstats
+
+from bottle import Bottle, HTTPError
+
+from services.metrics import Metrics, MetricsMiddleware
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_app(metrics, clock):
+    app = Bottle()
+
+    @app.route('/heatmap/frame/<view>')
+    def frame(view):
+        with metrics.stage('load'):
+            clock.now += 0.25
+        with metrics.stage('render'):
+            clock.now += 0.5
+        metrics.count('activities', 3)
+        return 'x' * 100
+
+    @app.route('/heatmap/tiles/<z:int>/<x:int>/<y:int>.png')
+    def tile(z, x, y):
+        return b'png'
+
+    @app.route('/missing')
+    def missing():
+        raise HTTPError(404)
+
+    return app
+
+
+def call(application, path, query=''):
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured['status'] = status
+        captured['headers'] = dict(headers)
+
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '80', 'wsgi.url_scheme': 'http'}
+    body = application(environ, start_response)
+    content = b''.join(body)
+    body.close()
+    return captured['status'], captured['headers'], content
+
+
+def test_stages_are_sent_as_server_timing_and_totalled_per_route():
+    clock = Clock()
+    metrics = Metrics(clock=clock)
+    application = MetricsMiddleware(make_app(metrics, clock), metrics, profile_mode='off')
+
+    status, headers, body = call(application, '/heatmap/frame/time')
+    assert status.startswith('200')
+    assert headers['Server-Timing'] == 'load;dur=250.0, render;dur=500.0, total;dur=750.0'
+
+    call(application, '/heatmap/frame/time')
+    call(application, '/heatmap/tiles/12/2889/1861.png')
+    call(application, '/missing')
+    text = metrics.render()
+    assert 'heatmap_http_requests_total{route="/heatmap/frame/time",method="GET",status="200"} 2' in text
+    assert 'heatmap_http_requests_total{route="/heatmap/tiles/<z>/<x>/<y>.png",method="GET",status="200"} 1' in text
+    assert 'heatmap_http_requests_total{route="not_found",method="GET",status="404"} 1' in text
+    assert 'heatmap_http_request_duration_seconds_bucket{route="/heatmap/frame/time",le="0.5"} 0' in text
+    assert 'heatmap_http_request_duration_seconds_bucket{route="/heatmap/frame/time",le="1.0"} 2' in text
+    assert 'heatmap_http_response_bytes_total{route="/heatmap/frame/time"} 200' in text
+    assert 'heatmap_stage_duration_seconds_sum{stage="render"} 1.000000' in text
+    assert 'heatmap_stage_duration_seconds_count{stage="render"} 2' in text
+    assert 'heatmap_activities_total 6' in text
+
+
+def test_profiles_are_opt_in_by_path_and_capped(tmp_path):
+    metrics = Metrics()
+    application = MetricsMiddleware(make_app(metrics, Clock()), metrics, profile_mode='/heatmap/frame',
+                                    profile_dir=str(tmp_path), profile_keep=2)
+
+    _, headers, _ = call(application, '/heatmap/tiles/12/2889/1861.png', 'profile=1')
+    assert 'X-Profile' not in headers
+    assert not list(tmp_path.iterdir())
+
+    ids = [call(application, '/heatmap/frame/time')[1]['X-Profile'] for _ in range(3)]
+    assert all('/' not in profile_id for profile_id in ids)
+    assert sorted(path.name for path in tmp_path.iterdir()) == [f"{profile_id}.prof" for profile_id in ids[1:]]
+    stats = pstats.Stats(str(tmp_path / f"{ids[-1]}.prof"))
+    assert any(function == 'frame' for _, _, function in stats.stats)
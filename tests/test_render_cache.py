@@ -0,0 +1,38 @@
+import gzip
+import time
+from types import SimpleNamespace
+
+import services.render_cache as render_cache_module
+from services.render_cache import RenderCache
+
+
+def read(cache, key, encoding):
+    size, chunks = cache.stream(key, encoding)
+    body = b''.join(chunks)
+    assert len(body) == size
+    return body
+
+
+def test_gzip_is_stored_at_once_and_brotli_in_the_background(tmp_path, monkeypatch):
+    compressed = []
+
+    def compress(data, quality):
+        compressed.append(quality)
+        return b'br:' + data
+
+    monkeypatch.setattr(render_cache_module, 'brotli', SimpleNamespace(compress=compress))
+    cache = RenderCache(cache_dir=str(tmp_path))
+    page = '<html>' + 'map ' * 1000 + '</html>'
+
+    cache.put('page', page)
+    assert read(cache, 'page', 'identity') == page.encode('utf-8')
+    assert gzip.decompress(read(cache, 'page', 'gzip')) == page.encode('utf-8')
+
+    deadline = time.monotonic() + 5
+    while cache.negotiate('page', 'gzip, br') != 'br' and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cache.negotiate('page', 'gzip, br') == 'br'
+    assert read(cache, 'page', 'br') == b'br:' + page.encode('utf-8')
+    assert compressed == [render_cache_module.BROTLI_QUALITY]
+    assert cache.negotiate('page', 'gzip') == 'gzip'
+    assert cache.negotiate('page', '') == 'identity'
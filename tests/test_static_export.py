@@ -0,0 +1,68 @@
+import json
+import os
+import subprocess
+import sys
+
+from benchmarks import synthetic
+from services.activity_store import ActivityStore
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VIEWS = ('index', 'time', 'single', 'routes')
+
+
+def make_athlete(tmp_path, name, count, seed):
+    athlete_dir = tmp_path / name
+    (athlete_dir / 'data').mkdir(parents=True)
+    synthetic.write(count, str(athlete_dir / 'data' / 'strava_activities.json'), seed=seed)
+    return athlete_dir
+
+
+def run_cli(*args, cwd):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'cli.py'), *args], cwd=cwd, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    assert result.returncode == 0, result.stdout
+    return result.stdout
+
+
+def test_exports_every_view_per_athlete_and_rebuilds_only_what_changed(tmp_path):
+    alice, bob = make_athlete(tmp_path, 'alice', 6, seed=1), make_athlete(tmp_path, 'bob', 4, seed=2)
+
+    output = run_cli('export', '--athlete', str(alice), '--athlete', str(bob), '--out', 'site', '--jobs', '2',
+                     cwd=tmp_path)
+    for athlete in (alice, bob):
+        site = athlete / 'site'
+        assert (site / 'static' / 'map_data.js').exists()
+        for view in VIEWS:
+            html = (site / f'{view}.html').read_text()
+            assert 'src="static/map_data.js"' in html and f'"data/{view}.json?v=' in html
+            assert json.loads((site / 'data' / f'{view}.json').read_text())
+        assert "[bob] Built routes" in output
+
+    built = {view: os.stat(bob / 'site' / f'{view}.html').st_mtime_ns for view in VIEWS}
+    store = ActivityStore(db_file=str(alice / 'data' / 'strava_activities.db'),
+                          legacy_file=str(alice / 'data' / 'strava_activities.json'))
+    store.upsert([dict(synthetic.generate(7, seed=1)[-1], id=42)])
+
+    output = run_cli('export', '--athlete', str(alice), '--athlete', str(bob), '--out', 'site', cwd=tmp_path)
+    assert "[alice] Built index" in output
+    assert "[bob] Unchanged: index, time, single, routes" in output
+    assert {view: os.stat(bob / 'site' / f'{view}.html').st_mtime_ns for view in VIEWS} == built
+
+
+def test_inlined_views_drop_their_data_files(tmp_path):
+    athlete = make_athlete(tmp_path, 'athlete', 3, seed=3)
+    run_cli('export', '--views', 'index,routes', cwd=athlete)
+    assert (athlete / 'data' / 'export' / 'data' / 'index.json').exists()
+
+    output = run_cli('export', '--views', 'index', '--inline', cwd=athlete)
+    assert "Built index" in output
+    assert not (athlete / 'data' / 'export' / 'data' / 'index.json').exists()
+    assert (athlete / 'data' / 'export' / 'data' / 'routes.json').exists()
+    assert '"data/index.json' not in (athlete / 'data' / 'export' / 'index.html').read_text()
+
+    # Deleted files are rebuilt even though nothing changed
+    os.remove(athlete / 'data' / 'export' / 'routes.html')
+    output = run_cli('export', '--views', 'routes', cwd=athlete)
+    assert "Built routes" in output
+    assert "Unchanged: index" in run_cli('export', '--views', 'index', '--inline', cwd=athlete)
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta, timezone
+
+from types import SimpleNamespace
+
+import pytest
+
+import services.sync_jobs as sync_jobs
+from services.activity_store import ActivityStore
+
+NOW = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def make_activity(activity_id, days_ago, name=None):
+    start = NOW - timedelta(days=days_ago)
+    return {
+        'id': activity_id,
+        'name': name or f"Run {activity_id}",
+        'start_date': start.strftime('%Y-%m-%dT%H:%M:%S'),
+        'start_lat': 18.5,
+        'start_lng': 73.8,
+        'distance': 5000.0,
+        'moving_time': 1500,
+        'elapsed_time': 1600,
+        'type': 'Run',
+        'average_speed': 3.3,
+        'map': '_p~iF~ps|U_ulLnnqC',
+    }
+
+
+class FakeStrava:
+    """Lists the activities it holds that start in the requested range, like the Strava API."""
+
+    def __init__(self, activities):
+        self.activities = activities
+        self.ranges = []
+
+    def fetch_changes(self, client, start_date, end_date, is_changed, on_activities=None, on_progress=None):
+        self.ranges.append((start_date, end_date))
+        listed = [activity for activity in self.activities
+                  if sync_jobs.utc_epoch(activity['start_date']) >= start_date.timestamp()]
+        changed = [activity for activity in listed if is_changed(activity)]
+        if on_activities:
+            on_activities(changed)
+        return changed, {activity['id'] for activity in listed}
+
+
+class Recorder:
+    """Stands in for the caches a sync refreshes, recording the methods called."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls.append(name)
+            return SimpleNamespace(activities=[])
+        return call
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = ActivityStore(db_file=str(tmp_path / 'activities.db'), legacy_file=str(tmp_path / 'missing.json'))
+    monkeypatch.setattr(sync_jobs, 'activity_store', store)
+    monkeypatch.setattr(sync_jobs, 'add_geometry', lambda activities: len(activities))
+    for name in ('dataset_manager', 'density_pyramid', 'render_cache'):
+        monkeypatch.setattr(sync_jobs, name, Recorder())
+    return store
+
+
+def run_sync(strava, **kwargs):
+    return sync_jobs.incremental_sync(lambda **progress: None, strava, None, **kwargs)
+
+
+def test_upserts_new_and_edited_activities_and_deletes_removed_ones(store):
+    store.upsert([make_activity(1, 30), make_activity(2, 20), make_activity(3, 5), make_activity(4, 3),
+                  make_activity(5, 2)])
+    store.set_sync_cursor(int((NOW - timedelta(days=1)).timestamp()))
+    written = []
+    upsert = store.upsert
+    store.upsert = lambda activities: written.extend(a['id'] for a in activities) or upsert(activities)
+
+    # 1 and 2 are older than the window and not listed, 5 was deleted, 4 edited and 6 is new
+    strava = FakeStrava([make_activity(3, 5), make_activity(4, 3, name="Renamed"), make_activity(6, 0.5)])
+    changes = run_sync(strava, reconcile_days=7)
+
+    assert changes == 3
+    assert sorted(written) == [4, 6]
+    stored = {activity['id']: activity for activity in store.all()}
+    assert sorted(stored) == [1, 2, 3, 4, 6]
+    assert stored[4]['name'] == "Renamed"
+    assert strava.ranges[0][0] <= NOW - timedelta(days=7)
+    assert store.sync_cursor() >= int(NOW.timestamp())
+    assert sync_jobs.render_cache.calls == ['invalidate']
+
+
+def test_sync_without_changes_writes_nothing(store):
+    activities = [make_activity(1, 3), make_activity(2, 1)]
+    store.upsert(activities)
+    version = store.version()
+
+    assert run_sync(FakeStrava(activities)) == 0
+    assert store.version() == version
+    assert sync_jobs.render_cache.calls == []
+
+
+def test_without_a_cursor_lists_from_the_latest_stored_activity(store):
+    store.upsert([make_activity(1, 40)])
+
+    strava = FakeStrava([make_activity(1, 40), make_activity(2, 35)])
+    assert run_sync(strava, reconcile_days=0) == 1
+    assert strava.ranges[0][0] <= NOW - timedelta(days=41)
+    assert sorted(activity['id'] for activity in store.all()) == [1, 2]
+
+
+def test_a_sync_written_page_by_page_bumps_the_version_once(store):
+    store.upsert([make_activity(1, 3)])
+    version = store.version()
+
+    class PagedStrava(FakeStrava):
+        def fetch_changes(self, client, start_date, end_date, is_changed, on_activities=None, on_progress=None):
+            changed, listed = super().fetch_changes(client, start_date, end_date, is_changed)
+            for activity in changed:
+                on_activities([activity])
+            return changed, listed
+
+    assert run_sync(PagedStrava([make_activity(2, 2), make_activity(3, 1), make_activity(4, 0.5)])) == 4
+    assert store.version() == version + 1
+    assert sorted(activity['id'] for activity in store.all()) == [2, 3, 4]
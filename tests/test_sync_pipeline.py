@@ -0,0 +1,214 @@
+import json
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from services.sync_pipeline import RateLimiter, SyncPipeline
+
+QUARTER_HOUR = 15 * 60
+DAY = 24 * 60 * 60
+
+
+def make_activity(activity_id):
+    return {
+        'id': activity_id,
+        'name': f"Run {activity_id}",
+        'start_date_local': f"2024-01-01T00:{activity_id % 60:02d}:00Z",
+        'start_latlng': [18.5, 73.8],
+        'distance': 1000.0,
+        'moving_time': 300,
+        'elapsed_time': 320,
+        'type': 'Run',
+        'average_speed': 3.3,
+        'map': {'summary_polyline': '_p~iF~ps|U', 'polyline': '_p~iF~ps|U_ulLnnqC'},
+    }
+
+
+class StubStrava:
+    """A local stand-in for the Strava API that records every request."""
+
+    def __init__(self, total=0):
+        self.activities = [make_activity(i) for i in range(1, total + 1)]
+        self.requests = []
+        self.responses = []  # Queued (status, usage) overrides, served before normal responses
+        self.fail_pages = set()
+        self.lock = threading.Lock()
+
+    def handle(self, handler):
+        url = urlparse(handler.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self.lock:
+            self.requests.append((url.path, query))
+            override = self.responses.pop(0) if self.responses else None
+
+        status, body, usage = 200, None, '1,1'
+        if override:
+            status, usage = override
+        elif url.path == '/athlete/activities':
+            page, per_page = int(query['page']), int(query['per_page'])
+            if page in self.fail_pages:
+                status = 500
+            body = self.activities[(page - 1) * per_page:page * per_page]
+        else:
+            activity_id = int(url.path.rsplit('/', 1)[1])
+            body = next(a for a in self.activities if a['id'] == activity_id)
+
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('X-RateLimit-Limit', '100,1000')
+        handler.send_header('X-RateLimit-Usage', usage)
+        handler.end_headers()
+        handler.wfile.write(json.dumps(body if status == 200 else {'message': 'error'}).encode())
+
+    def pages_requested(self):
+        return sorted(int(query['page']) for path, query in self.requests if path == '/athlete/activities')
+
+
+@pytest.fixture
+def stub():
+    strava = StubStrava()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            strava.handle(self)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    strava.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield strava
+    server.shutdown()
+    server.server_close()
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_pipeline(stub, tmp_path, clock, **kwargs):
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep, wall_clock=clock)
+    kwargs.setdefault('detailed', False)
+    return SyncPipeline('token', api_url=stub.url, limiter=limiter,
+                        state_file=str(tmp_path / 'sync_state.json'),
+                        spool_file=str(tmp_path / 'sync_spool.jsonl'), **kwargs)
+
+
+def test_fetches_every_page_until_a_short_page(stub, tmp_path):
+    stub.activities = [make_activity(i) for i in range(1, 451)]
+    pipeline = make_pipeline(stub, tmp_path, FakeClock(0), workers=3, per_page=100)
+
+    activities = pipeline.run(datetime(2024, 1, 1), datetime(2024, 2, 1))
+
+    assert sorted(a['id'] for a in activities) == list(range(1, 451))
+    assert stub.pages_requested() == [1, 2, 3, 4, 5, 6]
+    assert not (tmp_path / 'sync_state.json').exists()
+
+
+def test_detailed_fetch_uses_the_full_polyline(stub, tmp_path):
+    stub.activities = [make_activity(i) for i in range(1, 4)]
+    pipeline = make_pipeline(stub, tmp_path, FakeClock(0), workers=2, per_page=10, detailed=True)
+
+    activities = pipeline.run(datetime(2024, 1, 1), datetime(2024, 2, 1))
+
+    assert [a['map'] for a in activities] == ['_p~iF~ps|U_ulLnnqC'] * 3
+    assert sum(path.startswith('/activities/') for path, _ in stub.requests) == 3
+
+
+def test_interrupted_run_resumes_on_the_same_day(stub, tmp_path):
+    stub.activities = [make_activity(i) for i in range(1, 351)]
+    stub.fail_pages = {3}
+    clock = FakeClock(0)
+    pipeline = make_pipeline(stub, tmp_path, clock, workers=1, per_page=100, max_retries=2)
+
+    with pytest.raises(RuntimeError):
+        pipeline.run(datetime(2024, 1, 1), datetime(2024, 2, 1, 9, 30))
+    assert clock.sleeps == [2]  # 5xx backoff goes through the injected sleep
+    first_before = json.loads((tmp_path / 'sync_state.json').read_text())['before']
+
+    stub.fail_pages = set()
+    stub.requests.clear()
+    # A later time on the same end day resumes instead of starting over
+    activities = pipeline.run(datetime(2024, 1, 1), datetime(2024, 2, 1, 17, 45))
+
+    assert sorted(a['id'] for a in activities) == list(range(1, 351))
+    assert stub.pages_requested() == [3, 4]
+    assert {int(query['before']) for _, query in stub.requests} == {first_before}
+
+
+def test_different_range_starts_over(stub, tmp_path):
+    stub.activities = [make_activity(i) for i in range(1, 151)]
+    stub.fail_pages = {2}
+    pipeline = make_pipeline(stub, tmp_path, FakeClock(0), workers=1, per_page=100, max_retries=1)
+    with pytest.raises(RuntimeError):
+        pipeline.run(datetime(2024, 1, 1), datetime(2024, 2, 1))
+
+    stub.fail_pages = set()
+    stub.requests.clear()
+    pipeline.run(datetime(2024, 1, 2), datetime(2024, 2, 1))
+
+    assert stub.pages_requested() == [1, 2]
+
+
+def test_rate_limited_request_waits_for_the_quarter_hour(stub, tmp_path):
+    stub.activities = [make_activity(i) for i in range(1, 6)]
+    stub.responses = [(429, '100,200'), (429, '100,200')]
+    clock = FakeClock(100 * QUARTER_HOUR + 60)
+    # A single retry is enough, 429s do not use retries up
+    pipeline = make_pipeline(stub, tmp_path, clock, workers=1, per_page=10, max_retries=1)
+
+    activities = pipeline.run(datetime(2024, 1, 1), datetime(2024, 2, 1))
+
+    assert len(activities) == 5
+    assert clock.sleeps == [QUARTER_HOUR - 60, QUARTER_HOUR]
+
+
+def test_spent_daily_budget_waits_for_midnight_utc(stub, tmp_path):
+    stub.activities = [make_activity(i) for i in range(1, 6)]
+    stub.responses = [(429, '20,1000')]
+    clock = FakeClock(10 * DAY + 3600)
+    pipeline = make_pipeline(stub, tmp_path, clock, workers=1, per_page=10)
+
+    pipeline.run(datetime(2024, 1, 1), datetime(2024, 2, 1))
+
+    assert clock.sleeps == [DAY - 3600]
+
+
+def test_limiter_spaces_requests_when_the_budget_runs_low():
+    clock = FakeClock(0)
+    limiter = RateLimiter(short_limit=100, long_limit=1000, clock=clock, sleep=clock.sleep, wall_clock=clock)
+    limiter.update({'X-RateLimit-Limit': '100,1000', 'X-RateLimit-Usage': '99,99'})
+
+    limiter.acquire()
+    assert clock.sleeps == []
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(QUARTER_HOUR / 100)]
+
+
+def test_keep_filters_what_is_fetched_and_listed_has_every_id(stub, tmp_path):
+    stub.activities = [make_activity(i) for i in range(1, 8)]
+    delivered = []
+    pipeline = make_pipeline(stub, tmp_path, FakeClock(0), workers=2, per_page=3, detailed=True,
+                             keep=lambda activity: activity['id'] % 2 == 0, on_activities=delivered.extend)
+
+    activities = pipeline.run(datetime(2024, 1, 1), datetime(2024, 2, 1))
+
+    assert sorted(a['id'] for a in activities) == [2, 4, 6]
+    assert {a['id'] for a in delivered} == {2, 4, 6}
+    assert sorted(path for path, _ in stub.requests if path.startswith('/activities/')) == [
+        '/activities/2', '/activities/4', '/activities/6']
+    assert pipeline.listed == set(range(1, 8))
@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+
+from services.token_manager import TokenManager
+
+HOUR = 60 * 60
+
+
+def no_refresh(refresh_token):
+    raise AssertionError("refresh should not be called")
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def write_tokens(path, expires_at, access_token='old'):
+    path.write_text(json.dumps({'access_token': access_token, 'refresh_token': 'refresh', 'expires_at': expires_at}))
+
+
+def test_valid_token_is_served_from_memory(tmp_path):
+    clock = Clock()
+    tokens_file = tmp_path / 'tokens.json'
+    write_tokens(tokens_file, clock.now + HOUR)
+    manager = TokenManager(str(tokens_file), refresh=no_refresh, clock=clock)
+
+    assert manager.access_token() == 'old'
+    tokens_file.unlink()
+    assert manager.access_token() == 'old'
+    assert manager.status() == 'valid'
+
+
+def test_concurrent_requests_share_one_refresh(tmp_path):
+    clock = Clock()
+    tokens_file = tmp_path / 'tokens.json'
+    write_tokens(tokens_file, clock.now - 1)
+    calls = []
+    release = threading.Event()
+
+    def refresh(refresh_token):
+        calls.append(refresh_token)
+        release.wait(5)
+        return {'access_token': 'new', 'refresh_token': 'refresh2', 'expires_at': clock.now + 6 * HOUR}
+
+    manager = TokenManager(str(tokens_file), refresh=refresh, clock=clock)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.access_token())) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+
+    # The status check answers while the refresh is still in flight
+    started = time.monotonic()
+    assert manager.status() == 'expired'
+    assert time.monotonic() - started < 0.5
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == ['new'] * 5
+    assert calls == ['refresh']
+    assert json.loads(tokens_file.read_text())['refresh_token'] == 'refresh2'
+
+
+def test_token_is_refreshed_in_the_background_before_it_expires(tmp_path):
+    clock = Clock()
+    tokens_file = tmp_path / 'tokens.json'
+    write_tokens(tokens_file, clock.now + 60)  # Inside the refresh margin
+
+    def refresh(refresh_token):
+        return {'access_token': 'new', 'refresh_token': 'refresh', 'expires_at': clock.now + 6 * HOUR}
+
+    manager = TokenManager(str(tokens_file), refresh=refresh, clock=clock, refresh_margin=300)
+    assert manager.status() == 'valid'
+    deadline = time.monotonic() + 5
+    while manager.access_token() != 'new' and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert manager.access_token() == 'new'
+    assert json.loads(tokens_file.read_text())['access_token'] == 'new'
+
+
+def test_failed_refresh_of_an_expired_token_reports_no_token(tmp_path):
+    clock = Clock()
+    tokens_file = tmp_path / 'tokens.json'
+    write_tokens(tokens_file, clock.now - 1)
+
+    def refresh(refresh_token):
+        raise OSError("Strava unreachable")
+
+    manager = TokenManager(str(tokens_file), refresh=refresh, clock=clock)
+    assert manager.access_token() is None
+    assert manager.has_credentials()
+
+
+def test_missing_tokens(tmp_path):
+    manager = TokenManager(str(tmp_path / 'tokens.json'), refresh=no_refresh)
+    assert manager.status() == 'missing'
+    assert manager.access_token() is None
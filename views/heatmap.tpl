@@ -1,4 +1,9 @@
 % rebase('layout.tpl', title='Heatmap')
 <main class="container-fluid mt-0 p-0">
-    {{!map}}
-</main>
\ No newline at end of file
+    <div style="width:100%;">
+        <div style="position:relative;width:100%;height:0;padding-bottom:60%;">
+            <iframe src="{{frame_url}}" style="position:absolute;width:100%;height:100%;left:0;top:0;border:none !important;"
+                    allowfullscreen webkitallowfullscreen mozallowfullscreen></iframe>
+        </div>
+    </div>
+</main>
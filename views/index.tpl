@@ -26,7 +26,7 @@
                                 <li class="list-group-item">Strava credentials: <span class="{{'text-success' if checklist['strava_credentials'] else 'text-danger'}}">{{'Valid' if checklist['strava_credentials'] else 'Invalid'}}</span></li>
                                 <li class="list-group-item">Data files:
                                     <ul class="list-group">
-                                        <li class="list-group-item">strava_activities.json: <span class="{{'text-success' if checklist['data_files']['strava_activities'] else 'text-danger'}}">{{'Present' if checklist['data_files']['strava_activities'] else 'Missing'}}</span></li>
+                                        <li class="list-group-item">strava_activities.db: <span class="{{'text-success' if checklist['data_files']['strava_activities'] else 'text-danger'}}">{{'Present' if checklist['data_files']['strava_activities'] else 'Missing'}}</span></li>
                                         <li class="list-group-item">strava_athlete.json: <span class="{{'text-success' if checklist['data_files']['strava_athlete'] else 'text-danger'}}">{{'Present' if checklist['data_files']['strava_athlete'] else 'Missing'}}</span></li>
                                     </ul>
                                 </li>
@@ -33,6 +33,7 @@
                             <li><a class="dropdown-item" href="/heatmap">Static</a></li>
                             <li><a class="dropdown-item" href="/heatmap/time">Timelapse</a></li>
                             <li><a class="dropdown-item" href="/heatmap/single">One at a time</a></li>
+                            <li><a class="dropdown-item" href="/heatmap/tiled">Server tiles</a></li>
                         </ul>
                     </li>                    
                     <li class="nav-item dropdown">
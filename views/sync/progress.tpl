@@ -0,0 +1,78 @@
+% rebase('layout.tpl', title='Syncing Activities')
+<main class="container mt-4">
+    <div class="row justify-content-center">
+        <div class="col-md-8 col-lg-6">
+            <h2 class="text-center mb-4">Syncing Strava Activities</h2>
+
+            <div id="sync-running" class="p-4 border rounded shadow-sm bg-white">
+                <p id="sync-stage" class="mb-2">Waiting for the sync to start...</p>
+                <div class="progress mb-3">
+                    <div id="sync-bar" class="progress-bar progress-bar-striped progress-bar-animated" role="progressbar" style="width: 100%"></div>
+                </div>
+                <p class="mb-0">
+                    <strong>Activities fetched:</strong> <span id="sync-fetched">0</span><br>
+                    <strong>Pages remaining:</strong> <span id="sync-pages">unknown</span><br>
+                    <strong>Time remaining:</strong> <span id="sync-eta">estimating</span>
+                </p>
+            </div>
+
+            <div id="sync-done" class="alert alert-success d-none">
+                <h4>Sync Successful!</h4>
+                <p>Successfully synced <span id="sync-count"></span> activities.</p>
+                <a href="/heatmap" class="btn btn-primary">View Heatmap</a>
+                <a href="/sync" class="btn btn-secondary">Sync More Activities</a>
+            </div>
+
+            <div id="sync-failed" class="alert alert-danger d-none">
+                <h4>Error During Sync</h4>
+                <p id="sync-error"></p>
+                <a href="/sync" class="btn btn-primary">Try Again</a>
+            </div>
+        </div>
+    </div>
+</main>
+
+<script>
+    (function() {
+        const statusUrl = '/sync/status?job={{job_id}}';
+
+        function formatSeconds(seconds) {
+            if (seconds === null || seconds === undefined) return 'estimating';
+            const minutes = Math.floor(seconds / 60);
+            return minutes ? minutes + ' min ' + Math.round(seconds % 60) + ' s' : Math.round(seconds) + ' s';
+        }
+
+        function poll() {
+            fetch(statusUrl, {cache: 'no-store'})
+                .then(response => response.json())
+                .then(job => {
+                    const progress = job.progress || {};
+                    if (job.state === 'done') {
+                        document.getElementById('sync-running').classList.add('d-none');
+                        document.getElementById('sync-count').textContent = job.result;
+                        document.getElementById('sync-done').classList.remove('d-none');
+                        return;
+                    }
+                    if (job.state === 'failed' || job.error) {
+                        document.getElementById('sync-running').classList.add('d-none');
+                        document.getElementById('sync-error').textContent = job.error;
+                        document.getElementById('sync-failed').classList.remove('d-none');
+                        return;
+                    }
+                    document.getElementById('sync-stage').textContent = progress.stage || 'Waiting for the sync to start...';
+                    document.getElementById('sync-fetched').textContent = progress.fetched || 0;
+                    document.getElementById('sync-pages').textContent =
+                        progress.pages_remaining === null || progress.pages_remaining === undefined ? 'unknown' : progress.pages_remaining;
+                    document.getElementById('sync-eta').textContent = formatSeconds(job.eta);
+                    if (progress.done && progress.remaining !== null && progress.remaining !== undefined) {
+                        const percent = 100 * progress.done / (progress.done + progress.remaining);
+                        document.getElementById('sync-bar').style.width = percent + '%';
+                    }
+                    setTimeout(poll, 1000);
+                })
+                .catch(() => setTimeout(poll, 3000));
+        }
+
+        poll();
+    })();
+</script>
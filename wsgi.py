@@ -0,0 +1,20 @@
+"""
+WSGI entry point for serving the app to concurrent users.
+
+    python wsgi.py
+    waitress-serve --listen=localhost:8080 --threads=8 wsgi:application
+    gunicorn --workers 1 --threads 8 wsgi:application
+
+Requests are handled on a pool of threads, so a slow map render no longer
+holds up other pages. Keep to a single process: sync jobs and their progress
+live in the process that started them.
+"""
+import os
+
+from app import application
+
+if __name__ == "__main__":
+    from waitress import serve
+
+    serve(application, host=os.getenv('HOST', 'localhost'), port=int(os.getenv('PORT', 8080)),
+          threads=int(os.getenv('WEB_THREADS', 8)))